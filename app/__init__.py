@@ -1,8 +1,44 @@
 from flask import Flask
+from jinja2 import FileSystemBytecodeCache
 from datetime import datetime
+import os
 from app.config import Config
 from app.models.database import init_db
 
+# Каталог байткода шаблонов, общий для воркеров gunicorn
+TEMPLATE_CACHE_DIR = '/var/cache/monitoring-web/jinja'
+# Размер LRU-кэша скомпилированных шаблонов в процессе
+TEMPLATE_CACHE_SIZE = 400
+
+
+def _configure_template_cache(app):
+    """Production: LRU-кэш шаблонов без проверки mtime и байткод на диске.
+    Должно вызываться до первого обращения к app.jinja_env."""
+    options = dict(app.jinja_options)
+    options['auto_reload'] = False
+    options['cache_size'] = TEMPLATE_CACHE_SIZE
+    cache_dir = os.environ.get('FLASK_TEMPLATE_CACHE_DIR', TEMPLATE_CACHE_DIR)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        options['bytecode_cache'] = FileSystemBytecodeCache(cache_dir, '%s.jinja.cache')
+    except OSError as e:
+        app.logger.warning(f"Кэш байткода шаблонов недоступен ({cache_dir}): {e}")
+    app.jinja_options = options
+
+
+def _precompile_templates(app):
+    """Загружает все шаблоны в кэш окружения (и байткод на диск для остальных воркеров)"""
+    env = app.jinja_env
+    count = 0
+    for name in env.list_templates(extensions=['html']):
+        try:
+            env.get_template(name)
+            count += 1
+        except Exception as e:
+            app.logger.error(f"Шаблон {name} не скомпилирован: {e}")
+    app.logger.debug(f"Предкомпилировано шаблонов: {count}")
+
+
 def create_app(config_class=Config):
     """Factory для создания Flask приложения"""
     app = Flask(__name__)
@@ -30,20 +66,23 @@ def create_app(config_class=Config):
         pass
     # Сохраняем время старта приложения для uptime
     app.config['STARTED_AT'] = datetime.now()
-    # Авто‑перезагрузка шаблонов (полезно при правках UI)
-    try:
-        import os
-        auto_reload = os.environ.get('FLASK_TEMPLATES_AUTO_RELOAD', '1') in ('1', 'true', 'True')
-    except Exception:
-        auto_reload = True
+    # Авто‑перезагрузка шаблонов (полезно при правках UI) — только по флагу
+    auto_reload = os.environ.get('FLASK_TEMPLATES_AUTO_RELOAD', '0') in ('1', 'true', 'True')
     app.config['TEMPLATES_AUTO_RELOAD'] = auto_reload
-    # Отключаем кэш шаблонов и уменьшаем кэш статики
-    app.jinja_env.auto_reload = True
-    app.jinja_env.cache = {}
-    app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
+    if auto_reload:
+        # Режим разработки: шаблоны перечитываются при изменении, кэш статики отключён
+        app.jinja_env.auto_reload = True
+        app.jinja_env.cache = {}
+        app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
+    else:
+        _configure_template_cache(app)
     
     # Инициализация БД
     init_db(app)
+
+    # Метрики запросов (/api/metrics)
+    from app.utils.metrics import init_metrics
+    init_metrics(app)
     
     # Регистрация blueprints
     from app.blueprints.main import bp as main_bp
@@ -67,6 +106,10 @@ def create_app(config_class=Config):
     # Регистрируем фильтры Jinja2
     from app.utils.filters import register_filters
     register_filters(app)
+
+    if not auto_reload:
+        # Компилируем все шаблоны заранее (после регистрации фильтров)
+        _precompile_templates(app)
     
     # Регистрируем context processor для глобальных переменных
     @app.context_processor
@@ -106,8 +149,10 @@ def create_app(config_class=Config):
     try:
         from app.models.auth import ensure_tables, get_user_by_username, create_user
         from app.models.ai_query import ensure_ai_tables
+        from app.models.slow_query import ensure_slow_query_tables
         ensure_tables()
         ensure_ai_tables()
+        ensure_slow_query_tables()
         admin_defaults = cfg_instance.ADMIN_DEFAULT if 'cfg_instance' in locals() else None
         if admin_defaults and admin_defaults.get('username') and admin_defaults.get('password'):
             if not get_user_by_username(admin_defaults['username']):
@@ -1,6 +1,7 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash
 from app.utils.decorators import admin_required
 from app.models.auth import list_users, create_user, set_admin, set_active, update_password
+from app.models.slow_query import top_fingerprints, fingerprint_samples
 
 bp = Blueprint('admin', __name__)
 
@@ -56,3 +57,19 @@ def users_reset_password(user_id):
     update_password(user_id, password)
     flash('Пароль обновлён', 'success')
     return redirect(url_for('admin.index'))
+
+
+@bp.route('/slow-queries')
+@admin_required
+def slow_queries():
+    days = request.args.get('days', 7, type=int) or 7
+    fingerprint = request.args.get('fp', '').strip()
+    rows, samples, error = [], [], None
+    try:
+        rows = top_fingerprints(days=days)
+        if fingerprint:
+            samples = fingerprint_samples(fingerprint)
+    except Exception as e:
+        error = str(e)
+    return render_template('admin/slow_queries.html', rows=rows, samples=samples,
+                           fingerprint=fingerprint, days=days, error=error)
@@ -1,13 +1,37 @@
-from flask import Blueprint, jsonify, request, current_app
+from flask import Blueprint, Response, jsonify, request, current_app
 from app.models.database import db_manager
+from app.services.snapshot import dashboard_snapshot
 from datetime import datetime, timedelta
 import logging
 import os
+import threading
 
 def _repo_root() -> str:
     return os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
 
+_version_cache = {'key': (), 'value': None}
+_version_lock = threading.Lock()
+
 def _get_version_info():
+    """(version, last_update_iso) с кэшем на процесс.
+    Пересчитывается только при изменении mtime/размера файла VERSION
+    (обход дерева app/ в фоллбэке выполняется один раз).
+    """
+    try:
+        st = os.stat(os.path.join(_repo_root(), 'VERSION'))
+        key = (st.st_mtime_ns, st.st_size)
+    except OSError:
+        key = None
+    cached = _version_cache
+    if cached['value'] is not None and cached['key'] == key:
+        return cached['value']
+    with _version_lock:
+        if _version_cache['value'] is None or _version_cache['key'] != key:
+            _version_cache['value'] = _read_version_info()
+            _version_cache['key'] = key
+        return _version_cache['value']
+
+def _read_version_info():
     """Возвращает (version, last_update_iso).
     Источник истины — файл VERSION в корне проекта:
       - version = содержимое VERSION (например, "2.1").
@@ -103,7 +127,8 @@ def index():
                 "/api/smb/files": "Открытые файлы SMB",
                 "/api/smb/users": "Пользователи SMB",
                 "/api/smb/stats": "Статистика SMB"
-            }
+            },
+            "/api/metrics": "Метрики процесса (формат Prometheus)"
         }
     })
 
@@ -124,7 +149,8 @@ def docs():
             "GET /api/docs": "Документация API",
             "GET /api/vpn/*": "VPN мониторинг endpoints",
             "GET /api/rdp/*": "RDP мониторинг endpoints", 
-            "GET /api/smb/*": "SMB мониторинг endpoints"
+            "GET /api/smb/*": "SMB мониторинг endpoints",
+            "GET /api/metrics": "Латентность SQL-запросов и маршрутов (text exposition format)"
         }
     })
 
@@ -134,20 +160,9 @@ def docs():
 def vpn_sessions():
     """Получить активные VPN сессии"""
     try:
-        # Читаем активные сессии из CSV файла, как в исходном проекте
-        state_file = '/var/log/mikrotik/ikev2_active.csv'
-        sessions = []
-        with open(state_file, 'r', encoding='utf-8') as f:
-            for line in f:
-                parts = line.strip().split(',')
-                if len(parts) == 4:
-                    username, outer_ip, inner_ip, time_start = parts
-                    sessions.append({
-                        'username': username,
-                        'outer_ip': outer_ip,
-                        'inner_ip': inner_ip,
-                        'time_start': time_start
-                    })
+        # Активные сессии из файла состояния ike2mon (путь из конфигурации)
+        from app.blueprints.vpn import read_active_vpn_sessions
+        sessions = read_active_vpn_sessions() or []
         return jsonify({
             "status": "success",
             "count": len(sessions),
@@ -205,37 +220,16 @@ def vpn_history():
 def vpn_stats():
     """Статистика VPN"""
     try:
-        with db_manager.get_connection('vpn') as conn:
-            with conn.cursor() as cursor:
-                # Активные сессии
-                cursor.execute("SELECT COUNT(*) as active FROM session_history WHERE time_end IS NULL")
-                active_count = cursor.fetchone()['active']
-                
-                # Всего сессий за сегодня
-                cursor.execute("""
-                    SELECT COUNT(*) as today 
-                    FROM session_history 
-                    WHERE DATE(time_start) = CURDATE()
-                """)
-                today_count = cursor.fetchone()['today']
-                
-                # Уникальные пользователи за сегодня
-                cursor.execute("""
-                    SELECT COUNT(DISTINCT username) as unique_users 
-                    FROM session_history 
-                    WHERE DATE(time_start) = CURDATE()
-                """)
-                unique_users = cursor.fetchone()['unique_users']
-                
-                return jsonify({
-                    "status": "success",
-                    "data": {
-                        "active_sessions": active_count,
-                        "sessions_today": today_count,
-                        "unique_users_today": unique_users,
-                        "timestamp": datetime.now().isoformat()
-                    }
-                })
+        vpn = dashboard_snapshot.get()['vpn']
+        return jsonify({
+            "status": "success",
+            "data": {
+                "active_sessions": vpn['open_history'],
+                "sessions_today": vpn['sessions_today'],
+                "unique_users_today": vpn['unique_users_today'],
+                "timestamp": datetime.now().isoformat()
+            }
+        })
     except Exception as e:
         current_app.logger.error(f"VPN stats API error: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
@@ -474,45 +468,18 @@ def smb_users():
 def smb_stats():
     """Статистика SMB"""
     try:
-        with db_manager.get_connection('smb') as conn:
-            with conn.cursor() as cursor:
-                # Активные сессии
-                cursor.execute("SELECT COUNT(*) as active FROM active_smb_sessions")
-                active_sessions = cursor.fetchone()['active']
-                
-                # Активные пользователи
-                cursor.execute("""
-                    SELECT COUNT(DISTINCT user_id) as active_users 
-                    FROM active_smb_sessions
-                """)
-                active_users = cursor.fetchone()['active_users']
-                
-                # Открытые файлы
-                cursor.execute("""
-                    SELECT COUNT(DISTINCT file_id) as open_files 
-                    FROM active_smb_sessions
-                """)
-                open_files = cursor.fetchone()['open_files']
-                
-                # Всего пользователей
-                cursor.execute("SELECT COUNT(*) as total_users FROM smb_users")
-                total_users = cursor.fetchone()['total_users']
-                
-                # Всего файлов
-                cursor.execute("SELECT COUNT(*) as total_files FROM smb_files")
-                total_files = cursor.fetchone()['total_files']
-                
-                return jsonify({
-                    "status": "success",
-                    "data": {
-                        "active_sessions": active_sessions,
-                        "active_users": active_users,
-                        "open_files": open_files,
-                        "total_users": total_users,
-                        "total_files": total_files,
-                        "timestamp": datetime.now().isoformat()
-                    }
-                })
+        smb = dashboard_snapshot.get()['smb']
+        return jsonify({
+            "status": "success",
+            "data": {
+                "active_sessions": smb['active_sessions'],
+                "active_users": smb['active_users'],
+                "open_files": smb['open_files'],
+                "total_users": smb['total_users'],
+                "total_files": smb['total_files'],
+                "timestamp": datetime.now().isoformat()
+            }
+        })
     except Exception as e:
         current_app.logger.error(f"SMB stats API error: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
@@ -559,17 +526,24 @@ def health():
             "timestamp": datetime.now().isoformat()
         }), 500
 
+@bp.route('/metrics')
+def metrics():
+    """Метрики процесса в текстовом формате Prometheus"""
+    from app.utils.metrics import registry
+    return Response(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 @bp.route('/status')
 def status():
     """Статус системы мониторинга"""
     try:
-        # Получаем данные из всех модулей
+        # Данные всех модулей — из общего снимка (обновляется в фоне)
         vpn_data = get_vpn_dashboard_data()
         rdp_data = get_rdp_dashboard_data()
         smb_data = get_smb_dashboard_data()
         
-        # Время последнего обновления
-        last_update = datetime.now().strftime("%d.%m.%Y %H:%M:%S")
+        # Время последнего обновления — момент построения снимка
+        generated_at = dashboard_snapshot.get()['generated_at'] or datetime.now()
+        last_update = generated_at.strftime("%d.%m.%Y %H:%M:%S")
         
         return jsonify({
             'status': 'ok',
@@ -626,90 +600,28 @@ def test_dashboard():
 
 def get_vpn_dashboard_data():
     """Получить данные VPN для дашборда"""
-    try:
-        # Используем внутренний запрос к рабочему VPN API endpoint
-        import requests
-        response = requests.get('http://127.0.0.1:5050/api/vpn/sessions', timeout=5)
-        if response.status_code == 200:
-            data = response.json()
-            
-            # Подсчитываем уникальных пользователей
-            if data.get('data'):
-                unique_users = set()
-                for session in data['data']:
-                    if session.get('username'):
-                        unique_users.add(session['username'])
-                active_count = len(unique_users)
-            else:
-                active_count = 0
-                
-            return {
-                'active_sessions': active_count,
-                'today_sessions': 0,  # Упрощённо, пока не исправим
-                'mikrotik_devices': 0  # Упрощённо, пока не исправим
-            }
-    except Exception as e:
-        current_app.logger.error(f"VPN dashboard data error: {e}")
-    
-    return {'active_sessions': 0, 'today_sessions': 0, 'mikrotik_devices': 0}
+    snapshot = dashboard_snapshot.get()
+    return {
+        # Активные — уникальные пользователи, а не число сессий
+        'active_sessions': snapshot['vpn']['active_users'],
+        'today_sessions': snapshot['vpn']['sessions_today'],
+        'mikrotik_devices': snapshot['mikrotik']['devices']
+    }
 
 def get_rdp_dashboard_data():
     """Получить данные RDP для дашборда"""
-    try:
-        # Используем внутренний запрос к рабочему RDP API endpoint
-        import requests
-        response = requests.get('http://127.0.0.1:5050/api/rdp/sessions', timeout=5)
-        if response.status_code == 200:
-            data = response.json()
-            
-            # Подсчитываем уникальных пользователей, а не общее количество сессий
-            if data.get('data'):
-                unique_users = set()
-                for session in data['data']:
-                    if session.get('username'):
-                        unique_users.add(session['username'])
-                count = len(unique_users)
-            else:
-                count = 0
-                
-            return {'active_sessions': count}
-    except Exception as e:
-        current_app.logger.error(f"RDP dashboard data error: {e}")
-    
-    return {'active_sessions': 0}
+    # Уникальные пользователи, а не общее количество сессий
+    return {'active_sessions': dashboard_snapshot.get()['rdp']['active_users']}
 
 def get_smb_dashboard_data():
     """Получить данные SMB для дашборда"""
-    try:
-        # Используем внутренний запрос к рабочему SMB API endpoint
-        import requests
-        response = requests.get('http://127.0.0.1:5050/api/smb/sessions', timeout=5)
-        if response.status_code == 200:
-            data = response.json()
-            
-            # Подсчитываем открытые файлы и уникальных пользователей
-            open_files_count = data.get('count', 0)
-            
-            # Подсчитываем уникальных пользователей с открытыми файлами
-            unique_users_count = 0
-            if data.get('data'):
-                unique_users = set()
-                for session in data['data']:
-                    if session.get('username'):
-                        # Извлекаем имя пользователя из формата "DOMAIN\\username"
-                        username = session['username'].split('\\')[-1] if '\\' in session['username'] else session['username']
-                        unique_users.add(username)
-                unique_users_count = len(unique_users)
-            
-            return {
-                'open_files': open_files_count,
-                'files_modified_today': 0,  # Упрощённо, пока не исправим
-                'rdp_users_with_files': unique_users_count  # Количество уникальных пользователей с открытыми файлами
-            }
-    except Exception as e:
-        current_app.logger.error(f"SMB dashboard data error: {e}")
-    
-    return {'open_files': 0, 'files_modified_today': 0, 'rdp_users_with_files': 0}
+    smb = dashboard_snapshot.get()['smb']
+    return {
+        'open_files': smb['open_files'],
+        'files_modified_today': smb['modified_24h'],
+        # Уникальные пользователи с открытыми файлами (имя без домена)
+        'rdp_users_with_files': smb['active_short_users']
+    }
 
 def get_system_uptime():
     """Получить uptime системы"""
@@ -5,6 +5,7 @@ from datetime import datetime
 import os
 import subprocess
 from app.blueprints.api import _get_version_info
+from app.services.snapshot import dashboard_snapshot
 
 logger = logging.getLogger(__name__)
 
@@ -13,160 +14,30 @@ bp = Blueprint('main', __name__)
 @bp.route('/')
 def index():
     """Главный дашборд системы мониторинга"""
+    # Счётчики и короткие списки — из общего снимка (обновляется в фоне)
+    snapshot = dashboard_snapshot.get()
+    vpn, rdp, smb, mt = snapshot['vpn'], snapshot['rdp'], snapshot['smb'], snapshot['mikrotik']
     stats = {
-        'vpn_active': 0,
-        'vpn_total_today': 0,
-        'rdp_active': 0,
-        'rdp_total_today': 0,
-        'smb_active': 0,
-        'smb_users_active': 0,
-        'mt_devices': 0,
-        'mt_if_addrs': 0
+        'vpn_active': vpn['active_sessions'],
+        'vpn_total_today': vpn['sessions_today'],
+        'rdp_active': rdp['active_sessions'],
+        'rdp_total_today': rdp['sessions_today'],
+        'smb_active': smb['active_sessions'],
+        'smb_users_active': smb['active_users'],
+        'mt_devices': mt['devices'],
+        'mt_if_addrs': mt['if_addrs']
     }
     # Списки для UI
-    vpn_users = []            # [{username}]
-    rdp_users = []            # [{username, collection_name}]
-    smb_files = []            # [{id, name, full_path}]
-    
-    try:
-        # VPN статистика
-        with db_manager.get_connection('vpn') as conn:
-            with conn.cursor() as cur:
-                # Активные VPN сессии (из CSV файла, как в исходном проекте)
-                try:
-                    # Импортируем утилиту чтения сессий из VPN blueprint, чтобы не дублировать
-                    from app.blueprints.vpn import read_active_vpn_sessions
-                    sessions = read_active_vpn_sessions() or []
-                    stats['vpn_active'] = len(sessions)
-                    # Список текущих пользователей (уникальные, сортируем алфавитно, ограничим 10)
-                    usernames = sorted({(s.get('username') or '').strip() for s in sessions if s.get('username')})
-                    vpn_users = [{'username': u} for u in usernames[:10]]
-                except Exception as e:
-                    logger.error(f"Error reading VPN state file: {e}")
-                    stats['vpn_active'] = 0
-                
-                # Всего сессий за сегодня
-                cur.execute("""
-                    SELECT COUNT(*) as count 
-                    FROM session_history 
-                    WHERE DATE(time_start) = CURDATE()
-                """)
-                result = cur.fetchone()
-                if result:
-                    stats['vpn_total_today'] = result['count']
-    
-    except Exception as e:
-        logger.error(f"Ошибка получения VPN статистики: {e}")
-    
-    try:
-        # MikroTik: карта устройств и адресов интерфейсов
-        try:
-            from app.blueprints.vpn import read_mikrotik_map
-            mt_rows = read_mikrotik_map() or []
-            stats['mt_if_addrs'] = len(mt_rows)
-            stats['mt_devices'] = len({r.get('identity') for r in mt_rows if r.get('identity')})
-        except Exception as e:
-            logger.error(f"Ошибка чтения карты MikroTik: {e}")
+    vpn_users = [{'username': u} for u in vpn['users']]     # [{username}]
+    rdp_users = rdp['users']                                # [{username, collection_name}]
+    smb_files = smb['files']                                # [{id, name, full_path}]
 
-        # RDP статистика
-        # RDP статистика
-        with db_manager.get_connection('rdp') as conn:
-            with conn.cursor() as cur:
-                # Активные RDP сессии
-                cur.execute("""
-                    SELECT username, collection_name
-                    FROM rdp_active_sessions
-                    ORDER BY username ASC
-                """)
-                rows = cur.fetchall() or []
-                stats['rdp_active'] = len(rows)
-                # Список пользователей с коллекцией
-                seen = set()
-                for r in rows:
-                    u = (r.get('username') or '').strip()
-                    if not u or u in seen:
-                        continue
-                    rdp_users.append({'username': u, 'collection_name': r.get('collection_name')})
-                    seen.add(u)
-                    if len(rdp_users) >= 10:
-                        break
-                
-                # Всего сессий за сегодня
-                cur.execute("""
-                    SELECT COUNT(*) as count 
-                    FROM rdp_session_history 
-                    WHERE DATE(login_time) = CURDATE()
-                """)
-                result = cur.fetchone()
-                if result:
-                    stats['rdp_total_today'] = result['count']
-    
-    except Exception as e:
-        logger.error(f"Ошибка получения RDP статистики: {e}")
-    
-    try:
-        # SMB статистика
-        with db_manager.get_connection('smb') as conn:
-            with conn.cursor() as cur:
-                # Активные SMB сессии
-                cur.execute("SELECT COUNT(*) as count FROM active_smb_sessions")
-                result = cur.fetchone()
-                if result:
-                    stats['smb_active'] = result['count']
-                
-                # Уникальные активные пользователи
-                cur.execute("""
-                    SELECT COUNT(DISTINCT user_id) as count 
-                    FROM active_smb_sessions
-                """)
-                result = cur.fetchone()
-                if result:
-                    stats['smb_users_active'] = result['count']
-
-                # Текущие открытые файлы (имя для показа + полный путь во всплывающей подсказке)
-                cur.execute(
-                    """
-                    SELECT f.id, f.path
-                    FROM active_smb_sessions s
-                    LEFT JOIN smb_files f ON s.file_id = f.id
-                    WHERE f.id IS NOT NULL
-                    ORDER BY f.path
-                    LIMIT 10
-                    """
-                )
-                for row in cur.fetchall() or []:
-                    path = row.get('path') or ''
-                    # преобразуем двойные подчёркивания в разделители, берём только имя для показа
-                    display = (path or '').replace('__', '\\').replace('/', '\\').split('\\')[-1]
-                    # привести регистр: первая буква заглавная, остальное маленькое; расширение нижним регистром
-                    base, ext = (display.rsplit('.', 1) + [''])[:2]
-                    base = (base.strip().lower().capitalize()) if base else ''
-                    ext = ('.' + ext.lower()) if ext else ''
-                    smb_files.append({'id': row['id'], 'name': base + ext, 'full_path': path})
-    
-    except Exception as e:
-        logger.error(f"Ошибка получения SMB статистики: {e}")
-    
-    # Версия приложения для немедленного отображения на странице
-    try:
-        # Получаем версию приложения и дату начала БД
-        version_info = _get_version_info()
-        app_version = version_info[0] if version_info and len(version_info) > 0 else 'unknown'
-        
-        from app.utils.db_info import get_db_start_date
-        db_start_date = get_db_start_date()
-    
-    except Exception:
-        app_version = 'unknown'
-        db_start_date = None
-    
+    # app_version и db_start_date добавляет context processor inject_global_vars
     return render_template('index.html', 
                          stats=stats, 
                          vpn_users=vpn_users,
                          rdp_users=rdp_users,
-                         smb_files=smb_files,
-                         app_version=app_version,
-                         db_start_date=db_start_date)
+                         smb_files=smb_files)
 
 @bp.route('/health')
 def health_check():
@@ -1,5 +1,6 @@
 from flask import Blueprint, render_template, request, jsonify, current_app, send_file
 from app.models.database import db_manager
+from app.services.snapshot import dashboard_snapshot
 from datetime import datetime, timedelta
 import logging
 import os
@@ -384,31 +385,9 @@ def index():
                     item['in_rdp_session'] = bool(r.get('open_in_rdp', 0))  # Используем встроенное поле
                     files.append(item)
 
-                # Статистика (выносим ИЗ цикла!)
-                cursor.execute("SELECT COUNT(*) as total FROM active_smb_sessions")
-                active_sessions = cursor.fetchone()['total']
-                cursor.execute("SELECT COUNT(DISTINCT user_id) as total FROM active_smb_sessions")
-                active_users = cursor.fetchone()['total']
-                cursor.execute("SELECT COUNT(DISTINCT file_id) as total FROM active_smb_sessions")
-                open_files = cursor.fetchone()['total']
-                cursor.execute("""
-                    SELECT COUNT(DISTINCT file_id) as total 
-                    FROM smb_session_history 
-                    WHERE open_time >= DATE_SUB(NOW(), INTERVAL 24 HOUR)
-                      AND final_size != initial_size
-                """)
-                modified_files_today = cursor.fetchone()['total']
-
-                # Пользователи с активными RDP
-                users_with_rdp = 0
-                try:
-                    with db_manager.get_connection('rdp') as rdp_conn:
-                        with rdp_conn.cursor() as rdp_cursor:
-                            rdp_cursor.execute("SELECT COUNT(DISTINCT username) as total FROM rdp_active_sessions")
-                            users_with_rdp = rdp_cursor.fetchone()['total']
-                except Exception as e:
-                    current_app.logger.warning(f"Could not fetch RDP users count: {e}")
-                    users_with_rdp = 0
+                # Статистика — из общего снимка дашбордов (обновляется в фоне)
+                snapshot = dashboard_snapshot.get()
+                smb_snapshot = snapshot['smb']
 
                 return render_template('smb/index.html',
                                      users=users,
@@ -424,11 +403,11 @@ def index():
                                          'pages': (math.ceil(total_files / per_page) if per_page else 1)
                                      },
                                      stats={
-                                              'active_sessions': active_sessions,
-                                              'active_users': active_users,
-                                              'open_files': open_files,
-                                              'modified_files_today': modified_files_today,
-                                              'users_with_rdp': users_with_rdp
+                                              'active_sessions': smb_snapshot['active_sessions'],
+                                              'active_users': smb_snapshot['active_users'],
+                                              'open_files': smb_snapshot['open_files'],
+                                              'modified_files_today': smb_snapshot['modified_24h'],
+                                              'users_with_rdp': snapshot['rdp']['active_users']
                                           })
                 recent_query = """
                     SELECT DISTINCT f.id as file_id, f.path, u.id as user_id, u.username,
@@ -1,10 +1,12 @@
 from flask import Blueprint, render_template, request, jsonify, current_app, send_from_directory, redirect, url_for
 from app.models.database import db_manager
+from app.services.snapshot import dashboard_snapshot
+from app.services import stats as stats_service
 from datetime import datetime, timedelta
 import logging
-import csv
 import os
-import ipaddress
+from app.utils.vpn_state import vpn_state
+from app.utils.mikrotik_map import get_mikrotik_map, load_mikrotik_map, group_by_identity, map_counts
 
 bp = Blueprint('vpn', __name__)
 
@@ -12,118 +14,30 @@ def read_mikrotik_map():
     """Чтение карты MikroTik: возвращает список адресов на интерфейсах.
     Единица списка — адрес (ip/mask) на интерфейсе устройства.
     Поля: identity, ip, iface, type.
-    Источник файла ищется по нескольким кандидатам.
+    Разбор и кэширование — app.utils.mikrotik_map; список общий, не изменять.
     """
-    try:
-        # Кандидаты путей в порядке приоритета
-        paths = []
-        try:
-            # 1) Боевой конфиг shares_f_map.mikrotik_map
-            sfm = current_app.config.get('SHARES_F_MAP') or {}
-            v0 = sfm.get('mikrotik_map')
-            if v0:
-                paths.append(str(v0))
-        except Exception:
-            pass
-        try:
-            # 2) Конфиг путей из config.Config
-            p = current_app.config.get('PATHS') or {}
-            v2 = p.get('mikrotik_map')
-            if v2:
-                paths.append(str(v2))
-        except Exception:
-            pass
-        try:
-            # 3) Явный ключ окружения/конфига
-            v = current_app.config.get('MIKROTIK_MAP_FILE')
-            if v:
-                paths.append(str(v))
-        except Exception:
-            pass
-        # Стандартные локации (обе версии проекта)
-        paths.extend([
-            '/opt/monitoring-web/data/full_map.csv',
-            '/opt/ike2web/data/full_map.csv',
-        ])
-        map_file = next((p for p in paths if p and os.path.exists(p)), None)
-        if not map_file:
-            current_app.logger.error("MikroTik map file not found in: %s", paths)
-            return []
-
-        rows = []
-        with open(map_file, 'r', encoding='utf-8') as f:
-            # Для диагностики: логируем выбранный путь один раз
-            try:
-                current_app.logger.debug(f"Using MikroTik map: {map_file}")
-            except Exception:
-                pass
-            peek = f.readline()
-            f.seek(0)
-            lower = peek.lower()
-            header_like = any(k in lower for k in ['identity', 'ip', 'iface', 'interface', 'type', 'mask'])
-            if header_like:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    identity = (row.get('identity') or row.get('Identity') or '').strip()
-                    ip = (row.get('ip') or row.get('address') or '').strip()
-                    iface = (row.get('iface') or row.get('interface') or row.get('location') or '').strip()
-                    rtype = (row.get('type') or row.get('flag') or '').strip()
-                    if rtype in ('D', 'I'):
-                        rtype = {'D': 'Dynamic', 'I': 'Internal'}[rtype]
-                    rows.append({'identity': identity, 'ip': ip, 'iface': iface, 'type': rtype})
-            else:
-                reader = csv.reader(f)
-                for row in reader:
-                    if not row:
-                        continue
-                    # Ожидаемый порядок: identity, ip, mask, iface, flag(optional)
-                    identity = row[0].strip() if len(row) > 0 else ''
-                    ip = row[1].strip() if len(row) > 1 else ''
-                    mask = row[2].strip() if len(row) > 2 else ''
-                    iface = row[3].strip() if len(row) > 3 else ''
-                    flag = row[4].strip() if len(row) > 4 else ''
-                    rtype = {'D': 'Dynamic', 'I': 'Internal'}.get(flag, flag or '-')
-                    ip_show = f"{ip}/{mask}" if mask else ip
-                    rows.append({'identity': identity, 'ip': ip_show, 'iface': iface, 'type': rtype})
-        return rows
-    except Exception as e:
-        current_app.logger.exception("Error reading MikroTik map")
-        return []
+    return get_mikrotik_map().rows
 
-def _build_mikrotik_networks():
-    """Строит список (identity, ip_network) из карты MikroTik."""
-    nets = []
-    try:
-        rows = read_mikrotik_map()
-        for r in rows:
-            cidr = (r.get('ip') or '').strip()
-            identity = (r.get('identity') or '').strip()
-            if not cidr or '/' not in cidr or not identity:
-                continue
-            try:
-                net = ipaddress.ip_network(cidr, strict=False)
-            except Exception:
-                continue
-            nets.append((identity, net))
-    except Exception:
-        pass
-    return nets
+def _get_router_index():
+    """PrefixIndex identity по сетям интерфейсов (живёт вместе с кэшем карты)."""
+    return get_mikrotik_map().prefix_index
+
+def _resolve_routers_by_inner_ip(inner_ips):
+    """Пакетно: identity MikroTik для каждого внутреннего IP (самая специфичная сеть), '' если нет."""
+    return _get_router_index().lookup_many(inner_ips, default='')
 
 def _resolve_router_by_inner_ip(inner_ip: str):
     """Возвращает identity MikroTik по внутреннему IP подключения."""
     if not inner_ip:
         return ''
-    try:
-        ip_obj = ipaddress.ip_address(inner_ip)
-    except Exception:
-        return ''
-    for identity, net in _build_mikrotik_networks():
-        try:
-            if ip_obj in net:
-                return identity
-        except Exception:
-            continue
-    return ''
+    return _get_router_index().lookup(inner_ip, default='')
+
+def _fill_device_names(rows):
+    """Заполняет device_name у строк без него (пакетный поиск по inner_ip)."""
+    pending = [it for it in rows if not it.get('device_name')]
+    names = _resolve_routers_by_inner_ip([it.get('inner_ip') for it in pending])
+    for it, name in zip(pending, names):
+        it['device_name'] = name or '-'
 
 def _parse_login_time(ts: str):
     """Парсим строку времени в datetime, совместимо с Python 3.6.
@@ -167,49 +81,11 @@ def _format_duration_from(dt: datetime):
         return 'N/A'
 
 def read_active_vpn_sessions():
-    """Чтение активных VPN сессий из файла состояния.
-    Поддерживает CSV без заголовка (username,outer_ip,inner_ip,time_start[,router]).
+    """Активные VPN сессии: подписка на сокет состояния ike2mon, запасной вариант — CSV.
+    Поля: username, outer_ip, inner_ip, time_start, router (см. app.utils.vpn_state).
     """
     try:
-        state_file = current_app.config.get('VPN_STATE_FILE', '/var/log/mikrotik/ikev2_active.csv')
-        if not os.path.exists(state_file):
-            return []
-
-        sessions = []
-        with open(state_file, 'r', encoding='utf-8') as f:
-            peek = f.readline()
-            f.seek(0)
-            # Определяем есть ли заголовок по наличию буквенных ключей
-            header_like = any(k in peek.lower() for k in ['username', 'outer', 'inner', 'time'])
-            if header_like:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    sessions.append({
-                        'username': row.get('username', '') or row.get('user', ''),
-                        'outer_ip': row.get('outer_ip', '') or row.get('remote_address', ''),
-                        'inner_ip': row.get('inner_ip', ''),
-                        'time_start': row.get('time_start', '') or row.get('login_time', ''),
-                        'router': row.get('router', '') or row.get('device_name', '')
-                    })
-            else:
-                reader = csv.reader(f)
-                for row in reader:
-                    if not row:
-                        continue
-                    # Ожидаем минимум 4 колонки
-                    username = row[0].strip() if len(row) > 0 else ''
-                    outer_ip = row[1].strip() if len(row) > 1 else ''
-                    inner_ip = row[2].strip() if len(row) > 2 else ''
-                    time_start = row[3].strip() if len(row) > 3 else ''
-                    router = row[4].strip() if len(row) > 4 else ''
-                    sessions.append({
-                        'username': username,
-                        'outer_ip': outer_ip,
-                        'inner_ip': inner_ip,
-                        'time_start': time_start,
-                        'router': router,
-                    })
-        return sessions
+        return vpn_state.sessions()
     except Exception as e:
         current_app.logger.error(f"Error reading VPN state: {e}")
         return []
@@ -258,9 +134,8 @@ def index():
                 week_stats = cursor.fetchone()
 
         # Дополнительные метрики для карточек
-        mikrotik_map = read_mikrotik_map()
-        # Считаем уникальные устройства по identity (как в топологии)
-        unique_devices = len(set(row['identity'] for row in mikrotik_map if row.get('identity')))
+        # Уникальные устройства по identity (как в топологии) — из кэша карты
+        unique_devices = get_mikrotik_map().device_count
         
         # Расчёт средней длительности активных сессий
         avg_duration = '0м'
@@ -315,7 +190,8 @@ def topology():
 def interfaces():
     """Список адресов на интерфейсах MikroTik с агрегированными счетчиками."""
     try:
-        rows = read_mikrotik_map()
+        mmap = get_mikrotik_map()
+        rows = mmap.rows
         try:
             current_app.logger.info(f"MikroTik interfaces: loaded {len(rows)} rows")
         except Exception:
@@ -323,24 +199,21 @@ def interfaces():
         selected_identity = request.args.get('identity', '').strip()
         if selected_identity:
             rows = [r for r in rows if (r.get('identity') or '').strip() == selected_identity]
-        try:
-            current_app.logger.info(f"MikroTik interfaces: after filter '{selected_identity}' -> {len(rows)} rows")
-        except Exception:
-            pass
-        address_count = len(rows)
-        device_count = len({r.get('identity') for r in rows if r.get('identity')})
-        interface_count = len({(r.get('identity'), r.get('iface')) for r in rows if r.get('identity') and r.get('iface')})
-        # Группируем по устройству (устойчиво к странным значениям)
-        groups = []
-        try:
-            names = {(r.get('identity') or '').strip() or '-' for r in rows}
-            for name in sorted(list(names), key=lambda x: x.lower()):
-                items = [t for t in rows if ((t.get('identity') or '').strip() or '-') == name]
-                items = sorted(items, key=lambda t: (t.get('iface') or '', t.get('ip') or ''))
-                groups.append({'identity': name, 'rows': items})
-        except Exception as ge:
-            current_app.logger.error(f"VPN interfaces grouping error: {ge}")
-            groups = []
+            try:
+                current_app.logger.info(f"MikroTik interfaces: after filter '{selected_identity}' -> {len(rows)} rows")
+            except Exception:
+                pass
+            counts = map_counts(rows)
+            groups = group_by_identity(rows)
+        else:
+            # Без фильтра группировки и счётчики готовы в кэше карты
+            counts = {'address_count': mmap.address_count,
+                      'device_count': mmap.device_count,
+                      'interface_count': mmap.interface_count}
+            groups = mmap.groups
+        address_count = counts['address_count']
+        device_count = counts['device_count']
+        interface_count = counts['interface_count']
 
         return render_template('vpn/interfaces.html',
                                groups=groups,
@@ -409,10 +282,8 @@ def history():
                 """, params + [per_page, offset])
                 
                 sessions = cursor.fetchall()
-                # enrich with router identity by inner_ip
-                for it in sessions:
-                    if not it.get('device_name'):
-                        it['device_name'] = _resolve_router_by_inner_ip(it.get('inner_ip')) or '-'
+                # enrich with router identity by inner_ip (одним пакетом на страницу)
+                _fill_device_names(sessions)
                 
                 # Пагинация
                 has_prev = page > 1
@@ -585,23 +456,21 @@ def mikrotik_topology():
 
         routers = {}
         vpn_peers = []
-        with open(full_map, encoding='utf-8') as f:
-            for row in csv.reader(f):
-                if len(row) < 4:
-                    continue
-                identity, ip, mask, iface = [x.strip() for x in row[:4]]
-                flag = row[4].strip() if len(row) > 4 else ""
-                if flag == "I":  # пропускаем внутренние
-                    continue
-                r = routers.setdefault(identity, {'lans': [], 'vpns': []})
-                if iface.startswith(('bridge', 'ether', 'vlan')):
-                    r['lans'].append(f"{ip}/{mask}")
-                # Учитываем L2TP, SSTP и другие VPN интерфейсы
-                if (iface.lower().startswith(('l2tp', 'sstp')) or 
-                    'l2tp' in iface.lower() or 'sstp' in iface.lower() or 
-                    is_vpn_ip(ip)):
-                    r['vpns'].append(f"{ip}/{mask}")
-                    vpn_peers.append((identity, ip, iface))
+        # Исходные поля строк из кэша карты (разбор CSV — только при изменении файла)
+        for identity, ip, mask, iface, flag in load_mikrotik_map(full_map).records:
+            if not iface:  # строки без интерфейса (неполные) пропускаем
+                continue
+            if flag == "I":  # пропускаем внутренние
+                continue
+            r = routers.setdefault(identity, {'lans': [], 'vpns': []})
+            if iface.startswith(('bridge', 'ether', 'vlan')):
+                r['lans'].append(f"{ip}/{mask}")
+            # Учитываем L2TP, SSTP и другие VPN интерфейсы
+            if (iface.lower().startswith(('l2tp', 'sstp')) or 
+                'l2tp' in iface.lower() or 'sstp' in iface.lower() or 
+                is_vpn_ip(ip)):
+                r['vpns'].append(f"{ip}/{mask}")
+                vpn_peers.append((identity, ip, iface))
 
         vpn_subnets = {}
         for identity, ip, iface in vpn_peers:
@@ -658,60 +527,13 @@ def mikrotik_topology():
 def stats():
     """Статистика VPN"""
     try:
-        with db_manager.get_connection('vpn') as conn:
-            with conn.cursor() as cursor:
-                # Активные сессии
-                cursor.execute("SELECT COUNT(*) as active FROM session_history WHERE time_end IS NULL")
-                active_sessions = cursor.fetchone()['active']
-                
-                # Статистика по дням за последние 30 дней
-                cursor.execute(
-                    """
-                    SELECT DATE(time_start) AS date,
-                           COUNT(*) AS sessions,
-                           COUNT(DISTINCT username) AS users
-                    FROM session_history
-                    WHERE time_start >= DATE_SUB(NOW(), INTERVAL 30 DAY)
-                    GROUP BY DATE(time_start)
-                    ORDER BY date DESC
-                    """
-                )
-                daily_stats = cursor.fetchall()
-                
-                # Топ пользователи за последние 30 дней
-                cursor.execute(
-                    """
-                    SELECT username,
-                           COUNT(*) AS sessions,
-                           AVG(TIMESTAMPDIFF(SECOND, time_start, COALESCE(time_end, NOW()))) AS avg_duration,
-                           SUM(TIMESTAMPDIFF(SECOND, time_start, COALESCE(time_end, NOW()))) AS total_duration
-                    FROM session_history
-                    WHERE time_start >= DATE_SUB(NOW(), INTERVAL 30 DAY)
-                    GROUP BY username
-                    ORDER BY sessions DESC
-                    LIMIT 20
-                    """
-                )
-                top_users = cursor.fetchall()
-                
-                # Статистика по часам за последнюю неделю
-                cursor.execute(
-                    """
-                    SELECT HOUR(time_start) AS hour,
-                           COUNT(*) AS sessions
-                    FROM session_history
-                    WHERE time_start >= DATE_SUB(NOW(), INTERVAL 7 DAY)
-                    GROUP BY HOUR(time_start)
-                    ORDER BY hour
-                    """
-                )
-                hourly_stats = cursor.fetchall()
-                
-                return render_template('vpn/stats.html',
-                                     active_sessions=active_sessions,
-                                     daily_stats=daily_stats,
-                                     top_users=top_users,
-                                     hourly_stats=hourly_stats)
+        # Активные — записи истории без time_end; по дням, топ пользователей и по часам —
+        # из сводных таблиц, которые ведёт ike2mon
+        return render_template('vpn/stats.html',
+                             active_sessions=stats_service.vpn_open_history_count(),
+                             daily_stats=stats_service.vpn_daily_stats(30),
+                             top_users=stats_service.vpn_user_totals(30, limit=20),
+                             hourly_stats=stats_service.vpn_hourly_stats(7))
     except Exception as e:
         current_app.logger.error(f"VPN stats error: {e}")
         return render_template('vpn/stats.html',
@@ -752,37 +574,17 @@ def api_sessions():
 def api_stats():
     """API: Статистика VPN"""
     try:
-        with db_manager.get_connection('vpn') as conn:
-            with conn.cursor() as cursor:
-                # Активные сессии
-                cursor.execute("SELECT COUNT(*) as active FROM session_history WHERE time_end IS NULL")
-                active_count = cursor.fetchone()['active']
-                
-                # Всего сессий за сегодня
-                cursor.execute("""
-                    SELECT COUNT(*) as today 
-                    FROM session_history 
-                    WHERE DATE(time_start) = CURDATE()
-                """)
-                today_count = cursor.fetchone()['today']
-                
-                # Уникальные пользователи за сегодня
-                cursor.execute("""
-                    SELECT COUNT(DISTINCT username) as unique_users 
-                    FROM session_history 
-                    WHERE DATE(time_start) = CURDATE()
-                """)
-                unique_users = cursor.fetchone()['unique_users']
-                
-                return jsonify({
-                    "status": "success",
-                    "data": {
-                        "active_sessions": active_count,
-                        "sessions_today": today_count,
-                        "unique_users_today": unique_users,
-                        "timestamp": datetime.now().isoformat()
-                    }
-                })
+        # Счётчики из общего снимка дашбордов (обновляется в фоне)
+        vpn = dashboard_snapshot.get()['vpn']
+        return jsonify({
+            "status": "success",
+            "data": {
+                "active_sessions": vpn['open_history'],
+                "sessions_today": vpn['sessions_today'],
+                "unique_users_today": vpn['unique_users_today'],
+                "timestamp": datetime.now().isoformat()
+            }
+        })
     except Exception as e:
         current_app.logger.error(f"VPN API stats error: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
@@ -806,14 +608,14 @@ def active_sessions():
     """Страница активных сессий с полной информацией"""
     try:
         raw_sessions = read_active_vpn_sessions()
+        # попытка определить маршрутизатор по внутреннему IP, если отсутствует
+        missing = [s.get('inner_ip') if not s.get('router') else None for s in raw_sessions]
+        resolved = _resolve_routers_by_inner_ip(missing)
         sessions = []
-        for s in raw_sessions:
+        for s, resolved_name in zip(raw_sessions, resolved):
             ts = s.get('time_start')
             login_dt = _parse_login_time(ts)
-            # попытка определить маршрутизатор по внутреннему IP, если отсутствует
-            device_name = s.get('router') or ''
-            if not device_name:
-                device_name = _resolve_router_by_inner_ip(s.get('inner_ip') or '')
+            device_name = s.get('router') or resolved_name or ''
             sessions.append({
                 'username': s.get('username') or '',
                 'remote_address': s.get('outer_ip') or '',
@@ -849,9 +651,7 @@ def today_sessions():
                 """)
                 sessions = cursor.fetchall()
                 # обогащаем маршрутизатором по внутреннему IP
-                for it in sessions:
-                    if not it.get('device_name'):
-                        it['device_name'] = _resolve_router_by_inner_ip(it.get('inner_ip')) or '-'
+                _fill_device_names(sessions)
         return render_template('vpn/today_sessions.html', sessions=sessions)
     except Exception as e:
         current_app.logger.error(f"VPN today sessions error: {e}")
@@ -862,27 +662,8 @@ def today_sessions():
 def devices():
     """Страница устройств MikroTik с адресами интерфейсов"""
     try:
-        mikrotik_map = read_mikrotik_map()
-        # Группируем по устройствам
-        devices = {}
-        for row in mikrotik_map:
-            identity = row.get('identity', '')
-            if not identity:
-                continue
-            if identity not in devices:
-                devices[identity] = {
-                    'identity': identity,
-                    'interfaces': [],
-                    'total_addresses': 0
-                }
-            devices[identity]['interfaces'].append({
-                'ip': row.get('ip', ''),
-                'iface': row.get('iface', ''),
-                'type': row.get('type', '')
-            })
-            devices[identity]['total_addresses'] += 1
-        
-        devices_list = list(devices.values())
+        # Группировка по устройствам готова в кэше карты
+        devices_list = get_mikrotik_map().devices
         return render_template('vpn/devices.html', devices=devices_list)
     except Exception as e:
         current_app.logger.error(f"VPN devices error: {e}")
@@ -897,21 +678,15 @@ def user_stats():
         if days not in [7, 30, 90, 365]:
             days = 30
         
-        with db_manager.get_connection('vpn') as conn:
-            with conn.cursor() as cursor:
-                cursor.execute("""
-                    SELECT username,
-                           COUNT(*) as total_sessions,
-                           AVG(TIMESTAMPDIFF(SECOND, time_start, COALESCE(time_end, NOW()))) as avg_duration_sec,
-                           MAX(TIMESTAMPDIFF(SECOND, time_start, COALESCE(time_end, NOW()))) as max_duration_sec,
-                           MAX(time_start) as last_login,
-                           COUNT(*) / %s as avg_per_day
-                    FROM session_history 
-                    WHERE time_start >= DATE_SUB(NOW(), INTERVAL %s DAY)
-                    GROUP BY username
-                    ORDER BY total_sessions DESC
-                """, (days, days))
-                users = cursor.fetchall()
+        # Итоги по пользователям — из сводной таблицы по дням (ведёт ike2mon)
+        users = [{
+            'username': row['username'],
+            'total_sessions': row['sessions'],
+            'avg_duration_sec': row['avg_duration'],
+            'max_duration_sec': row['max_duration'],
+            'last_login': row['last_login'],
+            'avg_per_day': row['sessions'] / days,
+        } for row in stats_service.vpn_user_totals(days)]
         
         # Форматируем длительности
         for user in users:
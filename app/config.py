@@ -1,17 +1,26 @@
-import json
 import os
+from infra.config import freeze, get_config, default_config_path
 
 class Config:
-    """Конфигурация приложения мониторинга"""
-    
+    """Конфигурация приложения мониторинга.
+    Экземпляр — лёгкое представление над процессным снимком config.json:
+    файл читается один раз и перечитывается только при изменении.
+    """
+
+    _default_snapshot = None
+
     def __init__(self):
-        config_path = os.environ.get('CONFIG_PATH', '/etc/infra/config.json')
+        self.config_path = default_config_path()
+
+    @property
+    def config(self):
         try:
-            with open(config_path, 'r', encoding='utf-8') as f:
-                self.config = json.load(f)
+            return get_config(self.config_path)
         except FileNotFoundError:
             # Fallback для разработки
-            self.config = self._get_default_config()
+            if Config._default_snapshot is None:
+                Config._default_snapshot = freeze(self._get_default_config())
+            return Config._default_snapshot
     
     def _get_default_config(self):
         """Конфигурация по умолчанию для разработки"""
@@ -76,6 +85,31 @@ class Config:
     def MYSQL_MONITORING(self):
         return self.config['mysql']['monitoring']
     
+    @property
+    def DB_POOL(self):
+        """Параметры пула соединений: max_size, max_idle, idle_timeout, wait_timeout, connect_timeout"""
+        return self.config.get('db_pool', {})
+
+    @property
+    def MYSQL_REPLICAS(self):
+        """Реплики для чтения: {"vpnstat": [{"host": ..., "port": ...}], ...}; недостающие поля берутся из primary"""
+        return self.config.get('mysql_replicas', {})
+
+    @property
+    def REPLICA_ROUTING(self):
+        """Маршрутизация чтения на реплики: max_lag, check_interval"""
+        return self.config.get('replica_routing', {})
+
+    @property
+    def DASHBOARD_SNAPSHOT(self):
+        """Снимок счётчиков дашбордов: interval (фоновое обновление), max_age"""
+        return self.config.get('dashboard_snapshot', {})
+
+    @property
+    def SLOW_QUERY(self):
+        """Журнал медленных запросов: enabled, threshold_ms, explain, explain_interval, queue_size, retention_days"""
+        return self.config.get('slow_query', {})
+
     # Пути и настройки
     @property
     def PATHS(self):
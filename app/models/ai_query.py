@@ -179,7 +179,7 @@ def execute_sql_readonly(db_type: str, sql: str, row_limit: int = 500) -> Tuple[
     limited_sql = sql
     if READONLY_SQL.match(sql) and 'limit' not in sql.lower():
         limited_sql = sql.rstrip(';') + f' LIMIT {row_limit}'
-    with db_manager.get_connection(db_type) as conn:
+    with db_manager.get_connection(db_type, readonly=True) as conn:
         with conn.cursor() as cur:
             cur.execute(limited_sql)
             rows = cur.fetchall()
@@ -1,78 +1,446 @@
 import pymysql
 from contextlib import contextmanager
-from flask import current_app, g
+from collections import deque
+from flask import current_app, g, has_app_context, request
 import logging
+import os
+import random
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 
+# Маппинг имен БД для совместимости
+DB_MAPPING = {
+    'vpn': 'vpnstat',
+    'rdp': 'rdpstat',
+    'smb': 'smbstat',
+    'auth': 'monitoring',
+    'monitoring': 'monitoring'
+}
+
+# Параметры пула по умолчанию (переопределяются секцией "db_pool" в config.json)
+POOL_DEFAULTS = {
+    'max_size': 10,         # максимум соединений на одну БД в процессе
+    'max_idle': 5,          # сколько простаивающих соединений держать
+    'idle_timeout': 300,    # секунды: простаивающие дольше — закрываются
+    'wait_timeout': 10,     # секунды ожидания свободного слота при исчерпании пула
+    'connect_timeout': 5,
+}
+
+# Маршрутизация чтения на реплики (секции "mysql_replicas" и "replica_routing")
+REPLICA_DEFAULTS = {
+    'max_lag': 30,          # секунды отставания, при которых реплика ещё годится для чтения
+    'check_interval': 15,   # как часто перепроверять состояние реплики
+}
+
+# GET-запросы этих blueprints только читают и могут обслуживаться репликой
+READONLY_BLUEPRINTS = ('vpn', 'rdp', 'smb', 'api')
+
+
+class PoolExhausted(RuntimeError):
+    """Не удалось получить соединение из пула за wait_timeout"""
+
+
+class InstrumentedCursor(pymysql.cursors.DictCursor):
+    """DictCursor, замеряющий время, число строк и fingerprint каждого запроса
+    (см. app.utils.metrics); медленные запросы уходят в app.models.slow_query"""
+
+    _measuring = False
+
+    def _measured(self, method, query, args, many=False):
+        # executemany внутри вызывает execute — считаем запрос один раз
+        if self._measuring:
+            return method(query, args)
+        from app.utils.metrics import record_query
+        from app.models.slow_query import recorder as slow_queries
+        self._measuring = True
+        started = time.perf_counter()
+        failed = False
+        try:
+            return method(query, args)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self._measuring = False
+            try:
+                duration = time.perf_counter() - started
+                rows = 0 if failed else self.rowcount
+                db_label = getattr(self.connection, 'db_label', None)
+                record_query(db_label, query, duration, rows, error=failed)
+                slow_queries.maybe_capture(db_label, query, args, duration, rows, many=many)
+            except Exception as e:
+                logger.debug(f"Не удалось записать метрику запроса: {e}")
+
+    def execute(self, query, args=None):
+        return self._measured(super().execute, query, args)
+
+    def executemany(self, query, args):
+        return self._measured(super().executemany, query, args, many=True)
+
+
+class ConnectionPool:
+    """Пул соединений к одной БД в пределах процесса.
+
+    - ограничение общего числа соединений (max_size);
+    - LIFO-выдача простаивающих соединений, вытеснение по idle_timeout;
+    - ping перед выдачей (мертвые соединения отбрасываются);
+    - после fork (gunicorn workers) пул сбрасывается без закрытия сокетов родителя.
+    """
+
+    def __init__(self, name, params, max_size=10, max_idle=5, idle_timeout=300, wait_timeout=10, db_label=None):
+        self.name = name
+        self.db_label = db_label or name
+        self.params = params
+        self.max_size = max(1, int(max_size))
+        self.max_idle = max(0, min(int(max_idle), self.max_size))
+        self.idle_timeout = float(idle_timeout)
+        self.wait_timeout = float(wait_timeout)
+        self._cond = threading.Condition(threading.Lock())
+        self._reset_state()
+
+    def _reset_state(self):
+        self._pid = os.getpid()
+        self._idle = deque()    # (conn, released_at)
+        self._in_use = 0
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            # Сокеты унаследованы от родителя: не закрываем (COM_QUIT оборвал бы
+            # соединения родителя), просто забываем про них.
+            self._cond = threading.Condition(threading.Lock())
+            self._reset_state()
+
+    def _connect(self):
+        conn = pymysql.connect(**self.params)
+        conn.db_label = self.db_label
+        logger.debug(f"Подключение к {self.name} установлено")
+        return conn
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _evict_idle(self, now):
+        """Закрывает соединения, простаивающие дольше idle_timeout (под локом)"""
+        stale = []
+        while self._idle and now - self._idle[0][1] > self.idle_timeout:
+            stale.append(self._idle.popleft()[0])
+        return stale
+
+    def acquire(self):
+        self._check_fork()
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            conn = None
+            with self._cond:
+                now = time.monotonic()
+                stale = self._evict_idle(now)
+                while not self._idle and self._in_use >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolExhausted(f"Пул {self.name} исчерпан ({self.max_size} соединений)")
+                    self._cond.wait(remaining)
+                if self._idle:
+                    conn = self._idle.pop()[0]
+                self._in_use += 1
+            for s in stale:
+                self._close_quietly(s)
+
+            if conn is None:
+                try:
+                    return self._connect()
+                except Exception:
+                    self._release_slot()
+                    raise
+            try:
+                conn.ping(reconnect=False)
+                return conn
+            except Exception:
+                logger.debug(f"Соединение {self.name} из пула не отвечает, отбрасываем")
+                self._close_quietly(conn)
+                self._release_slot()
+
+    def _release_slot(self):
+        with self._cond:
+            self._in_use = max(0, self._in_use - 1)
+            self._cond.notify()
+
+    def release(self, conn, discard=False):
+        """Возвращает соединение в пул (или закрывает, если discard/пул полон)"""
+        if self._pid != os.getpid():
+            return
+        if not discard:
+            try:
+                # Если кто-то открыл транзакцию — откатываем, чтобы не утекла в чужой запрос
+                if not conn.get_autocommit():
+                    conn.rollback()
+                    conn.autocommit(True)
+            except Exception:
+                discard = True
+        to_close = None
+        with self._cond:
+            self._in_use = max(0, self._in_use - 1)
+            if discard or not conn.open or len(self._idle) >= self.max_idle:
+                to_close = conn
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+        if to_close is not None:
+            self._close_quietly(to_close)
+            logger.debug(f"Подключение к {self.name} закрыто")
+
+    def close_all(self):
+        with self._cond:
+            idle = [c for c, _ in self._idle]
+            self._idle.clear()
+        for c in idle:
+            self._close_quietly(c)
+
+
+def _is_connection_error(exc):
+    """Ошибки, после которых соединение нельзя возвращать в пул"""
+    return isinstance(exc, (pymysql.err.OperationalError, pymysql.err.InterfaceError))
+
+
 class DatabaseManager:
     """Менеджер подключений к базам данных"""
-    
+
     def __init__(self, app=None):
         self.app = app
+        self._pools = {}
+        self._pools_lock = threading.Lock()
+        self._replica_state = {}        # ключ пула реплики -> (checked_at, lag или None)
+        self._replica_checking = set()
         if app:
             self.init_app(app)
-    
+
     def init_app(self, app):
         """Инициализация с Flask приложением"""
+        app.before_request(self._mark_readonly_request)
         app.teardown_appcontext(self.close_db)
-    
-    @contextmanager
-    def get_connection(self, db_type):
-        """
-        Контекстный менеджер для подключений к БД
-        
-        Args:
-            db_type: тип БД ('vpnstat', 'rdpstat', 'smbstat', 'monitoring' и др.)
-        """
-        # Маппинг имен БД для совместимости
-        db_mapping = {
-            'vpn': 'vpnstat',
-            'rdp': 'rdpstat', 
-            'smb': 'smbstat',
-            'auth': 'monitoring',
-            'monitoring': 'monitoring'
+
+    @staticmethod
+    def _mark_readonly_request():
+        """GET-запросы к дашбордам читают с реплики (если она настроена и здорова)"""
+        g.db_readonly = request.method in ('GET', 'HEAD') and request.blueprint in READONLY_BLUEPRINTS
+
+    @staticmethod
+    def _connection_params(config, pool_cfg):
+        return {
+            'host': config['host'],
+            'user': config['user'],
+            'password': config['password'],
+            'database': config['database'],
+            'port': int(config.get('port', 3306)),
+            'charset': config.get('charset', 'utf8mb4'),
+            'cursorclass': InstrumentedCursor,
+            'autocommit': True,
+            'connect_timeout': pool_cfg['connect_timeout'],
         }
-        
-        # Получаем правильное имя БД
-        actual_db_type = db_mapping.get(db_type, db_type)
-        
-        # Получаем конфигурацию БД из экземпляра Config
+
+    def _pool_for(self, key, db_label, params, pool_cfg):
+        with self._pools_lock:
+            pool = self._pools.get(key)
+            # Пересоздаём пул, если поменялись параметры подключения
+            if pool is None or pool.params != params:
+                if pool is not None:
+                    pool.close_all()
+                pool = ConnectionPool(
+                    key, params,
+                    max_size=pool_cfg['max_size'],
+                    max_idle=pool_cfg['max_idle'],
+                    idle_timeout=pool_cfg['idle_timeout'],
+                    wait_timeout=pool_cfg['wait_timeout'],
+                    db_label=db_label,
+                )
+                self._pools[key] = pool
+            return pool
+
+    def _db_settings(self, actual_db_type, db_type):
+        # Получаем конфигурацию БД из процессного экземпляра Config
         from app.config import Config
         config_instance = Config()
-        
+
         config_attr = f'MYSQL_{actual_db_type.upper()}'
         if hasattr(config_instance, config_attr):
             config = getattr(config_instance, config_attr)
         else:
             raise ValueError(f"Конфигурация для {db_type} не найдена")
-        
+
+        pool_cfg = dict(POOL_DEFAULTS)
+        pool_cfg.update(config_instance.DB_POOL or {})
+        return config_instance, config, pool_cfg
+
+    def _get_pool(self, actual_db_type, db_type):
+        _, config, pool_cfg = self._db_settings(actual_db_type, db_type)
+        params = self._connection_params(config, pool_cfg)
+        return self._pool_for(actual_db_type, actual_db_type, params, pool_cfg)
+
+    def _pick_replica(self, actual_db_type, db_type):
+        """Пул здоровой реплики с допустимым отставанием или None (читать с primary)"""
+        config_instance, config, pool_cfg = self._db_settings(actual_db_type, db_type)
+        replicas = (config_instance.MYSQL_REPLICAS or {}).get(actual_db_type)
+        if not replicas:
+            return None
+        routing = dict(REPLICA_DEFAULTS)
+        routing.update(config_instance.REPLICA_ROUTING or {})
+
+        candidates = []
+        for replica in replicas:
+            # Реплика наследует учётные данные и имя БД от primary
+            replica_config = dict(config)
+            replica_config.update(replica)
+            params = self._connection_params(replica_config, pool_cfg)
+            key = f"{actual_db_type}@{params['host']}:{params['port']}"
+            pool = self._pool_for(key, actual_db_type, params, pool_cfg)
+            lag = self._replica_lag(pool, float(routing['check_interval']))
+            if lag is not None and lag <= float(routing['max_lag']):
+                candidates.append(pool)
+        return random.choice(candidates) if candidates else None
+
+    def _replica_lag(self, pool, check_interval):
+        """Отставание реплики в секундах (None — недоступна/репликация стоит), с кэшированием"""
+        now = time.monotonic()
+        with self._pools_lock:
+            state = self._replica_state.get(pool.name)
+            if state is not None and now - state[0] < check_interval:
+                return state[1]
+            if pool.name in self._replica_checking:
+                # Проверяет другой поток — пока пользуемся прежним значением
+                return state[1] if state is not None else None
+            self._replica_checking.add(pool.name)
+        lag = None
         try:
-            conn = pymysql.connect(
-                host=config['host'],
-                user=config['user'],
-                password=config['password'],
-                database=config['database'],
-                charset=config.get('charset', 'utf8mb4'),
-                cursorclass=pymysql.cursors.DictCursor,
-                autocommit=True
-            )
-            logger.debug(f"Подключение к {db_type} установлено")
-            yield conn
+            lag = self._check_replica(pool)
+        finally:
+            with self._pools_lock:
+                self._replica_state[pool.name] = (time.monotonic(), lag)
+                self._replica_checking.discard(pool.name)
+        if lag is None:
+            logger.warning(f"Реплика {pool.name} недоступна или не реплицирует, чтение идёт с primary")
+        return lag
+
+    @staticmethod
+    def _check_replica(pool):
+        conn = None
+        try:
+            conn = pool.acquire()
+            with conn.cursor() as cursor:
+                try:
+                    cursor.execute("SHOW REPLICA STATUS")
+                except pymysql.err.ProgrammingError:
+                    # MySQL < 8.0.22
+                    cursor.execute("SHOW SLAVE STATUS")
+                row = cursor.fetchone()
+            pool.release(conn)
+        except Exception as e:
+            logger.debug(f"Проверка реплики {pool.name}: {e}")
+            if conn is not None:
+                pool.release(conn, discard=True)
+            return None
+        if not row:
+            return 0    # узел не реплика (например, член кластера) — отставания нет
+        lag = row.get('Seconds_Behind_Source', row.get('Seconds_Behind_Master'))
+        return None if lag is None else int(lag)
+
+    def _mark_replica_down(self, pool):
+        with self._pools_lock:
+            self._replica_state[pool.name] = (time.monotonic(), None)
+
+    @staticmethod
+    def _checkout(pool, slot, in_context):
+        """Соединение для слота запроса: переиспользуется внутри контекста приложения"""
+        if in_context:
+            held = g.db_connections.get(slot)
+            if held is not None and held[0] is pool:
+                return held[1], False
+            conn = pool.acquire()
+            g.db_connections[slot] = (pool, conn)
+            return conn, False
+        return pool.acquire(), True
+
+    @contextmanager
+    def get_connection(self, db_type, readonly=None):
+        """
+        Контекстный менеджер для подключений к БД.
+        Внутри контекста приложения соединение берётся из пула один раз на БД
+        и переиспользуется до конца запроса (возвращается в пул в close_db).
+
+        Args:
+            db_type: тип БД ('vpnstat', 'rdpstat', 'smbstat', 'monitoring' и др.)
+            readonly: читать с реплики, если есть здоровая; None — по типу
+                запроса (g.db_readonly, см. READONLY_BLUEPRINTS)
+        """
+        # Получаем правильное имя БД
+        actual_db_type = DB_MAPPING.get(db_type, db_type)
+
+        in_context = has_app_context()
+        if readonly is None:
+            readonly = in_context and bool(g.get('db_readonly'))
+        conn = None
+        pool = None
+        slot = actual_db_type
+        owned = False
+        try:
+            if in_context and not hasattr(g, 'db_connections'):
+                g.db_connections = {}
+            if readonly:
+                ro_slot = actual_db_type + ':ro'
+                held = g.db_connections.get(ro_slot) if in_context else None
+                replica = held[0] if held is not None else self._pick_replica(actual_db_type, db_type)
+                if replica is not None:
+                    try:
+                        conn, owned = self._checkout(replica, ro_slot, in_context)
+                        pool, slot = replica, ro_slot
+                    except Exception as e:
+                        logger.warning(f"Реплика {replica.name} недоступна, читаем с primary: {e}")
+                        self._mark_replica_down(replica)
+            if conn is None:
+                pool = self._get_pool(actual_db_type, db_type)
+                conn, owned = self._checkout(pool, slot, in_context)
         except Exception as e:
             logger.error(f"Ошибка подключения к {db_type}: {e}")
             raise
+
+        broken = False
+        try:
+            yield conn
+        except Exception as e:
+            broken = _is_connection_error(e)
+            if broken:
+                logger.error(f"Ошибка соединения с {db_type}: {e}")
+                if slot != actual_db_type:
+                    self._mark_replica_down(pool)
+            raise
         finally:
-            if 'conn' in locals():
-                conn.close()
-                logger.debug(f"Подключение к {db_type} закрыто")
-    
+            if owned:
+                pool.release(conn, discard=broken)
+            elif broken:
+                # Сломанное соединение убираем из запроса, следующий вызов возьмёт новое
+                held = g.db_connections.get(slot)
+                if held is not None and held[1] is conn:
+                    g.db_connections.pop(slot, None)
+                    pool.release(conn, discard=True)
+
     def close_db(self, error):
-        """Закрытие подключений при завершении контекста"""
-        if hasattr(g, 'db_connections'):
-            for conn in g.db_connections.values():
+        """Возврат подключений в пул при завершении контекста"""
+        connections = g.pop('db_connections', None)
+        if connections:
+            for pool, conn in connections.values():
                 if conn:
-                    conn.close()
+                    pool.release(conn)
+
+    def close_all(self):
+        """Закрыть все простаивающие соединения всех пулов"""
+        with self._pools_lock:
+            pools = list(self._pools.values())
+        for pool in pools:
+            pool.close_all()
 
 # Глобальный экземпляр менеджера БД
 db_manager = DatabaseManager()
@@ -0,0 +1,260 @@
+"""Журнал медленных SQL-запросов (monitoring.slow_queries).
+
+Запросы дольше порога (секция "slow_query" в config.json) ставятся в
+ограниченную очередь; фоновый поток снимает для них EXPLAIN FORMAT=JSON
+на отдельном соединении и пишет запись в monitoring. Параметры запросов
+в БД не сохраняются — только их форма (тип/длина, положение % в LIKE).
+"""
+
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import date, datetime
+from typing import Dict, List, Optional
+
+from app.models.database import db_manager
+from app.utils.metrics import current_endpoint, sql_fingerprint
+
+logger = logging.getLogger(__name__)
+
+SLOW_QUERY_DEFAULTS = {
+    'enabled': True,
+    'threshold_ms': 500,
+    'explain': True,
+    'explain_interval': 600,    # секунды: не чаще одного EXPLAIN на fingerprint
+    'queue_size': 1000,
+    'retention_days': 30,
+}
+
+EXPLAINABLE_PREFIXES = ('SELECT', 'WITH')
+
+
+def ensure_slow_query_tables():
+    """Create slow_queries table in 'monitoring' DB."""
+    with db_manager.get_connection('monitoring') as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS slow_queries (
+                  id BIGINT PRIMARY KEY AUTO_INCREMENT,
+                  created_at DATETIME NOT NULL,
+                  db_name VARCHAR(50) NOT NULL,
+                  endpoint VARCHAR(100) NOT NULL,
+                  fingerprint CHAR(12) NOT NULL,
+                  statement TEXT NOT NULL,
+                  params TEXT,
+                  duration_ms DECIMAL(12,3) NOT NULL,
+                  rows_count INT DEFAULT 0,
+                  explain_json MEDIUMTEXT,
+                  KEY idx_fingerprint_created (fingerprint, created_at),
+                  KEY idx_created (created_at)
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+                """
+            )
+
+
+def _redact_value(value):
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        return '<bool>'
+    if isinstance(value, (int, float)):
+        return '<num>'
+    if isinstance(value, (datetime, date)):
+        return '<datetime>'
+    if isinstance(value, (bytes, bytearray)):
+        return f'<bytes:{len(value)}>'
+    if isinstance(value, str):
+        # Сохраняем только форму LIKE-шаблона: '%<str:5>%' — видно ведущий wildcard
+        head = '%' if value.startswith('%') else ''
+        tail = '%' if len(value) > 1 and value.endswith('%') else ''
+        return f"'{head}<str:{len(value)}>{tail}'"
+    if isinstance(value, (list, tuple, set)):
+        return '(' + ', '.join(_redact_value(v) for v in value) + ')'
+    return f'<{type(value).__name__}>'
+
+
+def redact_params(args) -> Optional[str]:
+    """Описание параметров без их значений"""
+    if args is None:
+        return None
+    if isinstance(args, dict):
+        return '{' + ', '.join(f'{k}: {_redact_value(v)}' for k, v in args.items()) + '}'
+    if isinstance(args, (list, tuple)):
+        return '(' + ', '.join(_redact_value(v) for v in args) + ')'
+    return _redact_value(args)
+
+
+class SlowQueryRecorder:
+    """Очередь медленных запросов и фоновый поток записи в monitoring.slow_queries"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._explained_at = {}     # fingerprint -> monotonic время последнего EXPLAIN
+        self._last_cleanup = 0.0
+        self.dropped = 0
+
+    @staticmethod
+    def settings() -> Dict:
+        from app.config import Config
+        cfg = dict(SLOW_QUERY_DEFAULTS)
+        cfg.update(Config().SLOW_QUERY or {})
+        return cfg
+
+    def _ensure_worker(self, cfg):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            # После fork поток родителя в воркере не существует — запускаем свой
+            self._queue = queue.Queue(maxsize=int(cfg['queue_size']))
+            self._explained_at = {}
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='slow-query-writer', daemon=True)
+            self._thread.start()
+
+    def is_worker_thread(self) -> bool:
+        return self._thread is not None and threading.current_thread() is self._thread
+
+    def maybe_capture(self, db, query, args, duration, rows, many=False):
+        """Вызывается курсором после каждого запроса; дешёвый выход, если запрос быстрый"""
+        if self.is_worker_thread():
+            return   # собственные EXPLAIN/INSERT не журналируем
+        cfg = self.settings()
+        if not cfg.get('enabled') or duration * 1000.0 < float(cfg['threshold_ms']):
+            return
+        try:
+            self._ensure_worker(cfg)
+            if isinstance(query, bytes):
+                query = query.decode('utf-8', 'replace')
+            item = {
+                'created_at': datetime.now(),
+                'db': db or 'unknown',
+                'endpoint': current_endpoint(),
+                'query': query,
+                # значения нужны только для EXPLAIN и в БД не попадают
+                'args': None if many else args,
+                'params': (f'executemany x{len(args)}' if many and args is not None else redact_params(args)),
+                'duration_ms': round(duration * 1000.0, 3),
+                'rows': rows if rows and rows > 0 else 0,
+            }
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+        except Exception as e:
+            logger.debug(f"Не удалось поставить медленный запрос в очередь: {e}")
+
+    def _run(self):
+        try:
+            ensure_slow_query_tables()
+        except Exception as e:
+            logger.warning(f"slow_queries: не удалось создать таблицу: {e}")
+        while True:
+            item = self._queue.get()
+            try:
+                self._store(item)
+            except Exception as e:
+                logger.warning(f"slow_queries: ошибка записи: {e}")
+            self._cleanup()
+
+    def _explain(self, item, fingerprint, cfg) -> Optional[str]:
+        if not cfg.get('explain') or (item['args'] is None and '%s' in item['query']):
+            return None
+        if not item['query'].lstrip().upper().startswith(EXPLAINABLE_PREFIXES):
+            return None
+        now = time.monotonic()
+        last = self._explained_at.get(fingerprint)
+        if last is not None and now - last < float(cfg['explain_interval']):
+            return None
+        self._explained_at[fingerprint] = now
+        try:
+            with db_manager.get_connection(item['db']) as conn:
+                with conn.cursor() as cur:
+                    cur.execute('EXPLAIN FORMAT=JSON ' + item['query'], item['args'])
+                    row = cur.fetchone()
+                    return next(iter(row.values())) if row else None
+        except Exception as e:
+            logger.debug(f"slow_queries: EXPLAIN не выполнен: {e}")
+            return None
+
+    def _store(self, item):
+        cfg = self.settings()
+        fingerprint, statement = sql_fingerprint(item['query'])
+        explain_json = self._explain(item, fingerprint, cfg)
+        with db_manager.get_connection('monitoring') as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    INSERT INTO slow_queries
+                      (created_at, db_name, endpoint, fingerprint, statement, params, duration_ms, rows_count, explain_json)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                    """,
+                    (item['created_at'], item['db'][:50], item['endpoint'][:100], fingerprint,
+                     statement, item['params'], item['duration_ms'], item['rows'], explain_json),
+                )
+
+    def _cleanup(self):
+        now = time.monotonic()
+        if now - self._last_cleanup < 3600:
+            return
+        self._last_cleanup = now
+        try:
+            days = int(self.settings()['retention_days'])
+            with db_manager.get_connection('monitoring') as conn:
+                with conn.cursor() as cur:
+                    cur.execute("DELETE FROM slow_queries WHERE created_at < NOW() - INTERVAL %s DAY", (days,))
+        except Exception as e:
+            logger.debug(f"slow_queries: очистка не выполнена: {e}")
+
+
+recorder = SlowQueryRecorder()
+
+
+def top_fingerprints(days: int = 7, limit: int = 100) -> List[Dict]:
+    """Fingerprint'ы, отсортированные по суммарному времени за период"""
+    with db_manager.get_connection('monitoring') as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT fingerprint,
+                       MAX(db_name) AS db_name,
+                       GROUP_CONCAT(DISTINCT endpoint ORDER BY endpoint SEPARATOR ', ') AS endpoints,
+                       COUNT(*) AS calls,
+                       SUM(duration_ms) AS total_ms,
+                       AVG(duration_ms) AS avg_ms,
+                       MAX(duration_ms) AS max_ms,
+                       MAX(created_at) AS last_seen,
+                       MAX(statement) AS statement,
+                       MAX(explain_json IS NOT NULL) AS has_explain
+                FROM slow_queries
+                WHERE created_at >= NOW() - INTERVAL %s DAY
+                GROUP BY fingerprint
+                ORDER BY total_ms DESC
+                LIMIT %s
+                """,
+                (int(days), int(limit)),
+            )
+            return cur.fetchall()
+
+
+def fingerprint_samples(fingerprint: str, limit: int = 20) -> List[Dict]:
+    """Последние замеры одного fingerprint (с планом, если он снимался)"""
+    with db_manager.get_connection('monitoring') as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT created_at, db_name, endpoint, statement, params, duration_ms, rows_count, explain_json
+                FROM slow_queries
+                WHERE fingerprint = %s
+                ORDER BY created_at DESC
+                LIMIT %s
+                """,
+                (fingerprint, int(limit)),
+            )
+            return cur.fetchall()
@@ -0,0 +1,170 @@
+"""Снимок счётчиков дашбордов, обновляемый фоновым потоком.
+
+Главная страница, /api/status, статистика VPN/SMB и автообновление вкладок
+читают готовый снимок вместо того, чтобы пересчитывать одни и те же
+агрегаты на каждый запрос. Снимок обновляется раз в interval секунд
+(в каждом воркере gunicorn — свой поток); если поток не успел и снимок
+старше max_age, первый пришедший запрос обновляет его сам.
+"""
+
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+from flask import current_app, g, has_app_context
+
+from app.services import stats as stats_service
+from app.utils.fanout import run_sections
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_DEFAULTS = {
+    'interval': 30,     # секунды между фоновыми обновлениями
+    'max_age': 90,      # старше — обновляем синхронно в запросе
+    'idle_after': 300,  # без обращений дольше — фоновый поток не ходит в БД
+}
+
+# Значения до первого успешного обновления секции
+EMPTY_SNAPSHOT = {
+    'vpn': {
+        'active_sessions': 0, 'active_users': 0, 'users': [],
+        'sessions_today': 0, 'unique_users_today': 0, 'open_history': 0,
+    },
+    'mikrotik': {'devices': 0, 'if_addrs': 0},
+    'rdp': {'active_sessions': 0, 'active_users': 0, 'users': [], 'sessions_today': 0},
+    'smb': {
+        'active_sessions': 0, 'active_users': 0, 'active_short_users': 0, 'open_files': 0,
+        'modified_24h': 0, 'total_users': 0, 'total_files': 0, 'files': [],
+    },
+    'generated_at': None,
+}
+
+
+def _vpn_section():
+    active = stats_service.vpn_active_summary()
+    today = stats_service.vpn_today_summary()
+    return {
+        'active_sessions': active['sessions'],
+        'active_users': active['unique_users'],
+        'users': active['users'],
+        'sessions_today': today['sessions_today'],
+        'unique_users_today': today['unique_users_today'],
+        'open_history': stats_service.vpn_open_history_count(),
+    }
+
+
+def _rdp_section():
+    active = stats_service.rdp_active_summary()
+    return {
+        'active_sessions': active['sessions'],
+        'active_users': active['unique_users'],
+        'users': stats_service.rdp_active_users(),
+        'sessions_today': stats_service.rdp_today_count(),
+    }
+
+
+def _smb_section():
+    data = dict(stats_service.smb_active_summary())
+    data.update(stats_service.smb_totals())
+    data['modified_24h'] = stats_service.smb_modified_last_24h()
+    data['files'] = stats_service.smb_open_files()
+    return data
+
+
+SECTIONS = {
+    'vpn': _vpn_section,
+    'mikrotik': stats_service.mikrotik_map_summary,
+    'rdp': _rdp_section,
+    'smb': _smb_section,
+}
+
+
+class DashboardSnapshot:
+    """Процессный снимок счётчиков с фоновым обновлением"""
+
+    def __init__(self):
+        self._data = None
+        self._refreshed_at = 0.0
+        self._accessed_at = 0.0
+        self._app = None
+        self._thread = None
+        self._pid = None
+        self._refresh_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+
+    @staticmethod
+    def settings():
+        from app.config import Config
+        cfg = dict(SNAPSHOT_DEFAULTS)
+        cfg.update(Config().DASHBOARD_SNAPSHOT or {})
+        return cfg
+
+    def _ensure_thread(self, app):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            # После fork поток родителя в воркере не существует
+            self._pid = os.getpid()
+            self._app = app
+            self._refresh_lock = threading.Lock()
+            self._thread = threading.Thread(target=self._run, name='dashboard-snapshot', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            cfg = self.settings()
+            time.sleep(max(1.0, float(cfg['interval'])))
+            if time.monotonic() - self._accessed_at > float(cfg['idle_after']):
+                continue
+            try:
+                with self._refresh_lock:
+                    self._refresh(self._app)
+            except Exception as e:
+                logger.error(f"Ошибка фонового обновления снимка дашборда: {e}")
+
+    def _refresh(self, app):
+        with app.app_context():
+            # Счётчики только читаются — подходит реплика (см. DatabaseManager)
+            g.db_readonly = True
+            g.metrics_endpoint = 'dashboard_snapshot'
+            results, errors = run_sections(SECTIONS)
+        for name, error in errors.items():
+            logger.error(f"Снимок дашборда: секция {name} не обновлена: {error}")
+        # Неудавшиеся секции сохраняют прежние значения
+        data = dict(self._data or EMPTY_SNAPSHOT)
+        data.update(results)
+        data['generated_at'] = datetime.now()
+        self._data = data
+        self._refreshed_at = time.monotonic()
+
+    def get(self):
+        """Текущий снимок: {'vpn': {...}, 'mikrotik': {...}, 'rdp': {...}, 'smb': {...}, 'generated_at': datetime}"""
+        app = current_app._get_current_object() if has_app_context() else self._app
+        if app is None:
+            return dict(EMPTY_SNAPSHOT)
+        self._ensure_thread(app)
+        self._accessed_at = time.monotonic()
+
+        data = self._data
+        max_age = float(self.settings()['max_age'])
+        if data is not None and time.monotonic() - self._refreshed_at <= max_age:
+            return data
+        if data is not None:
+            # Устаревший снимок: обновляет один запрос, остальные пока получают прежний
+            if not self._refresh_lock.acquire(blocking=False):
+                return data
+        else:
+            self._refresh_lock.acquire()
+        try:
+            if self._data is None or time.monotonic() - self._refreshed_at > max_age:
+                self._refresh(app)
+        finally:
+            self._refresh_lock.release()
+        return self._data or dict(EMPTY_SNAPSHOT)
+
+
+dashboard_snapshot = DashboardSnapshot()
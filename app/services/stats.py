@@ -0,0 +1,255 @@
+"""Агрегаты для дашбордов и API (общие для маршрутов и /api/status).
+
+Функции возвращают готовые числа: подсчёты выполняются в SQL
+(COUNT / COUNT(DISTINCT)), списки сессий не материализуются.
+"""
+
+import logging
+
+from app.models.database import db_manager
+from app.utils.mikrotik_map import get_mikrotik_map
+
+logger = logging.getLogger(__name__)
+
+# Начало текущих суток в виде диапазона — позволяет использовать индекс по времени
+TODAY_RANGE = "{col} >= CURDATE() AND {col} < CURDATE() + INTERVAL 1 DAY"
+
+
+# === VPN ===
+
+def vpn_active_summary(user_limit=10):
+    """Активные VPN-сессии из файла состояния ike2mon: сессий, уникальных пользователей
+    и первые user_limit имён по алфавиту"""
+    from app.blueprints.vpn import read_active_vpn_sessions
+    sessions = read_active_vpn_sessions() or []
+    users = sorted({(s.get('username') or '').strip() for s in sessions if s.get('username')})
+    return {'sessions': len(sessions), 'unique_users': len(users), 'users': users[:user_limit]}
+
+
+def vpn_today_summary():
+    """VPN-сессии, начатые сегодня, и уникальные пользователи среди них (сводка по дням)"""
+    with db_manager.get_connection('vpn') as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT COALESCE(SUM(sessions), 0) AS sessions_today,
+                       COUNT(*) AS unique_users_today
+                FROM vpn_daily_user_stats
+                WHERE day = CURDATE()
+            """)
+            row = cursor.fetchone() or {}
+    return {
+        'sessions_today': int(row.get('sessions_today') or 0),
+        'unique_users_today': row.get('unique_users_today') or 0,
+    }
+
+
+# Статистика VPN читается из сводных таблиц vpn_daily_user_stats / vpn_hourly_stats,
+# которые ike2mon ведёт при записи session_history (учтены закрытые сессии по дню начала).
+
+def vpn_daily_stats(days=30):
+    """По дням за последние days дней: сессии и уникальные пользователи, новые сверху"""
+    with db_manager.get_connection('vpn') as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT day AS date,
+                       SUM(sessions) AS sessions,
+                       COUNT(*) AS users
+                FROM vpn_daily_user_stats
+                WHERE day >= CURDATE() - INTERVAL %s DAY
+                GROUP BY day
+                ORDER BY day DESC
+            """, (int(days),))
+            rows = cursor.fetchall() or []
+    for row in rows:
+        row['sessions'] = int(row['sessions'] or 0)
+    return rows
+
+
+def vpn_user_totals(days=30, limit=None):
+    """Итоги по пользователям за последние days дней, по убыванию числа сессий:
+    сессии, средняя/суммарная/максимальная длительность (сек), последний вход"""
+    sql = """
+        SELECT username,
+               SUM(sessions) AS sessions,
+               SUM(total_duration) / SUM(sessions) AS avg_duration,
+               SUM(total_duration) AS total_duration,
+               MAX(max_duration) AS max_duration,
+               MAX(last_login) AS last_login
+        FROM vpn_daily_user_stats
+        WHERE day >= CURDATE() - INTERVAL %s DAY
+        GROUP BY username
+        ORDER BY sessions DESC
+    """
+    args = [int(days)]
+    if limit:
+        sql += " LIMIT %s"
+        args.append(int(limit))
+    with db_manager.get_connection('vpn') as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(sql, args)
+            rows = cursor.fetchall() or []
+    for row in rows:
+        row['sessions'] = int(row['sessions'] or 0)
+        row['total_duration'] = int(row['total_duration'] or 0)
+    return rows
+
+
+def vpn_hourly_stats(days=7):
+    """Сессии по часу начала за последние days дней"""
+    with db_manager.get_connection('vpn') as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT hour,
+                       SUM(sessions) AS sessions
+                FROM vpn_hourly_stats
+                WHERE day >= CURDATE() - INTERVAL %s DAY
+                GROUP BY hour
+                ORDER BY hour
+            """, (int(days),))
+            rows = cursor.fetchall() or []
+    for row in rows:
+        row['sessions'] = int(row['sessions'] or 0)
+    return rows
+
+
+def vpn_open_history_count():
+    """Записи истории без time_end (сессия ещё не закрыта коллектором)"""
+    with db_manager.get_connection('vpn') as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) AS active FROM session_history WHERE time_end IS NULL")
+            row = cursor.fetchone() or {}
+    return row.get('active') or 0
+
+
+def mikrotik_map_summary():
+    """Карта MikroTik: число устройств и адресов интерфейсов"""
+    mmap = get_mikrotik_map()
+    return {
+        'devices': mmap.device_count,
+        'if_addrs': mmap.address_count,
+    }
+
+
+def mikrotik_device_count():
+    """Число устройств MikroTik в карте адресов"""
+    return mikrotik_map_summary()['devices']
+
+
+# === RDP ===
+
+def rdp_active_summary():
+    """Активные RDP-сессии и уникальные пользователи"""
+    with db_manager.get_connection('rdp') as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT COUNT(*) AS sessions,
+                       COUNT(DISTINCT username) AS unique_users
+                FROM rdp_active_sessions
+            """)
+            row = cursor.fetchone() or {}
+    return {'sessions': row.get('sessions') or 0, 'unique_users': row.get('unique_users') or 0}
+
+
+def rdp_today_count():
+    """RDP-входы за сегодня"""
+    with db_manager.get_connection('rdp') as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f"""
+                SELECT COUNT(*) AS count
+                FROM rdp_session_history
+                WHERE {TODAY_RANGE.format(col='login_time')}
+            """)
+            row = cursor.fetchone() or {}
+    return row.get('count') or 0
+
+
+def rdp_active_users(limit=10):
+    """Первые limit пользователей с активными RDP-сессиями (с коллекцией)"""
+    with db_manager.get_connection('rdp') as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT username, MIN(collection_name) AS collection_name
+                FROM rdp_active_sessions
+                WHERE username IS NOT NULL AND username <> ''
+                GROUP BY username
+                ORDER BY username ASC
+                LIMIT %s
+            """, (int(limit),))
+            return [{'username': r['username'].strip(), 'collection_name': r.get('collection_name')}
+                    for r in cursor.fetchall() or []]
+
+
+# === SMB ===
+
+def smb_active_summary():
+    """Активные SMB-сессии: сессии, пользователи (в т.ч. без домена) и открытые файлы"""
+    with db_manager.get_connection('smb') as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT COUNT(*) AS active_sessions,
+                       COUNT(DISTINCT s.user_id) AS active_users,
+                       COUNT(DISTINCT s.file_id) AS open_files,
+                       COUNT(DISTINCT SUBSTRING_INDEX(u.username, '\\\\', -1)) AS active_short_users
+                FROM active_smb_sessions s
+                LEFT JOIN smb_users u ON s.user_id = u.id
+            """)
+            row = cursor.fetchone() or {}
+    return {
+        'active_sessions': row.get('active_sessions') or 0,
+        'active_users': row.get('active_users') or 0,
+        'open_files': row.get('open_files') or 0,
+        'active_short_users': row.get('active_short_users') or 0,
+    }
+
+
+def smb_totals():
+    """Всего известных пользователей и файлов SMB"""
+    with db_manager.get_connection('smb') as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT (SELECT COUNT(*) FROM smb_users) AS total_users,
+                       (SELECT COUNT(*) FROM smb_files) AS total_files
+            """)
+            row = cursor.fetchone() or {}
+    return {'total_users': row.get('total_users') or 0, 'total_files': row.get('total_files') or 0}
+
+
+def smb_modified_last_24h():
+    """Файлы, изменённые (размер при закрытии отличается) за последние 24 часа"""
+    with db_manager.get_connection('smb') as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT COUNT(DISTINCT file_id) AS total
+                FROM smb_session_history
+                WHERE open_time >= DATE_SUB(NOW(), INTERVAL 24 HOUR)
+                  AND final_size != initial_size
+            """)
+            row = cursor.fetchone() or {}
+    return row.get('total') or 0
+
+
+def _display_file_name(path):
+    """Имя файла для показа: двойные подчёркивания — разделители, регистр приводим"""
+    display = (path or '').replace('__', '\\').replace('/', '\\').split('\\')[-1]
+    # первая буква заглавная, остальное маленькое; расширение нижним регистром
+    base, ext = (display.rsplit('.', 1) + [''])[:2]
+    base = (base.strip().lower().capitalize()) if base else ''
+    ext = ('.' + ext.lower()) if ext else ''
+    return base + ext
+
+
+def smb_open_files(limit=10):
+    """Текущие открытые файлы (имя для показа + полный путь)"""
+    with db_manager.get_connection('smb') as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT f.id, f.path
+                FROM active_smb_sessions s
+                LEFT JOIN smb_files f ON s.file_id = f.id
+                WHERE f.id IS NOT NULL
+                ORDER BY f.path
+                LIMIT %s
+            """, (int(limit),))
+            rows = cursor.fetchall() or []
+    return [{'id': r['id'], 'name': _display_file_name(r.get('path')), 'full_path': r.get('path') or ''}
+            for r in rows]
@@ -1,50 +1,69 @@
 """Утилиты для получения информации о базах данных"""
 
 from app.models.database import db_manager
+from app.utils.fanout import run_sections
 import logging
+import threading
+import time
 from datetime import datetime
 
 logger = logging.getLogger(__name__)
 
+# Самая ранняя запись в каждой БД: (тип БД, запрос)
+EARLIEST_QUERIES = {
+    'vpn': "SELECT MIN(login_time) as earliest FROM session_history WHERE login_time IS NOT NULL",
+    'rdp': "SELECT MIN(login_time) as earliest FROM rdp_session_history WHERE login_time IS NOT NULL",
+    'smb': "SELECT MIN(open_time) as earliest FROM smb_session_history WHERE open_time IS NOT NULL",
+}
+
+
+def _earliest_date(db_type):
+    with db_manager.get_connection(db_type) as conn:
+        with conn.cursor() as cur:
+            cur.execute(EARLIEST_QUERIES[db_type])
+            result = cur.fetchone()
+            return result['earliest'] if result else None
+
+
+# Дата начала меняется только при чистке истории — держим её долго
+START_DATE_TTL = 6 * 3600
+# Если ни одна БД не ответила — повторяем раньше
+START_DATE_RETRY_TTL = 60
+
+_start_date_cache = {'value': None, 'expires': 0.0}
+_start_date_lock = threading.Lock()
+
+
 def get_db_start_date():
+    """Дата начала наполнения БД (ДД.ММ.ГГГГ), кэшируется на процесс на START_DATE_TTL"""
+    now = time.monotonic()
+    if now < _start_date_cache['expires']:
+        return _start_date_cache['value']
+    with _start_date_lock:
+        if time.monotonic() < _start_date_cache['expires']:
+            return _start_date_cache['value']
+        value = _query_db_start_date()
+        ttl = START_DATE_TTL if value else START_DATE_RETRY_TTL
+        _start_date_cache['value'] = value
+        _start_date_cache['expires'] = time.monotonic() + ttl
+        return value
+
+
+def _query_db_start_date():
     """Получает дату начала наполнения БД (самая ранняя запись)"""
+    # Три независимых MIN() по разным БД — параллельно
+    results, errors = run_sections({
+        db_type: (lambda db_type=db_type: _earliest_date(db_type))
+        for db_type in EARLIEST_QUERIES
+    })
+    for db_type, error in errors.items():
+        logger.debug(f"Could not get {db_type.upper()} earliest date: {error}")
+
     earliest_dates = []
-    
-    # VPN БД
-    try:
-        with db_manager.get_connection('vpn') as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT MIN(login_time) as earliest FROM session_history WHERE login_time IS NOT NULL")
-                result = cur.fetchone()
-                if result and result['earliest']:
-                    earliest_dates.append(result['earliest'])
-                    logger.debug(f"VPN earliest date: {result['earliest']}")
-    except Exception as e:
-        logger.debug(f"Could not get VPN earliest date: {e}")
-    
-    # RDP БД
-    try:
-        with db_manager.get_connection('rdp') as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT MIN(login_time) as earliest FROM rdp_session_history WHERE login_time IS NOT NULL")
-                result = cur.fetchone()
-                if result and result['earliest']:
-                    earliest_dates.append(result['earliest'])
-                    logger.debug(f"RDP earliest date: {result['earliest']}")
-    except Exception as e:
-        logger.debug(f"Could not get RDP earliest date: {e}")
-    
-    # SMB БД
-    try:
-        with db_manager.get_connection('smb') as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT MIN(open_time) as earliest FROM smb_session_history WHERE open_time IS NOT NULL")
-                result = cur.fetchone()
-                if result and result['earliest']:
-                    earliest_dates.append(result['earliest'])
-                    logger.debug(f"SMB earliest date: {result['earliest']}")
-    except Exception as e:
-        logger.debug(f"Could not get SMB earliest date: {e}")
+    for db_type, earliest in results.items():
+        if earliest:
+            earliest_dates.append(earliest)
+            logger.debug(f"{db_type.upper()} earliest date: {earliest}")
     
     # Находим самую раннюю дату
     if earliest_dates:
@@ -0,0 +1,101 @@
+"""Параллельное выполнение независимых секций дашборда.
+
+Каждая секция выполняется в общем пуле потоков в собственном контексте
+приложения (свои соединения из пула БД, возвращаются по завершении секции).
+Результаты частичные: секция, упавшая или не уложившаяся в таймаут,
+просто отсутствует в результатах, а причина попадает в errors.
+"""
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+from flask import current_app, g, has_app_context
+
+from app.utils.metrics import current_endpoint
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 5.0
+MAX_WORKERS = 8
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+_local = threading.local()
+
+
+def _get_executor():
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        with _executor_lock:
+            if _executor is None or _executor_pid != os.getpid():
+                # После fork потоки пула родителя в воркере не существуют
+                _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='fanout')
+                _executor_pid = os.getpid()
+    return _executor
+
+
+def _run_inline(sections):
+    results, errors = {}, {}
+    for name, spec in sections.items():
+        func = spec[0] if isinstance(spec, tuple) else spec
+        try:
+            results[name] = func()
+        except Exception as e:
+            errors[name] = str(e)
+    return results, errors
+
+
+def run_sections(sections, timeout=DEFAULT_TIMEOUT):
+    """Выполняет секции параллельно.
+
+    Args:
+        sections: {имя: callable} или {имя: (callable, таймаут_секции)}
+        timeout: таймаут по умолчанию для секций, секунды
+
+    Returns:
+        (results, errors): результаты успевших секций и {имя: причина} для остальных
+    """
+    # Вложенный вызов из секции выполняем последовательно: ожидание на том же
+    # пуле могло бы занять все его потоки
+    if getattr(_local, 'active', False) or not has_app_context():
+        return _run_inline(sections)
+
+    app = current_app._get_current_object()
+    readonly = g.get('db_readonly')
+    endpoint = current_endpoint()
+
+    def wrap(func):
+        def task():
+            _local.active = True
+            try:
+                with app.app_context():
+                    g.db_readonly = readonly
+                    g.metrics_endpoint = endpoint
+                    return func()
+            finally:
+                _local.active = False
+        return task
+
+    executor = _get_executor()
+    started = time.monotonic()
+    futures = {}
+    for name, spec in sections.items():
+        func, section_timeout = spec if isinstance(spec, tuple) else (spec, timeout)
+        futures[name] = (executor.submit(wrap(func)), section_timeout)
+
+    results, errors = {}, {}
+    for name, (future, section_timeout) in futures.items():
+        remaining = max(0.0, started + section_timeout - time.monotonic())
+        try:
+            results[name] = future.result(timeout=remaining)
+        except FutureTimeout:
+            errors[name] = f'timeout {section_timeout:g}s'
+            logger.warning(f"Секция {name} ({endpoint}) не уложилась в {section_timeout:g} с")
+        except Exception as e:
+            errors[name] = str(e)
+            logger.error(f"Секция {name} ({endpoint}) завершилась ошибкой: {e}")
+    return results, errors
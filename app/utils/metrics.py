@@ -0,0 +1,409 @@
+"""Метрики (гистограммы/счётчики) в текстовом формате Prometheus.
+
+Метрики копятся в памяти процесса, но отдаются суммой по всем воркерам gunicorn:
+каждый воркер раз в DUMP_INTERVAL секунд (и при ответе на /api/metrics) сбрасывает
+свои значения в файл <pid>.json каталога METRICS_DIR, а /api/metrics складывает
+все файлы. Файлы завершившихся воркеров переносятся в archive.json, поэтому
+счётчики не откатываются при перезапуске воркера и rate() по ним корректен.
+"""
+
+import atexit
+import fcntl
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from functools import lru_cache
+
+from flask import g, has_app_context, has_request_context, request
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Ограничение кардинальности: запросы из AI-модуля произвольные
+MAX_FINGERPRINTS = 500
+
+# Общий каталог значений воркеров (см. докстринг модуля)
+METRICS_DIR = os.environ.get('MONITORING_METRICS_DIR') or os.path.join(tempfile.gettempdir(), 'monitoring-web-metrics')
+DUMP_INTERVAL = 5.0
+
+logger = logging.getLogger(__name__)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(v):
+    if isinstance(v, float):
+        if v == float('inf'):
+            return '+Inf'
+        return repr(v)
+    return str(v)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    @staticmethod
+    def serialize(values):
+        return [[list(labels), value] for labels, value in values.items()]
+
+    def snapshot(self):
+        with self._lock:
+            return self.serialize(self._values)
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    @staticmethod
+    def merge(acc, series):
+        for labels, value in series:
+            labels = tuple(labels)
+            acc[labels] = acc.get(labels, 0) + value
+
+    def render(self, values=None):
+        if values is None:
+            with self._lock:
+                values = dict(self._values)
+        items = sorted(values.items())
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for labels, value in items:
+            lines.append(f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}')
+        return lines
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, labels=(), value=1):
+        with self._lock:
+            self._values[labels] = value
+
+    @staticmethod
+    def merge(acc, series):
+        for labels, value in series:
+            labels = tuple(labels)
+            acc[labels] = max(acc.get(labels, value), value)
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._series = {}   # labels -> [bucket_counts, sum, count]
+
+    def observe(self, labels, value):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            counts = series[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    @staticmethod
+    def serialize(values):
+        return [[list(labels), list(v[0]), v[1], v[2]] for labels, v in values.items()]
+
+    def snapshot(self):
+        with self._lock:
+            return self.serialize(self._series)
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+    def merge(self, acc, series):
+        for labels, counts, total, count in series:
+            if len(counts) != len(self.buckets):
+                continue  # файл от версии с другими границами
+            labels = tuple(labels)
+            cur = acc.get(labels)
+            if cur is None:
+                acc[labels] = [list(counts), total, count]
+            else:
+                cur[0] = [a + b for a, b in zip(cur[0], counts)]
+                cur[1] += total
+                cur[2] += count
+
+    def render(self, values=None):
+        if values is None:
+            with self._lock:
+                values = {k: [list(v[0]), v[1], v[2]] for k, v in self._series.items()}
+        items = sorted(values.items())
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, c in zip(self.buckets, counts):
+                cumulative += c
+                le = 'le="%s"' % _format_value(float(bound))
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}')
+            inf = 'le="+Inf"'
+            lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, labels, inf)} {count}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, labels)} {count}')
+        return lines
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _write_json(path, data):
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+class Registry:
+    def __init__(self, directory=METRICS_DIR):
+        self._metrics = []
+        self.directory = directory
+        self._pid = os.getpid()
+        self._dumper_pid = None
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def snapshot(self):
+        return {m.name: m.snapshot() for m in self._metrics}
+
+    def _check_fork(self):
+        """Воркер после fork получает копию значений мастера (preload_app) — они уже
+        учтены в файле мастера, в воркере счёт начинается с нуля"""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            for metric in self._metrics:
+                metric.reset()
+            with _fingerprints_lock:
+                _known_fingerprints.clear()
+            sql_fingerprint.cache_clear()
+
+    def dump(self):
+        """Значения этого процесса -> <pid>.json (атомарная подмена)"""
+        self._check_fork()
+        os.makedirs(self.directory, exist_ok=True)
+        _write_json(os.path.join(self.directory, f'{os.getpid()}.json'), self.snapshot())
+
+    def start_dumper(self):
+        """Фоновый сброс значений процесса; после fork поток запускается заново"""
+        if self._dumper_pid == os.getpid():
+            return
+        self._check_fork()
+        self._dumper_pid = os.getpid()
+        threading.Thread(target=self._dump_loop, name='metrics-dump', daemon=True).start()
+        atexit.register(self._dump_quietly)
+
+    def _dump_loop(self):
+        while True:
+            time.sleep(DUMP_INTERVAL)
+            self._dump_quietly()
+
+    def _dump_quietly(self):
+        try:
+            self.dump()
+        except Exception as e:
+            logger.warning(f"Метрики не сброшены в {self.directory}: {e}")
+
+    def _collect(self):
+        """Сумма значений всех воркеров; файлы завершившихся переносит в archive.json"""
+        self.dump()
+        with open(os.path.join(self.directory, '.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            archive_path = os.path.join(self.directory, 'archive.json')
+            files = [archive_path] if os.path.exists(archive_path) else []
+            dead = []
+            for path in glob.glob(os.path.join(self.directory, '[0-9]*.json')):
+                pid = int(os.path.basename(path)[:-5])
+                files.append(path)
+                if not _pid_alive(pid):
+                    dead.append(path)
+            merged = {m.name: {} for m in self._metrics}
+            archived = {m.name: {} for m in self._metrics}
+            for path in files:
+                try:
+                    with open(path) as f:
+                        data = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                for metric in self._metrics:
+                    series = data.get(metric.name, ())
+                    metric.merge(merged[metric.name], series)
+                    if path == archive_path or path in dead:
+                        metric.merge(archived[metric.name], series)
+            if dead:
+                _write_json(archive_path, {m.name: m.serialize(archived[m.name]) for m in self._metrics})
+                for path in dead:
+                    os.unlink(path)
+        return merged
+
+    def render(self):
+        try:
+            merged = self._collect()
+        except Exception as e:
+            # Каталог недоступен — отдаём хотя бы значения этого воркера
+            logger.warning(f"Метрики воркеров не собраны из {self.directory}: {e}")
+            merged = {m.name: None for m in self._metrics}
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render(merged[metric.name]))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+DB_QUERY_SECONDS = registry.register(Histogram(
+    'monitoring_db_query_duration_seconds',
+    'Время выполнения SQL-запроса',
+    ('db', 'endpoint', 'fingerprint'),
+))
+DB_QUERY_ROWS = registry.register(Counter(
+    'monitoring_db_query_rows_total',
+    'Строк возвращено/затронуто SQL-запросами',
+    ('db', 'endpoint', 'fingerprint'),
+))
+DB_QUERY_ERRORS = registry.register(Counter(
+    'monitoring_db_query_errors_total',
+    'SQL-запросы, завершившиеся ошибкой',
+    ('db', 'endpoint', 'fingerprint'),
+))
+DB_QUERY_INFO = registry.register(Gauge(
+    'monitoring_db_query_fingerprint_info',
+    'Нормализованный текст SQL для fingerprint',
+    ('fingerprint', 'statement'),
+))
+HTTP_REQUEST_SECONDS = registry.register(Histogram(
+    'monitoring_http_request_duration_seconds',
+    'Время обработки HTTP-запроса по маршруту',
+    ('endpoint', 'method', 'status'),
+))
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=registry._check_fork)
+
+
+_RE_COMMENT = re.compile(r'/\*.*?\*/|--[^\n]*|#[^\n]*', re.S)
+_RE_STRING = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.)*\"")
+_RE_PLACEHOLDER = re.compile(r'%\(\w+\)s|%s')
+_RE_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_RE_IN_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_RE_WS = re.compile(r'\s+')
+
+_fingerprints_lock = threading.Lock()
+_known_fingerprints = set()
+
+
+def normalize_sql(sql):
+    """Приводит SQL к шаблону: литералы и плейсхолдеры -> ?, списки IN (...) -> (?+), пробелы схлопнуты"""
+    s = _RE_COMMENT.sub(' ', sql)
+    s = _RE_STRING.sub('?', s)
+    s = _RE_PLACEHOLDER.sub('?', s)
+    s = _RE_NUMBER.sub('?', s)
+    s = _RE_IN_LIST.sub('(?+)', s)
+    return _RE_WS.sub(' ', s).strip()
+
+
+@lru_cache(maxsize=2048)
+def sql_fingerprint(sql):
+    """(fingerprint, нормализованный SQL) для текста запроса"""
+    if isinstance(sql, bytes):
+        sql = sql.decode('utf-8', 'replace')
+    normalized = normalize_sql(sql)
+    fp = hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:12]
+    with _fingerprints_lock:
+        if fp not in _known_fingerprints:
+            if len(_known_fingerprints) >= MAX_FINGERPRINTS:
+                return 'other', normalized
+            _known_fingerprints.add(fp)
+            DB_QUERY_INFO.set((fp, normalized[:300]), 1)
+    return fp, normalized
+
+
+def current_endpoint():
+    """Имя маршрута, от имени которого выполняется код (для фоновых потоков — из g)"""
+    if has_request_context():
+        return request.endpoint or 'unknown'
+    if has_app_context():
+        return g.get('metrics_endpoint') or 'background'
+    return 'background'
+
+
+def record_query(db, sql, duration, rows, error=False):
+    fp, _ = sql_fingerprint(sql)
+    labels = (db or 'unknown', current_endpoint(), fp)
+    DB_QUERY_SECONDS.observe(labels, duration)
+    if rows and rows > 0:
+        DB_QUERY_ROWS.inc(labels, rows)
+    if error:
+        DB_QUERY_ERRORS.inc(labels)
+
+
+def init_metrics(app):
+    """Подключает замер времени обработки каждого маршрута"""
+
+    @app.before_request
+    def _metrics_start():
+        registry.start_dumper()
+        g._metrics_started = time.perf_counter()
+
+    @app.after_request
+    def _metrics_observe(response):
+        started = g.pop('_metrics_started', None)
+        if started is not None:
+            HTTP_REQUEST_SECONDS.observe(
+                (request.endpoint or 'unknown', request.method, str(response.status_code)),
+                time.perf_counter() - started,
+            )
+        return response
+
+    @app.teardown_request
+    def _metrics_teardown(error):
+        # after_request не вызывается при необработанном исключении
+        started = g.pop('_metrics_started', None)
+        if started is not None:
+            HTTP_REQUEST_SECONDS.observe(
+                (request.endpoint or 'unknown', request.method, '500'),
+                time.perf_counter() - started,
+            )
@@ -0,0 +1,278 @@
+"""Кэш карты MikroTik (full_map.csv) в процессе воркера.
+
+Файл ищется по кандидатам один раз; дальше каждое обращение делает один
+os.stat и, если (mtime, размер) не изменились, отдаёт уже разобранные строки
+вместе с готовыми группировками (по устройству, интерфейсы, счётчики,
+индекс сетей). Разобранная карта дополнительно сохраняется рядом с CSV
+в <карта>.cache.json: другие воркеры и перезапуски берут её без разбора CSV,
+пока подпись исходного файла совпадает. Снимок — только JSON (не pickle): каталог
+карты пишут скрипты обнаружения, и подложенный файл не должен исполнять код.
+
+Строки и группировки общие для всех запросов процесса — их нельзя изменять.
+"""
+
+import csv
+import ipaddress
+import logging
+import json
+import os
+import threading
+
+from flask import current_app, has_app_context
+
+from app.utils.netindex import PrefixIndex
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAP_PATHS = (
+    '/opt/monitoring-web/data/full_map.csv',
+    '/opt/ike2web/data/full_map.csv',
+)
+SIDECAR_SUFFIX = '.cache.json'
+SIDECAR_VERSION = 2
+
+TYPE_NAMES = {'D': 'Dynamic', 'I': 'Internal'}
+
+
+def _split_cidr(ip, mask):
+    if not mask and '/' in ip:
+        ip, mask = ip.split('/', 1)
+    return ip, mask
+
+
+def parse_map_file(path):
+    """Разбор CSV карты.
+
+    Returns:
+        (rows, records): rows — строки для страниц {'identity', 'ip', 'iface', 'type'},
+        records — исходные поля (identity, ip, mask, iface, flag)
+    """
+    rows, records = [], []
+    with open(path, 'r', encoding='utf-8') as f:
+        peek = f.readline()
+        f.seek(0)
+        lower = peek.lower()
+        header_like = any(k in lower for k in ['identity', 'ip', 'iface', 'interface', 'type', 'mask'])
+        if header_like:
+            for row in csv.DictReader(f):
+                identity = (row.get('identity') or row.get('Identity') or '').strip()
+                ip = (row.get('ip') or row.get('address') or '').strip()
+                iface = (row.get('iface') or row.get('interface') or row.get('location') or '').strip()
+                flag = (row.get('type') or row.get('flag') or '').strip()
+                rtype = TYPE_NAMES.get(flag, flag)
+                rows.append({'identity': identity, 'ip': ip, 'iface': iface, 'type': rtype})
+                addr, mask = _split_cidr(ip, (row.get('mask') or '').strip())
+                records.append((identity, addr, mask, iface, flag))
+        else:
+            for row in csv.reader(f):
+                if not row:
+                    continue
+                # Ожидаемый порядок: identity, ip, mask, iface, flag(optional)
+                identity = row[0].strip() if len(row) > 0 else ''
+                ip = row[1].strip() if len(row) > 1 else ''
+                mask = row[2].strip() if len(row) > 2 else ''
+                iface = row[3].strip() if len(row) > 3 else ''
+                flag = row[4].strip() if len(row) > 4 else ''
+                rtype = TYPE_NAMES.get(flag, flag or '-')
+                ip_show = f"{ip}/{mask}" if mask else ip
+                rows.append({'identity': identity, 'ip': ip_show, 'iface': iface, 'type': rtype})
+                records.append((identity, ip, mask, iface, flag))
+    return rows, records
+
+
+def group_by_identity(rows):
+    """[{'identity': имя, 'rows': [...]}] по имени без учёта регистра, строки по (iface, ip)"""
+    groups = {}
+    for r in rows:
+        groups.setdefault((r.get('identity') or '').strip() or '-', []).append(r)
+    return [
+        {'identity': name, 'rows': sorted(groups[name], key=lambda t: (t.get('iface') or '', t.get('ip') or ''))}
+        for name in sorted(groups, key=lambda x: x.lower())
+    ]
+
+
+def map_counts(rows):
+    """Число адресов, устройств и пар (устройство, интерфейс)"""
+    return {
+        'address_count': len(rows),
+        'device_count': len({r.get('identity') for r in rows if r.get('identity')}),
+        'interface_count': len({(r.get('identity'), r.get('iface')) for r in rows
+                                if r.get('identity') and r.get('iface')}),
+    }
+
+
+class MikrotikMap:
+    """Разобранная карта и производные от неё структуры"""
+
+    def __init__(self, path=None, signature=None, rows=(), records=()):
+        self.path = path
+        self.signature = signature
+        self.rows = list(rows)
+        self.records = list(records)
+        self.groups = group_by_identity(self.rows)
+        counts = map_counts(self.rows)
+        self.address_count = counts['address_count']
+        self.device_count = counts['device_count']
+        self.interface_count = counts['interface_count']
+        self.devices = self._build_devices()
+        self._prefix_index = None
+        self._index_lock = threading.Lock()
+
+    def _build_devices(self):
+        devices = {}
+        for row in self.rows:
+            identity = row.get('identity', '')
+            if not identity:
+                continue
+            entry = devices.get(identity)
+            if entry is None:
+                entry = devices[identity] = {'identity': identity, 'interfaces': [], 'total_addresses': 0}
+            entry['interfaces'].append({
+                'ip': row.get('ip', ''),
+                'iface': row.get('iface', ''),
+                'type': row.get('type', ''),
+            })
+            entry['total_addresses'] += 1
+        return list(devices.values())
+
+    def networks(self):
+        """Список (identity, ip_network) по адресам интерфейсов"""
+        nets = []
+        for r in self.rows:
+            cidr = (r.get('ip') or '').strip()
+            identity = (r.get('identity') or '').strip()
+            if not cidr or '/' not in cidr or not identity:
+                continue
+            try:
+                nets.append((identity, ipaddress.ip_network(cidr, strict=False)))
+            except ValueError:
+                continue
+        return nets
+
+    @property
+    def prefix_index(self):
+        """PrefixIndex identity по сетям интерфейсов (строится при первом обращении)"""
+        if self._prefix_index is None:
+            with self._index_lock:
+                if self._prefix_index is None:
+                    self._prefix_index = PrefixIndex(self.networks())
+        return self._prefix_index
+
+
+EMPTY_MAP = MikrotikMap()
+
+_cache = {}             # путь -> MikrotikMap
+_cache_lock = threading.Lock()
+_resolved = {'candidates': None, 'path': None}
+
+
+def _candidate_paths():
+    paths = []
+    if has_app_context():
+        cfg = current_app.config
+        try:
+            # 1) Боевой конфиг shares_f_map.mikrotik_map
+            v = (cfg.get('SHARES_F_MAP') or {}).get('mikrotik_map')
+            if v:
+                paths.append(str(v))
+        except Exception:
+            pass
+        try:
+            # 2) Конфиг путей из config.Config
+            v = (cfg.get('PATHS') or {}).get('mikrotik_map')
+            if v:
+                paths.append(str(v))
+        except Exception:
+            pass
+        # 3) Явный ключ окружения/конфига
+        v = cfg.get('MIKROTIK_MAP_FILE')
+        if v:
+            paths.append(str(v))
+    paths.extend(DEFAULT_MAP_PATHS)
+    return tuple(paths)
+
+
+def resolve_map_path():
+    """Путь к карте: первый существующий из кандидатов (или None).
+    Выбранный путь запоминается, пока файл существует и список кандидатов тот же.
+    """
+    candidates = _candidate_paths()
+    path = _resolved['path']
+    if path and _resolved['candidates'] == candidates and os.path.exists(path):
+        return path
+    path = next((p for p in candidates if p and os.path.exists(p)), None)
+    if not path and (_resolved['candidates'] != candidates or _resolved['path']):
+        logger.error("MikroTik map file not found in: %s", list(candidates))
+    _resolved['candidates'] = candidates
+    _resolved['path'] = path
+    return path
+
+
+def _sidecar_path(path):
+    return path + SIDECAR_SUFFIX
+
+
+def _load_sidecar(path, signature):
+    try:
+        with open(_sidecar_path(path), 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('version') == SIDECAR_VERSION and tuple(data.get('signature') or ()) == signature[1:]:
+            return data['rows'], [tuple(r) for r in data['records']]
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.debug(f"MikroTik map: снимок {_sidecar_path(path)} не прочитан: {e}")
+    return None
+
+
+def _write_sidecar(path, signature, rows, records):
+    target = _sidecar_path(path)
+    tmp = f"{target}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'version': SIDECAR_VERSION, 'signature': signature[1:],
+                       'rows': rows, 'records': records}, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp, target)
+    except Exception as e:
+        logger.debug(f"MikroTik map: снимок {target} не записан: {e}")
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+
+
+def load_mikrotik_map(path):
+    """Карта по конкретному пути; повторный разбор только при изменении файла"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return EMPTY_MAP
+    signature = (path, st.st_mtime_ns, st.st_size)
+    cached = _cache.get(path)
+    if cached is not None and cached.signature == signature:
+        return cached
+    with _cache_lock:
+        cached = _cache.get(path)
+        if cached is not None and cached.signature == signature:
+            return cached
+        loaded = _load_sidecar(path, signature)
+        if loaded is None:
+            rows, records = parse_map_file(path)
+            _write_sidecar(path, signature, rows, records)
+        else:
+            rows, records = loaded
+        logger.debug(f"Using MikroTik map: {path} ({len(rows)} rows)")
+        cached = _cache[path] = MikrotikMap(path, signature, rows, records)
+        return cached
+
+
+def get_mikrotik_map():
+    """Текущая карта MikroTik (EMPTY_MAP, если файл не найден или не читается)"""
+    path = resolve_map_path()
+    if not path:
+        return EMPTY_MAP
+    try:
+        return load_mikrotik_map(path)
+    except Exception:
+        logger.exception("Error reading MikroTik map")
+        return EMPTY_MAP
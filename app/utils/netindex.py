@@ -0,0 +1,60 @@
+"""Индекс IP-сетей с поиском по наиболее длинному префиксу (LPM)."""
+
+import ipaddress
+
+
+class PrefixIndex:
+    """Сети хранятся в словарях по длине префикса: {длина: {адрес_сети >> (bits - длина): значение}}.
+    Поиск перебирает только реально встречающиеся длины, от длинных к коротким,
+    т.е. O(число различных длин) словарных обращений на адрес.
+    """
+
+    def __init__(self, entries=()):
+        self._tables = {4: {}, 6: {}}
+        self._lengths = {4: [], 6: []}
+        for value, network in entries:
+            self.add(network, value)
+
+    def add(self, network, value):
+        net = network if isinstance(network, (ipaddress.IPv4Network, ipaddress.IPv6Network)) \
+            else ipaddress.ip_network(network, strict=False)
+        tables = self._tables[net.version]
+        if net.prefixlen not in tables:
+            tables[net.prefixlen] = {}
+            self._lengths[net.version] = sorted(tables.keys(), reverse=True)
+        table = tables[net.prefixlen]
+        key = int(net.network_address) >> (net.max_prefixlen - net.prefixlen)
+        # При совпадении сетей побеждает первая запись (порядок строк карты)
+        table.setdefault(key, value)
+
+    def __len__(self):
+        return sum(len(t) for tables in self._tables.values() for t in tables.values())
+
+    def lookup(self, ip, default=None):
+        """Значение самой специфичной сети, содержащей ip (строка или ip_address)"""
+        try:
+            addr = ip if isinstance(ip, (ipaddress.IPv4Address, ipaddress.IPv6Address)) \
+                else ipaddress.ip_address(str(ip).strip())
+        except ValueError:
+            return default
+        tables = self._tables[addr.version]
+        bits = addr.max_prefixlen
+        value = int(addr)
+        for length in self._lengths[addr.version]:
+            hit = tables[length].get(value >> (bits - length))
+            if hit is not None:
+                return hit
+        return default
+
+    def lookup_many(self, ips, default=None):
+        """Пакетный поиск: список результатов в порядке ips (повторяющиеся адреса считаются один раз)"""
+        memo = {}
+        out = []
+        for ip in ips:
+            if not ip:
+                out.append(default)
+                continue
+            if ip not in memo:
+                memo[ip] = self.lookup(ip, default)
+            out.append(memo[ip])
+        return out
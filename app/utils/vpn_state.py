@@ -0,0 +1,186 @@
+"""Активные VPN-сессии из ike2mon.
+
+Основной источник — локальный Unix-сокет ike2mon (paths.ikev2_state_socket):
+в каждом воркере фоновый поток держит подписку (снимок + события add/remove)
+и хранит сессии в памяти, так что запрос страницы не делает ни одного
+обращения к диску. Пока подписка не установлена, берётся разовый снимок
+через сокет, а если ike2mon недоступен — CSV состояния (ikev2_active.csv),
+который ike2mon подменяет атомарно.
+"""
+
+import csv
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+from flask import current_app, has_app_context
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STATE_FILE = '/var/log/mikrotik/ikev2_active.csv'
+DEFAULT_STATE_SOCKET = '/run/ike2mon/state.sock'
+SOCKET_TIMEOUT = 1.0        # разовый запрос снимка
+IDLE_TIMEOUT = 90.0         # подписка: ike2mon шлёт ping каждые 30 с
+RECONNECT_DELAY = 5.0
+
+
+def state_paths():
+    """(путь сокета, путь CSV) из конфигурации приложения"""
+    paths = {}
+    cfg = {}
+    if has_app_context():
+        cfg = current_app.config
+        paths = cfg.get('PATHS') or {}
+    state_file = cfg.get('VPN_STATE_FILE') or paths.get('ikev2_state_file') or DEFAULT_STATE_FILE
+    state_socket = cfg.get('VPN_STATE_SOCKET') or paths.get('ikev2_state_socket') or DEFAULT_STATE_SOCKET
+    return state_socket, state_file
+
+
+def _session(row):
+    return {
+        'username': row.get('username', '') or row.get('user', ''),
+        'outer_ip': row.get('outer_ip', '') or row.get('remote_address', ''),
+        'inner_ip': row.get('inner_ip', ''),
+        'time_start': row.get('time_start', '') or row.get('login_time', ''),
+        'router': row.get('router', '') or row.get('device_name', ''),
+    }
+
+
+def parse_state_file(path):
+    """CSV состояния: с заголовком или без (username,outer_ip,inner_ip,time_start[,router])"""
+    sessions = []
+    with open(path, 'r', encoding='utf-8') as f:
+        peek = f.readline()
+        f.seek(0)
+        # Определяем есть ли заголовок по наличию буквенных ключей
+        header_like = any(k in peek.lower() for k in ['username', 'outer', 'inner', 'time'])
+        if header_like:
+            for row in csv.DictReader(f):
+                sessions.append(_session(row))
+        else:
+            for row in csv.reader(f):
+                if not row:
+                    continue
+                fields = [x.strip() for x in row[:5]] + [''] * (5 - min(len(row), 5))
+                sessions.append(dict(zip(('username', 'outer_ip', 'inner_ip', 'time_start', 'router'), fields)))
+    return sessions
+
+
+_file_cache = {'signature': None, 'sessions': []}
+
+
+def read_state_file(path):
+    """CSV состояния с кэшем по mtime/размеру"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return []
+    signature = (path, st.st_ino, st.st_mtime_ns, st.st_size)
+    cached = _file_cache
+    if cached['signature'] == signature:
+        return list(cached['sessions'])
+    sessions = parse_state_file(path)
+    _file_cache.update(signature=signature, sessions=sessions)
+    return list(sessions)
+
+
+def _connect(path, timeout):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
+def request_state(path, command='snapshot', timeout=SOCKET_TIMEOUT):
+    """Разовый запрос к сокету ike2mon: snapshot или stats"""
+    with _connect(path, timeout) as sock:
+        sock.sendall((command + '\n').encode('utf-8'))
+        with sock.makefile('rb') as f:
+            line = f.readline()
+    if not line:
+        raise ConnectionError('ike2mon закрыл соединение без ответа')
+    return json.loads(line.decode('utf-8'))
+
+
+class VpnStateClient:
+    """Подписка на состояние ike2mon в фоновом потоке (своя в каждом воркере)"""
+
+    def __init__(self):
+        self._sessions = {}
+        self._live = False
+        self.version = None
+        self._socket_path = None
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._failed_at = 0.0
+
+    def _ensure_thread(self, socket_path):
+        self._socket_path = socket_path
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            # После fork поток родителя в воркере не существует
+            self._pid = os.getpid()
+            self._live = False
+            self._thread = threading.Thread(target=self._run, name='vpn-state', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self._subscribe(self._socket_path)
+            except Exception as e:
+                logger.debug(f"Подписка на состояние ike2mon прервана: {e}")
+            self._live = False
+            time.sleep(RECONNECT_DELAY)
+
+    def _subscribe(self, path):
+        with _connect(path, IDLE_TIMEOUT) as sock:
+            sock.sendall(b'subscribe\n')
+            with sock.makefile('rb') as f:
+                for line in f:
+                    self._apply(json.loads(line.decode('utf-8')))
+
+    def _apply(self, message):
+        kind = message.get('type')
+        if kind == 'snapshot':
+            self._sessions = {s.get('inner_ip'): s for s in message.get('sessions') or []}
+            self._live = True
+        elif kind in ('add', 'remove'):
+            # Копия при записи: запросы читают self._sessions без блокировки
+            session = message.get('session') or {}
+            sessions = dict(self._sessions)
+            if kind == 'add':
+                sessions[session.get('inner_ip')] = session
+            else:
+                sessions.pop(session.get('inner_ip'), None)
+            self._sessions = sessions
+        self.version = message.get('version', self.version)
+
+    def sessions(self):
+        """Список активных сессий в формате read_active_vpn_sessions()"""
+        socket_path, state_file = state_paths()
+        self._ensure_thread(socket_path)
+        if self._live:
+            return list(self._sessions.values())
+        # Подписка ещё не установлена: разовый снимок, не чаще раза в RECONNECT_DELAY при ошибках
+        if time.monotonic() - self._failed_at > RECONNECT_DELAY and os.path.exists(socket_path):
+            try:
+                return list(request_state(socket_path).get('sessions') or [])
+            except Exception as e:
+                self._failed_at = time.monotonic()
+                logger.debug(f"Сокет ike2mon {socket_path} недоступен: {e}")
+        return read_state_file(state_file)
+
+
+vpn_state = VpnStateClient()
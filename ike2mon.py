@@ -7,12 +7,36 @@ import pymysql
 import subprocess
 import json
 import sys
+import socket
+import socketserver
+import threading
+import queue
+import atexit
+import signal
+import select
+import struct
+import ctypes
+import ctypes.util
+import gzip
+import contextlib
+from argparse import ArgumentParser, ArgumentTypeError
+from concurrent.futures import ThreadPoolExecutor, wait as futures_wait
+
+try:
+    import paramiko
+except ImportError:  # без paramiko — ssh-подпроцесс на каждую сверку
+    paramiko = None
+
+# Общие модули проекта (infra/): рядом со скриптом или в каталоге установки веб-приложения
+for _p in (os.environ.get('MONITORING_HOME', '/opt/monitoring-web'), os.path.dirname(os.path.realpath(__file__))):
+    if _p not in sys.path:
+        sys.path.insert(0, _p)
+from infra.config import get_config
 
 CONFIG_PATH = '/etc/infra/config.json'
 
 def load_config(path):
-    with open(path, 'r', encoding='utf-8') as f:
-        return json.load(f)
+    return get_config(path)
 
 try:
     CONFIG = load_config(CONFIG_PATH)
@@ -33,14 +57,126 @@ SSH_PASSWORD     = None  # Только если понадобится; по у
 
 SYNC_INTERVAL    = 300  # можно вынести в конфиг, если понадобится
 
+# Роутеры, на которых терминируется IKEv2: ike2mon.routers, иначе mikrotik.router_access_ips,
+# иначе единственный remote_host.mikrotik.ssh_host. Учётка — из секции mikrotik, если задана.
+MIKROTIK         = CONFIG.get('mikrotik', {})
+IKE2MON_ROUTERS  = list(CONFIG.get('ike2mon', {}).get('routers') or MIKROTIK.get('router_access_ips') or [SSH_HOST])
+ROUTER_SSH_USER  = MIKROTIK.get('ssh_user', SSH_USER)
+ROUTER_SSH_KEY   = MIKROTIK.get('ssh_key', SSH_KEY)
+ROUTER_KNOWN_HOSTS = MIKROTIK.get('ssh_known_hosts', '/root/.ssh/known_hosts')
+
+# Настройки самого ike2mon (необязательная секция "ike2mon" в config.json)
+IKE2MON          = CONFIG.get('ike2mon', {})
+# Локальный сокет запросов состояния: веб-приложение берёт сессии отсюда, а не из CSV
+STATE_SOCKET      = CONFIG['paths'].get('ikev2_state_socket', '/run/ike2mon/state.sock')
+STATE_SOCKET_MODE = int(str(IKE2MON.get('state_socket_mode', '660')), 8)
+SUBSCRIBER_QUEUE  = 1000   # событий в очереди подписчика; не успевает — отключаем
+HEARTBEAT         = 30     # секунд тишины до ping подписчику
+
+# Журнал изменений: событие = одна дописанная строка, CSV пересобирается при уплотнении
+JOURNAL_FILE             = IKE2MON.get('journal_file', STATE_FILE + '.journal')
+JOURNAL_COMPACT_RECORDS  = int(IKE2MON.get('journal_compact_records', 1000))
+JOURNAL_COMPACT_INTERVAL = float(IKE2MON.get('journal_compact_interval', 30))
+JOURNAL_FSYNC            = bool(IKE2MON.get('journal_fsync', False))
+
+# Контрольная точка лога: (устройство, inode, смещение, начало файла) на момент уплотнения
+CHECKPOINT_FILE  = IKE2MON.get('checkpoint_file', STATE_FILE + '.checkpoint')
+TAIL_SCAN_BYTES  = int(IKE2MON.get('tail_scan_bytes', 64 * 1024 * 1024))
+HEAD_BYTES       = 256     # по началу файла отличаем переписанный лог с тем же inode
+
+# Сверка с роутерами: параллельно, не больше sync_workers SSH-сессий одновременно
+SYNC_WORKERS     = int(IKE2MON.get('sync_workers', 4))
+SYNC_TIMEOUT     = float(IKE2MON.get('sync_timeout', 30))
+
+# Запись истории в MySQL: фоновый поток, пачки executemany, при недоступной БД — файл-спил
+HISTORY_QUEUE_SIZE     = int(IKE2MON.get('history_queue_size', 10000))
+HISTORY_BATCH_SIZE     = int(IKE2MON.get('history_batch_size', 200))
+HISTORY_FLUSH_INTERVAL = float(IKE2MON.get('history_flush_interval', 2))
+HISTORY_SPILL_FILE     = IKE2MON.get('history_spill_file', STATE_FILE + '.spill')
+HISTORY_RETRY_MAX      = 60      # секунд между попытками переподключения (верхняя граница)
+HISTORY_STOP_TIMEOUT   = 10      # секунд на дозапись текущей пачки при остановке
+# Чтение лога: inotify будит цикл на запись/ротацию; без него — опрос
+LOG_READ_CHUNK   = 1024 * 1024   # байт за один read() при всплеске событий
+LOG_POLL_INTERVAL = 0.5          # запасной режим без inotify
+IN_MODIFY, IN_ATTRIB, IN_MOVED_TO, IN_CREATE = 0x002, 0x004, 0x080, 0x100
+IN_DELETE_SELF, IN_MOVE_SELF, IN_Q_OVERFLOW  = 0x400, 0x800, 0x4000
+IN_NONBLOCK, IN_CLOEXEC = os.O_NONBLOCK, getattr(os, 'O_CLOEXEC', 0o2000000)
+
+HISTORY_INSERT_SQL = (
+    "INSERT INTO session_history (username, outer_ip, inner_ip, time_start, time_end, duration) "
+    "VALUES (%s, %s, %s, %s, %s, %s)"
+)
+
+# Сводные таблицы для страниц статистики VPN. Обновляются в той же транзакции, что и
+# session_history (учитываются закрытые сессии по дню/часу начала); --rebuild-rollups
+# пересчитывает их из session_history.
+ROLLUP_DDL = (
+    """CREATE TABLE IF NOT EXISTS vpn_daily_user_stats (
+      day DATE NOT NULL,
+      username VARCHAR(255) NOT NULL,
+      sessions INT NOT NULL DEFAULT 0,
+      total_duration BIGINT NOT NULL DEFAULT 0,
+      max_duration INT NOT NULL DEFAULT 0,
+      last_login DATETIME NULL,
+      PRIMARY KEY (day, username),
+      KEY idx_username_day (username, day)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4""",
+    """CREATE TABLE IF NOT EXISTS vpn_hourly_stats (
+      day DATE NOT NULL,
+      hour TINYINT NOT NULL,
+      sessions INT NOT NULL DEFAULT 0,
+      PRIMARY KEY (day, hour)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4""",
+)
+ROLLUP_DAILY_SQL = (
+    "INSERT INTO vpn_daily_user_stats (day, username, sessions, total_duration, max_duration, last_login) "
+    "VALUES (%s, %s, %s, %s, %s, %s) "
+    "ON DUPLICATE KEY UPDATE sessions = sessions + VALUES(sessions), "
+    "total_duration = total_duration + VALUES(total_duration), "
+    "max_duration = GREATEST(max_duration, VALUES(max_duration)), "
+    "last_login = GREATEST(COALESCE(last_login, VALUES(last_login)), VALUES(last_login))"
+)
+ROLLUP_HOURLY_SQL = (
+    "INSERT INTO vpn_hourly_stats (day, hour, sessions) VALUES (%s, %s, %s) "
+    "ON DUPLICATE KEY UPDATE sessions = sessions + VALUES(sessions)"
+)
+# Именованная блокировка MySQL: пересчёт сводок и их пополнение (живой писатель, --replay)
+# не идут одновременно, иначе пересчёт теряет или удваивает строки, вставленные во время него
+ROLLUP_LOCK_NAME     = 'ike2mon_rollups'
+ROLLUP_LOCK_WAIT     = 5      # секунд ждёт пополнение сводок (дальше — пачка в спил)
+ROLLUP_REBUILD_WAIT  = 60     # секунд ждёт пересчёт, пока допишется текущая пачка
+
+# Без ведущего '.*': search() и так ищет по всей строке, а префикс заставлял движок
+# перебирать каждую позицию. Дешёвая проверка подстроки отсекает почти весь лог заранее.
 acquired_re = re.compile(
-    r'.*acquired (?P<inner_ip>\d+\.\d+\.\d+\.\d+) address for (?P<outer_ip>\d+\.\d+\.\d+\.\d+), (?:CN=(?P<cn>[^,]+)|(?P<altname>[^,]+))'
+    r'acquired (?P<inner_ip>\d+\.\d+\.\d+\.\d+) address for (?P<outer_ip>\d+\.\d+\.\d+\.\d+), (?:CN=(?P<cn>[^,]+)|(?P<altname>[^,]+))'
 )
 releasing_re = re.compile(
-    r'.*releasing address (?P<inner_ip>\d+\.\d+\.\d+\.\d+)'
+    r'releasing address (?P<inner_ip>\d+\.\d+\.\d+\.\d+)'
 )
 
 sessions = {}
+# Сессии читают потоки сокета состояния, меняет — основной цикл
+sessions_lock = threading.RLock()
+state_version = 0          # растёт на каждое изменение sessions
+subscribers = set()
+service_stats = {'started_at': None, 'adds': 0, 'removes': 0, 'dropped_subscribers': 0}
+# Последняя сверка по каждому роутеру: задержка, число пиров, расхождения
+router_stats = {}
+# inner_ip -> time.monotonic() последнего add/remove; сверка не трогает сессии,
+# изменившиеся по логу после начала опроса роутеров
+session_touched = {}
+journal = {'file': None, 'records': 0, 'compacted_at': 0.0}
+history_queue = queue.Queue(maxsize=HISTORY_QUEUE_SIZE)
+history_spill_lock = threading.Lock()
+history_stats = {'written': 0, 'batches': 0, 'spilled': 0, 'errors': 0, 'last_error': None}
+# Позиция в логе после последней обработанной строки
+log_pos = {'dev': None, 'ino': None, 'offset': 0, 'head': ''}
+
+iso_ts_re = re.compile(
+    r'^(?P<date>\d{4}-\d{2}-\d{2})[T ](?P<time>\d{2}:\d{2}:\d{2})(?:\.(?P<frac>\d+))?(?P<tz>Z|[+-]\d{2}:?\d{2})?'
+)
+syslog_ts_re = re.compile(r'^(?P<mon>[A-Z][a-z]{2}) +(?P<day>\d{1,2}) (?P<time>\d{2}:\d{2}:\d{2})')
 
 def parse_iso8601(s):
     for fmt in ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S"):
@@ -53,46 +189,505 @@ def parse_iso8601(s):
 def current_timestamp():
     return datetime.datetime.now().isoformat()
 
+def parse_log_timestamp(line, now=None):
+    """Время события из строки лога rsyslog в локальном времени (ISO-строка) или None.
+    Форматы: RSYSLOG_FileFormat (2025-06-14T10:11:12.123456+03:00) и традиционный
+    (Jun 14 10:11:12) — для него год берётся текущий, а дата из будущего считается прошлогодней."""
+    m = iso_ts_re.match(line)
+    if m:
+        try:
+            dt = datetime.datetime.strptime(f"{m.group('date')} {m.group('time')}", "%Y-%m-%d %H:%M:%S")
+        except ValueError:
+            return None
+        frac = m.group('frac')
+        if frac:
+            dt = dt.replace(microsecond=int(frac[:6].ljust(6, '0')))
+        tz = m.group('tz')
+        if tz:
+            if tz == 'Z':
+                offset = datetime.timedelta(0)
+            else:
+                sign = -1 if tz[0] == '-' else 1
+                digits = tz[1:].replace(':', '')
+                offset = sign * datetime.timedelta(hours=int(digits[:2]), minutes=int(digits[2:]))
+            dt = dt.replace(tzinfo=datetime.timezone(offset)).astimezone().replace(tzinfo=None)
+        return dt.isoformat()
+    m = syslog_ts_re.match(line)
+    if m:
+        now = now or datetime.datetime.now()
+        try:
+            dt = datetime.datetime.strptime(f"{now.year} {m.group('mon')} {m.group('day')} {m.group('time')}", "%Y %b %d %H:%M:%S")
+        except ValueError:
+            return None
+        if dt - now > datetime.timedelta(days=1):
+            dt = dt.replace(year=dt.year - 1)
+        return dt.isoformat()
+    return None
+
 def save_to_mysql(username, outer_ip, inner_ip, ts_start, ts_end, duration):
+    """Ставит закрытую сессию в очередь фонового писателя; никогда не ждёт БД.
+    Очередь переполнена — строка сразу уходит в файл-спил и будет дописана позже."""
+    row = (username, outer_ip, inner_ip, ts_start, ts_end, duration)
     try:
-        db = pymysql.connect(**MYSQL_SETTINGS)
-        with db:
+        history_queue.put_nowait(row)
+    except queue.Full:
+        spill_rows([row])
+
+def spill_rows(rows):
+    """Дописывает строки в файл-спил (JSON по строке) — переживают рестарт и простой MySQL"""
+    with history_spill_lock:
+        with open(HISTORY_SPILL_FILE, 'a') as f:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        history_stats['spilled'] += len(rows)
+
+def take_spill():
+    """Забирает накопленный спил: файл переименовывается, чтобы новые строки шли в свежий.
+    Незавершённая прошлая попытка (.sending) дочитывается первой."""
+    sending = HISTORY_SPILL_FILE + '.sending'
+    with history_spill_lock:
+        if not os.path.exists(sending):
+            if not os.path.exists(HISTORY_SPILL_FILE):
+                return None, []
+            os.replace(HISTORY_SPILL_FILE, sending)
+    rows = []
+    with open(sending, 'r') as f:
+        for line in f:
+            try:
+                rows.append(tuple(json.loads(line)))
+            except ValueError:
+                continue  # строка, оборванная при сбое
+    return sending, rows
+
+def session_start(ts):
+    """Время из строки истории: ISO (очередь/спил живого писателя) или 'YYYY-MM-DD HH:MM:SS'"""
+    return parse_iso8601(ts.replace(' ', 'T', 1))
+
+def mysql_datetime(ts):
+    """Время -> DATETIME без долей секунды. В session_history и в сводки идёт одно и то же
+    значение: иначе MySQL округлил бы 23:59:59.6 до следующего дня, а сводка — нет."""
+    return session_start(ts).strftime('%Y-%m-%d %H:%M:%S')
+
+def history_row(row):
+    """Строка session_history с временем в целых секундах (как у --replay)"""
+    username, outer_ip, inner_ip, ts_start, ts_end, duration = row
+    return (username, outer_ip, inner_ip, mysql_datetime(ts_start),
+            mysql_datetime(ts_end) if ts_end else ts_end, duration)
+
+def update_rollups(cursor, rows):
+    """Добавляет строки session_history к сводным таблицам (в текущей транзакции)"""
+    daily = {}
+    hourly = {}
+    for username, _outer_ip, _inner_ip, ts_start, _ts_end, duration in rows:
+        start = session_start(ts_start)
+        acc = daily.setdefault((start.date(), username or ''), [0, 0, 0, start])
+        acc[0] += 1
+        acc[1] += duration or 0
+        acc[2] = max(acc[2], duration or 0)
+        acc[3] = max(acc[3], start)
+        hourly[(start.date(), start.hour)] = hourly.get((start.date(), start.hour), 0) + 1
+    if daily:
+        cursor.executemany(ROLLUP_DAILY_SQL, [(day, user, n, total, longest, last)
+                                              for (day, user), (n, total, longest, last) in daily.items()])
+        cursor.executemany(ROLLUP_HOURLY_SQL, [(day, hour, n) for (day, hour), n in hourly.items()])
+
+def ensure_rollups(db):
+    """Создаёт сводные таблицы, если их нет. True — сводки пусты (только что созданы или
+    прошлый пересчёт не завершился) и их нужно пересчитать из session_history."""
+    with db.cursor() as c:
+        for ddl in ROLLUP_DDL:
+            c.execute(ddl)
+        c.execute("SELECT 1 FROM vpn_daily_user_stats LIMIT 1")
+        empty = c.fetchone() is None
+    db.commit()
+    return empty
+
+class RollupBusy(RuntimeError):
+    """Сводные таблицы заняты другим процессом (пересчёт или пополнение)"""
+
+@contextlib.contextmanager
+def rollup_lock(db, wait, enabled=True):
+    """GET_LOCK(ROLLUP_LOCK_NAME) на соединении db на время блока; RollupBusy — не дождались.
+    enabled=False — блок без блокировки (сводки не трогаются)."""
+    if not enabled:
+        yield
+        return
+    with db.cursor() as c:
+        c.execute("SELECT GET_LOCK(%s, %s)", (ROLLUP_LOCK_NAME, wait))
+        row = c.fetchone()
+    if not row or row[0] != 1:
+        raise RollupBusy(f"блокировка {ROLLUP_LOCK_NAME} занята дольше {wait} с")
+    try:
+        yield
+    finally:
+        try:
             with db.cursor() as c:
-                c.execute(
-                    "INSERT INTO session_history (username, outer_ip, inner_ip, time_start, time_end, duration) VALUES (%s, %s, %s, %s, %s, %s)",
-                    (username, outer_ip, inner_ip, ts_start, ts_end, duration)
-                )
-            db.commit()
-    except Exception as e:
-        print("Ошибка при записи в MySQL:", e)
+                c.execute("SELECT RELEASE_LOCK(%s)", (ROLLUP_LOCK_NAME,))
+                c.fetchone()
+        except Exception:
+            pass  # соединение оборвано — MySQL снимет блокировку сам
+
+def rebuild_rollups(db, since=None, wait=ROLLUP_REBUILD_WAIT):
+    """Пересчитывает сводные таблицы из session_history (целиком или начиная с дня since;
+    у datetime время отбрасывается — день пересчитывается целиком) одной транзакцией
+    под rollup_lock; возвращает (строк по дням, строк по часам)"""
+    if isinstance(since, datetime.datetime):
+        since = since.date()
+    with rollup_lock(db, wait):
+        return _rebuild_rollups(db, since)
+
+def _rebuild_rollups(db, since):
+    where = "time_end IS NOT NULL" + (" AND time_start >= %s" if since else "")
+    args = (since,) if since else ()
+    with db.cursor() as c:
+        if since:
+            c.execute("DELETE FROM vpn_daily_user_stats WHERE day >= %s", args)
+            c.execute("DELETE FROM vpn_hourly_stats WHERE day >= %s", args)
+        else:
+            c.execute("DELETE FROM vpn_daily_user_stats")
+            c.execute("DELETE FROM vpn_hourly_stats")
+        duration = "COALESCE(duration, TIMESTAMPDIFF(SECOND, time_start, time_end))"
+        daily = c.execute(f"""
+            INSERT INTO vpn_daily_user_stats (day, username, sessions, total_duration, max_duration, last_login)
+            SELECT DATE(time_start), COALESCE(username, ''), COUNT(*), SUM({duration}), MAX({duration}), MAX(time_start)
+            FROM session_history
+            WHERE {where}
+            GROUP BY DATE(time_start), COALESCE(username, '')
+        """, args)
+        hourly = c.execute(f"""
+            INSERT INTO vpn_hourly_stats (day, hour, sessions)
+            SELECT DATE(time_start), HOUR(time_start), COUNT(*)
+            FROM session_history
+            WHERE {where}
+            GROUP BY DATE(time_start), HOUR(time_start)
+        """, args)
+    db.commit()
+    return daily, hourly
+
+class HistoryWriter(threading.Thread):
+    """Пишет session_history пачками через одно долгоживущее соединение.
+
+    Пачка уходит, когда набралось HISTORY_BATCH_SIZE строк или прошло
+    HISTORY_FLUSH_INTERVAL секунд с первой строки. Ошибка БД — пачка в спил,
+    соединение сбрасывается, следующая попытка с нарастающей паузой; после
+    успешной записи спил дописывается в БД."""
+
+    def __init__(self):
+        super().__init__(name='history-writer', daemon=True)
+        self.db = None
+        self.retry_at = 0.0
+        self.backoff = 1.0
+        self.rollups = False    # сводные таблицы готовы (проверяется при каждом новом соединении)
+        self.stopping = threading.Event()
+        self.inflight = None    # пачка, взятая из очереди и ещё не записанная (для spill_pending)
+
+    def connect(self):
+        if self.db is not None:
+            try:
+                self.db.ping(reconnect=True)
+                return self.db
+            except Exception:
+                self.close()
+        self.db = pymysql.connect(**MYSQL_SETTINGS)
+        if not self.rollups:
+            self.prepare_rollups()
+        return self.db
+
+    def prepare_rollups(self):
+        """Нет прав или таблиц — пишем только session_history, сводки пересчитает --rebuild-rollups"""
+        try:
+            if ensure_rollups(self.db):
+                daily, hourly = rebuild_rollups(self.db)
+                print(f"[HISTORY] Созданы сводные таблицы VPN: {daily} строк по дням, {hourly} по часам", flush=True)
+            self.rollups = True
+        except Exception as e:
+            print(f"[HISTORY] Сводные таблицы VPN недоступны: {e}", flush=True)
+            try:
+                self.db.rollback()
+            except Exception:
+                pass
+
+    def close(self):
+        if self.db is not None:
+            try:
+                self.db.close()
+            except Exception:
+                pass
+        self.db = None
+
+    def insert(self, rows):
+        rows = [history_row(r) for r in rows]
+        db = self.connect()
+        try:
+            # Идёт --rebuild-rollups — ждём ROLLUP_LOCK_WAIT, затем пачка в спил (RollupBusy)
+            with rollup_lock(db, ROLLUP_LOCK_WAIT, self.rollups):
+                for i in range(0, len(rows), HISTORY_BATCH_SIZE):
+                    with db.cursor() as c:
+                        c.executemany(HISTORY_INSERT_SQL, rows[i:i + HISTORY_BATCH_SIZE])
+                        if self.rollups:
+                            update_rollups(c, rows[i:i + HISTORY_BATCH_SIZE])
+                db.commit()
+        except Exception:
+            try:
+                db.rollback()
+            except Exception:
+                pass
+            self.close()
+            raise
+        history_stats['written'] += len(rows)
+        history_stats['batches'] += 1
+
+    def failed(self, e, rows):
+        history_stats['errors'] += 1
+        history_stats['last_error'] = str(e)
+        print(f"[HISTORY] MySQL недоступен ({e}), строк в спил: {len(rows)}", flush=True)
+        if rows:
+            spill_rows(rows)
+        self.retry_at = time.monotonic() + self.backoff
+        self.backoff = min(self.backoff * 2, HISTORY_RETRY_MAX)
+
+    def flush(self, rows):
+        if time.monotonic() < self.retry_at:
+            spill_rows(rows)  # БД недавно отказала — не держим очередь, ждём паузу
+            return
+        try:
+            self.insert(rows)
+        except Exception as e:
+            self.failed(e, rows)
+            return
+        self.backoff = 1.0
+        self.drain_spill()
+
+    def drain_spill(self):
+        if time.monotonic() < self.retry_at:
+            return
+        try:
+            path, rows = take_spill()
+        except Exception as e:
+            print(f"[HISTORY] Не читается спил {HISTORY_SPILL_FILE}: {e}", flush=True)
+            return
+        if path is None:
+            return
+        try:
+            if rows:
+                self.insert(rows)
+        except Exception as e:
+            # Файл .sending остаётся — следующая попытка начнёт с него
+            self.failed(e, [])
+            return
+        os.unlink(path)
+        self.backoff = 1.0
+        if rows:
+            print(f"[HISTORY] Дописано из спила: {len(rows)}", flush=True)
+
+    def run(self):
+        self.drain_spill()
+        while not self.stopping.is_set():
+            try:
+                row = history_queue.get(timeout=HISTORY_FLUSH_INTERVAL)
+            except queue.Empty:
+                self.drain_spill()
+                continue
+            rows = self.inflight = [row]
+            deadline = time.monotonic() + HISTORY_FLUSH_INTERVAL
+            while len(rows) < HISTORY_BATCH_SIZE and not self.stopping.is_set():
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    # Короткие ожидания — чтобы остановка не ждала весь интервал сбора пачки
+                    rows.append(history_queue.get(timeout=min(timeout, 0.2)))
+                except queue.Empty:
+                    continue
+            try:
+                self.flush(rows)
+            except Exception as e:
+                print(f"[HISTORY] Ошибка записи истории: {e}", flush=True)
+            self.inflight = None
+
+def start_history_writer():
+    writer = HistoryWriter()
+    writer.start()
+    atexit.register(spill_pending, writer)
+
+def spill_pending(writer=None):
+    """При остановке: писатель дописывает текущую пачку (не дольше HISTORY_STOP_TIMEOUT)
+    и выходит; всё, что не успело уйти в БД, включая зависшую пачку, — в спил"""
+    rows = []
+    if writer is not None:
+        writer.stopping.set()
+        writer.join(HISTORY_STOP_TIMEOUT)
+        if writer.is_alive() and writer.inflight:
+            rows.extend(writer.inflight)
+    while True:
+        try:
+            rows.append(history_queue.get_nowait())
+        except queue.Empty:
+            break
+    if rows:
+        spill_rows(rows)
+        print(f"[HISTORY] При остановке в спил: {len(rows)}", flush=True)
 
 def save_state():
-    with open(STATE_FILE, 'w') as f:
-        for username, outer_ip, inner_ip, ts in sessions.values():
-            f.write(f'{username},{outer_ip},{inner_ip},{ts}\n')
+    # Пишем во временный файл и подменяем: читатели никогда не видят половину файла
+    tmp = STATE_FILE + '.tmp'
+    with sessions_lock:
+        rows = list(sessions.values())
+    with open(tmp, 'w') as f:
+        for username, outer_ip, inner_ip, ts, router in rows:
+            f.write(f'{username},{outer_ip},{inner_ip},{ts},{router}\n')
+    os.replace(tmp, STATE_FILE)
+
+def journal_append(record):
+    """Дописывает событие в журнал; уплотняет, когда записей накопилось много"""
+    f = journal['file']
+    if f is None:
+        f = journal['file'] = open(JOURNAL_FILE, 'a')
+    # pos — смещение в логе, до которого событие учтено (для продолжения после сбоя)
+    record['pos'] = log_pos['offset']
+    f.write(json.dumps(record, ensure_ascii=False) + '\n')
+    f.flush()
+    if JOURNAL_FSYNC:
+        os.fsync(f.fileno())
+    journal['records'] += 1
+    if journal['records'] >= JOURNAL_COMPACT_RECORDS:
+        compact_state()
 
-def add_session(username, outer_ip, inner_ip):
-    sessions[inner_ip] = (username, outer_ip, inner_ip, current_timestamp())
+def compact_state():
+    """Уплотнение: снимок sessions в STATE_FILE (tmp + rename), затем пустой журнал.
+    Сбой между шагами безопасен — повтор журнала поверх нового снимка ничего не меняет."""
     save_state()
+    save_checkpoint()
+    f = journal['file']
+    if f is not None:
+        f.truncate(0)
+        f.seek(0)
+    else:
+        open(JOURNAL_FILE, 'w').close()
+    journal['records'] = 0
+    journal['compacted_at'] = time.monotonic()
+
+def maybe_compact():
+    if journal['records'] and time.monotonic() - journal['compacted_at'] >= JOURNAL_COMPACT_INTERVAL:
+        try:
+            compact_state()
+        except Exception as e:
+            print("[ERROR] Не могу уплотнить журнал состояния:", e)
+
+def save_checkpoint():
+    if log_pos['dev'] is None or log_pos['ino'] is None:
+        return  # файл лога ещё не открыт — такая точка привела бы к полному пересканированию
+    tmp = CHECKPOINT_FILE + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(dict(log_pos, saved_at=current_timestamp()), f)
+    os.replace(tmp, CHECKPOINT_FILE)
+
+def load_checkpoint():
+    try:
+        with open(CHECKPOINT_FILE, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"[WARN] Контрольная точка {CHECKPOINT_FILE} не читается: {e}")
+        return None
+
+def load_state():
+    """Состояние после рестарта/сбоя: снимок STATE_FILE плюс журнал поверх него.
+    Возвращает (sessions, смещение в логе из последней записи журнала или None)"""
+    state = {}
+    pos = None
+    try:
+        with open(STATE_FILE, 'r') as f:
+            for line in f:
+                parts = line.rstrip('\n').split(',')
+                if len(parts) >= 4:
+                    router = parts[4] if len(parts) >= 5 else ''
+                    state[parts[2]] = (parts[0], parts[1], parts[2], parts[3], router)
+    except FileNotFoundError:
+        pass
+    try:
+        with open(JOURNAL_FILE, 'r') as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue  # строка, оборванная при сбое
+                pos = rec.get('pos', pos)
+                if rec.get('op') == 'add':
+                    state[rec['inner_ip']] = (rec['username'], rec['outer_ip'], rec['inner_ip'], rec['ts'],
+                                              rec.get('router', ''))
+                elif rec.get('op') == 'remove':
+                    state.pop(rec.get('inner_ip'), None)
+    except FileNotFoundError:
+        pass
+    return state, pos
+
+def session_dict(value):
+    username, outer_ip, inner_ip, ts, router = value
+    return {'username': username, 'outer_ip': outer_ip, 'inner_ip': inner_ip, 'time_start': ts, 'router': router}
+
+def publish(event, payload):
+    """Изменение sessions: новая версия состояния и рассылка подписчикам (под sessions_lock)"""
+    global state_version
+    state_version += 1
+    line = (json.dumps({'type': event, 'version': state_version, 'session': payload}) + '\n').encode('utf-8')
+    for sub in list(subscribers):
+        try:
+            sub.put_nowait(line)
+        except queue.Full:
+            # Медленный клиент: отключаем, он переподпишется и получит свежий снимок.
+            # Под sessions_lock ничего не ждём: освобождаем место под маркер отключения
+            # (кладёт в очередь только publish, так что место после get_nowait есть).
+            subscribers.discard(sub)
+            try:
+                sub.get_nowait()
+            except queue.Empty:
+                pass
+            try:
+                sub.put_nowait(None)
+            except queue.Full:
+                pass
+            service_stats['dropped_subscribers'] += 1
+
+def add_session(username, outer_ip, inner_ip, ts=None, router=''):
+    with sessions_lock:
+        sessions[inner_ip] = (username, outer_ip, inner_ip, ts or current_timestamp(), router)
+        session_touched[inner_ip] = time.monotonic()
+        service_stats['adds'] += 1
+        publish('add', session_dict(sessions[inner_ip]))
+    try:
+        journal_append({'op': 'add', 'username': username, 'outer_ip': outer_ip,
+                        'inner_ip': inner_ip, 'ts': sessions[inner_ip][3], 'router': router})
+    except Exception as e:
+        print("[ERROR] Не могу записать журнал состояния:", e)
 
-def remove_session(inner_ip):
+def remove_session(inner_ip, ts_end=None):
     inner_ip = inner_ip.strip()
     if inner_ip not in sessions:
         print(f"[WARN] {inner_ip} not in sessions")
         return
 
-    username, outer_ip, inner_ip, ts_start = sessions[inner_ip]
-    ts_end   = current_timestamp()
-    duration = int((parse_iso8601(ts_end) - parse_iso8601(ts_start)).total_seconds())
+    username, outer_ip, inner_ip, ts_start, _router = sessions[inner_ip]
+    ts_end   = ts_end or current_timestamp()
+    duration = max(0, int((parse_iso8601(ts_end) - parse_iso8601(ts_start)).total_seconds()))
     save_to_mysql(username, outer_ip, inner_ip, ts_start, ts_end, duration)
 
-    del sessions[inner_ip]
+    with sessions_lock:
+        del sessions[inner_ip]
+        session_touched[inner_ip] = time.monotonic()
+        service_stats['removes'] += 1
+        publish('remove', {'inner_ip': inner_ip})
     try:
-        save_state()
+        journal_append({'op': 'remove', 'inner_ip': inner_ip})
     except Exception as e:
-        print("[ERROR] Не могу сохранить CSV:", e)
+        print("[ERROR] Не могу записать журнал состояния:", e)
 
 def process_line(line):
+    if 'acquired' not in line and 'releasing' not in line:
+        return
     m = acquired_re.search(line)
     if m:
         print("  > Найдено подключение", m.groupdict(), flush=True)
@@ -101,58 +696,228 @@ def process_line(line):
         username = (cn if cn else altname).strip()
         outer_ip = m.group('outer_ip')
         inner_ip = m.group('inner_ip')
-        add_session(username, outer_ip, inner_ip)
+        add_session(username, outer_ip, inner_ip, parse_log_timestamp(line))
         return
 
     m = releasing_re.search(line)
     if m:
         print("  > Найдено отключение", m.groupdict(), flush=True)
         inner_ip = m.group('inner_ip').strip()
-        remove_session(inner_ip)
+        remove_session(inner_ip, parse_log_timestamp(line))
         return
 
-def initial_scan():
-    if os.path.isfile(STATE_FILE):
-        os.remove(STATE_FILE)
-    sessions.clear()
-    with open(LOG_FILE, 'r') as f:
-        for line in f:
-            m = acquired_re.search(line)
-            if m:
-                cn = m.group('cn')
-                altname = m.group('altname')
-                username = (cn if cn else altname).strip()
-                outer_ip = m.group('outer_ip')
-                inner_ip = m.group('inner_ip')
-                sessions[inner_ip] = (username, outer_ip, inner_ip, current_timestamp())
-            m = releasing_re.search(line)
-            if m:
-                inner_ip = m.group('inner_ip').strip()
-                sessions.pop(inner_ip, None)
-    save_state()
+def snapshot_message():
+    with sessions_lock:
+        return {'type': 'snapshot', 'version': state_version,
+                'sessions': [session_dict(v) for v in sessions.values()]}
 
-def ssh_get_active_peers():
-    peers = set()
-    ssh_command = [
-        "ssh",
-        "-q",
-        "-i", SSH_KEY,
-        "-o", "StrictHostKeyChecking=no",
-        "-o", "UserKnownHostsFile=/root/.ssh/known_hosts",
-        f"{SSH_USER}@{SSH_HOST}",
-        '/ip ipsec active-peers print detail'
-    ]
+def stats_message():
+    with sessions_lock:
+        return {'type': 'stats', 'version': state_version, 'sessions': len(sessions),
+                'subscribers': len(subscribers), 'started_at': service_stats['started_at'],
+                'adds': service_stats['adds'], 'removes': service_stats['removes'],
+                'dropped_subscribers': service_stats['dropped_subscribers'],
+                'routers': {ip: dict(st) for ip, st in router_stats.items()},
+                'history': dict(history_stats, pending=history_queue.qsize())}
+
+class StateRequestHandler(socketserver.StreamRequestHandler):
+    """Протокол: клиент шлёт одну строку (snapshot | subscribe | stats), ответ — JSON по строке.
+    subscribe: снимок, затем события add/remove с номером версии и ping при тишине."""
+
+    def send(self, message):
+        data = message if isinstance(message, bytes) else (json.dumps(message) + '\n').encode('utf-8')
+        self.wfile.write(data)
+        self.wfile.flush()
+
+    def handle(self):
+        self.request.settimeout(5)
+        try:
+            command = self.rfile.readline(256).decode('utf-8', 'ignore').strip().lower() or 'snapshot'
+        except socket.timeout:
+            return
+        if command == 'snapshot':
+            self.send(snapshot_message())
+        elif command == 'stats':
+            self.send(stats_message())
+        elif command == 'subscribe':
+            self.subscribe()
+        else:
+            self.send({'type': 'error', 'error': f'unknown command: {command}'})
+
+    def subscribe(self):
+        sub = queue.Queue(maxsize=SUBSCRIBER_QUEUE)
+        # Снимок и регистрация под одной блокировкой — между ними не теряется ни одно событие
+        with sessions_lock:
+            snapshot = snapshot_message()
+            subscribers.add(sub)
+        try:
+            self.send(snapshot)
+            while True:
+                try:
+                    line = sub.get(timeout=HEARTBEAT)
+                except queue.Empty:
+                    line = {'type': 'ping', 'version': state_version}
+                if line is None:
+                    return
+                self.send(line)
+        except (OSError, socket.timeout):
+            pass
+        finally:
+            with sessions_lock:
+                subscribers.discard(sub)
+
+class StateServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def start_state_server():
+    """Сокет состояния в фоновом потоке; без него работают только CSV-читатели"""
     try:
-        result = subprocess.run(
-            ssh_command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            timeout=60
-        )
-        out = result.stdout.decode('utf-8', 'ignore')
+        os.makedirs(os.path.dirname(STATE_SOCKET), exist_ok=True)
+        if os.path.exists(STATE_SOCKET):
+            os.unlink(STATE_SOCKET)
+        server = StateServer(STATE_SOCKET, StateRequestHandler)
+        os.chmod(STATE_SOCKET, STATE_SOCKET_MODE)
     except Exception as e:
-        print(f"[SSH ERROR] {e}")
-        out = ''
+        print(f"[WARN] Сокет состояния {STATE_SOCKET} недоступен: {e}", flush=True)
+        return None
+    threading.Thread(target=server.serve_forever, name='state-server', daemon=True).start()
+    print(f"Сокет состояния: {STATE_SOCKET}", flush=True)
+    return server
+
+def scan_line(line, state):
+    """Применяет строку лога к словарю состояния без записи в MySQL и журнал (восстановление)"""
+    if 'acquired' not in line and 'releasing' not in line:
+        return
+    m = acquired_re.search(line)
+    if m:
+        cn = m.group('cn')
+        altname = m.group('altname')
+        username = (cn if cn else altname).strip()
+        outer_ip = m.group('outer_ip')
+        inner_ip = m.group('inner_ip')
+        state[inner_ip] = (username, outer_ip, inner_ip, parse_log_timestamp(line) or current_timestamp(), '')
+        return
+    m = releasing_re.search(line)
+    if m:
+        state.pop(m.group('inner_ip').strip(), None)
+
+def file_head(f):
+    pos = f.tell()
+    f.seek(0)
+    head = f.read(HEAD_BYTES)
+    f.seek(pos)
+    return head.hex()
+
+def track_position(f):
+    """Запоминает файл и смещение, с которого продолжается обработка"""
+    st = os.fstat(f.fileno())
+    log_pos.update(dev=st.st_dev, ino=st.st_ino, offset=f.tell(), head=file_head(f))
+
+def same_log(position, f):
+    """Открытый файл — тот же лог, что в position, и он не был усечён"""
+    st = os.fstat(f.fileno())
+    if not position or (position.get('dev'), position.get('ino')) != (st.st_dev, st.st_ino):
+        return False
+    if st.st_size < position.get('offset', 0):
+        return False
+    head = position.get('head') or ''
+    return file_head(f)[:len(head)] == head
+
+def find_rotated(position):
+    """Прежний файл лога после ротации (тот же inode под именем LOG_FILE.1), если он есть"""
+    for path in (LOG_FILE + '.1', LOG_FILE + '.0'):
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if (position.get('dev'), position.get('ino')) == (st.st_dev, st.st_ino):
+            return path
+    return None
+
+def catch_up(f):
+    """Обрабатывает строки от текущей позиции до конца файла как живые события.
+    Читает блоками по LOG_READ_CHUNK; недописанная последняя строка остаётся в файле
+    (позиция возвращается к её началу) и будет прочитана на следующем проходе."""
+    lines = 0
+    while True:
+        chunk = f.read(LOG_READ_CHUNK)
+        if not chunk:
+            return lines
+        end = chunk.rfind(b'\n') + 1
+        if end < len(chunk):
+            f.seek(end - len(chunk), 1)
+        if not end:
+            return lines
+        offset = f.tell() - end
+        for raw in chunk[:end].splitlines(keepends=True):
+            offset += len(raw)
+            log_pos['offset'] = offset
+            process_line(raw.decode('utf-8', 'replace'))
+            lines += 1
+        maybe_compact()  # раз на блок, а не на каждую строку всплеска
+
+def tail_scan(f):
+    """Хвост лога (не больше TAIL_SCAN_BYTES) поверх восстановленного состояния"""
+    size = os.fstat(f.fileno()).st_size
+    start = max(0, size - TAIL_SCAN_BYTES)
+    f.seek(start)
+    if start:
+        f.readline()  # первая строка окна может быть неполной
+    lines = 0
+    while True:
+        raw = f.readline()
+        if not raw or not raw.endswith(b'\n'):
+            if raw:
+                f.seek(-len(raw), 1)
+            break
+        scan_line(raw.decode('utf-8', 'replace'), sessions)
+        lines += 1
+    print(f"[START] Просканирован хвост лога: {lines} строк с позиции {start}", flush=True)
+
+def open_log(position):
+    """Открывает LOG_FILE и встаёт на позицию продолжения.
+
+    position совпадает с файлом — продолжаем с сохранённого смещения (строки после
+    него обработает follow как обычные события). Лог ротирован и старый файл найден —
+    дочитываем его, новый берём с начала. Иначе (нет контрольной точки, усечение,
+    файл переписан) — ограниченный скан хвоста."""
+    f = open(LOG_FILE, 'rb')
+    if position and same_log(position, f):
+        f.seek(position['offset'])
+        print(f"[START] Продолжаем лог с позиции {position['offset']}", flush=True)
+    elif position and find_rotated(position):
+        rotated = find_rotated(position)
+        print(f"[START] Лог ротирован, дочитываем {rotated} с позиции {position.get('offset', 0)}", flush=True)
+        with open(rotated, 'rb') as old:
+            old.seek(position.get('offset', 0))
+            catch_up(old)
+        f.seek(0)
+    else:
+        if position:
+            print("[START] Контрольная точка не подходит к логу (усечение/замена) — скан хвоста", flush=True)
+        tail_scan(f)
+    track_position(f)
+    return f
+
+def recover_state():
+    """Состояние после рестарта: снимок + журнал, позиция — контрольная точка или журнал"""
+    recovered, journal_offset = load_state()
+    sessions.clear()
+    sessions.update(recovered)
+    position = load_checkpoint()
+    if position is not None and journal_offset is not None:
+        position['offset'] = max(position.get('offset', 0), journal_offset)
+    if position is not None:
+        # Дочитывание ротированного файла в open_log может уплотнить журнал раньше,
+        # чем track_position откроет новый: позиция уже должна указывать на файл из точки
+        log_pos.update(dev=position.get('dev'), ino=position.get('ino'),
+                       offset=position.get('offset', 0), head=position.get('head') or '')
+    print(f"[START] Восстановлено сессий: {len(sessions)}", flush=True)
+    return position
+
+def parse_active_peers(out):
+    """Разбор вывода '/ip ipsec active-peers print detail': множество (user, outer_ip, inner_ip)"""
+    peers = set()
     cur_user = cur_outer = cur_inner = None
     for ln in out.splitlines():
         if 'l2tp-in-server' in ln:
@@ -174,56 +939,582 @@ def ssh_get_active_peers():
             cur_user = cur_outer = cur_inner = None
     return peers
 
-def sync_with_router():
-    print("[SYNC] Начинаем сверку с MikroTik...", flush=True)
-    active_peers = ssh_get_active_peers()
-    ssh_set = set(active_peers)
-    if active_peers is None:
-        print("[SYNC] Ошибка SSH, сверка пропущена!")
-        return
+class RouterClient:
+    """Долгоживущая SSH-сессия к одному роутеру: команда — новый канал в уже открытом
+    транспорте, без повторного рукопожатия. Обрыв — одно переподключение на команду."""
+
+    def __init__(self, host):
+        self.host = host
+        self.client = None
+
+    def connect(self):
+        transport = self.client.get_transport() if self.client is not None else None
+        if transport is not None and transport.is_active():
+            return self.client
+        self.close()
+        client = paramiko.SSHClient()
+        if os.path.exists(ROUTER_KNOWN_HOSTS):
+            try:
+                client.load_host_keys(ROUTER_KNOWN_HOSTS)
+            except Exception:
+                pass
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(hostname=self.host, username=ROUTER_SSH_USER, key_filename=ROUTER_SSH_KEY,
+                       timeout=10, banner_timeout=10, auth_timeout=10,
+                       allow_agent=False, look_for_keys=False)
+        client.get_transport().set_keepalive(30)
+        self.client = client
+        return client
+
+    def close(self):
+        if self.client is not None:
+            try:
+                self.client.close()
+            except Exception:
+                pass
+        self.client = None
+
+    def run(self, command, timeout):
+        if paramiko is None:
+            return self.run_subprocess(command, timeout)
+        for attempt in (1, 2):
+            try:
+                client = self.connect()
+                _stdin, stdout, _stderr = client.exec_command(command, timeout=timeout)
+                return stdout.read().decode('utf-8', 'ignore')
+            except Exception:
+                self.close()
+                if attempt == 2:
+                    raise
+
+    def run_subprocess(self, command, timeout):
+        ssh_command = [
+            "ssh",
+            "-q",
+            "-i", ROUTER_SSH_KEY,
+            "-o", "BatchMode=yes",
+            "-o", "StrictHostKeyChecking=no",
+            "-o", f"UserKnownHostsFile={ROUTER_KNOWN_HOSTS}",
+            "-o", "ConnectTimeout=10",
+            f"{ROUTER_SSH_USER}@{self.host}",
+            command
+        ]
+        result = subprocess.run(ssh_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.decode('utf-8', 'ignore').strip() or f"ssh rc={result.returncode}")
+        return result.stdout.decode('utf-8', 'ignore')
+
+router_clients = {}
+sync_executor = None
+# Незавершённый опрос по роутеру: брошенный по таймауту future продолжает работать
+# с тем же RouterClient, второй опрос в него не запускаем
+router_inflight = {}
+
+def ssh_get_active_peers(router):
+    """Активные пиры одного роутера: (множество, секунд на запрос); None — роутер недоступен"""
+    client = router_clients.setdefault(router, RouterClient(router))
+    t0 = time.monotonic()
+    try:
+        out = client.run('/ip ipsec active-peers print detail', SYNC_TIMEOUT)
+    except Exception as e:
+        print(f"[SSH ERROR] {router}: {e}")
+        return None, time.monotonic() - t0
+    return parse_active_peers(out), time.monotonic() - t0
 
-    local_set = set((v[0], v[1], v[2]) for v in sessions.values())
+def poll_routers():
+    """Опрашивает все роутеры параллельно (пул SYNC_WORKERS) и ждёт не дольше SYNC_TIMEOUT
+    сверх таймаута команды; не ответившие вовремя считаются недоступными."""
+    global sync_executor
+    if sync_executor is None:
+        sync_executor = ThreadPoolExecutor(max_workers=max(1, min(SYNC_WORKERS, len(IKE2MON_ROUTERS))),
+                                           thread_name_prefix='router-sync')
+    results = {}
+    futures = {}
+    for router in IKE2MON_ROUTERS:
+        previous = router_inflight.get(router)
+        if previous is not None and not previous.done():
+            print(f"[SYNC] {router}: прошлый опрос ещё не завершён, пропускаем", flush=True)
+            results[router] = (None, SYNC_TIMEOUT * 2 + 10)
+            continue
+        futures[sync_executor.submit(ssh_get_active_peers, router)] = router
+    router_inflight.update({router: fut for fut, router in futures.items()})
+    done, _ = futures_wait(futures, timeout=SYNC_TIMEOUT * 2 + 10)
+    for fut, router in futures.items():
+        if fut in done and fut.exception() is None:
+            results[router] = fut.result()
+        else:
+            results[router] = (None, SYNC_TIMEOUT * 2 + 10)
+    return results
+
+def apply_sync(results, started):
+    """Применяет результат опроса роутеров к sessions (в основном цикле, под sessions_lock).
+    started — time.monotonic() начала опроса: сессии, изменённые по логу позже, пропускаются,
+    их снимок пиров уже устарел."""
+    with sessions_lock:
+        applied = reconcile(results, started)
+        # Следующий опрос начнётся позже started — более старые отметки ему не нужны
+        for ip in [ip for ip, t in session_touched.items() if t < started]:
+            del session_touched[ip]
+    if applied:
+        compact_state()
+        print("[SYNC] Сверка завершена.", flush=True)
+
+def reconcile(results, started):
+    """Фантомы и новые сессии по снимку пиров; False — не ответил ни один роутер"""
+    failed = {r for r, (peers, _) in results.items() if peers is None}
+    if len(failed) == len(results):
+        print("[SYNC] Ошибка SSH на всех роутерах, сверка пропущена!")
+        for router, (_, latency) in results.items():
+            router_stats[router] = {'ok': False, 'latency_ms': int(latency * 1000), 'synced_at': current_timestamp()}
+        return False
 
-    # Удалить фантомные (которых нет на MikroTik)
+    # Каждый активный пир — с роутером, на котором он найден
+    remote = {}
+    for router, (peers, _) in results.items():
+        for triple in peers or ():
+            remote[triple] = router
+    drift = {r: {'phantoms': 0, 'added': 0} for r in results}
+
+    # Фантомы — сессии, которых нет ни на одном ответившем роутере. Если роутер сессии
+    # не ответил (или ещё не известен, а кто-то не ответил) — не трогаем.
     for k, v in list(sessions.items()):
         triple = (v[0], v[1], v[2])
-        if triple not in ssh_set:
-            print(f"[SYNC] Фантом: {triple}, удаляем.")
-            remove_session(k)
+        if triple in remote or session_touched.get(k, 0) >= started:
+            continue
+        router = v[4]
+        if (router and router in failed) or (not router and failed):
+            continue
+        print(f"[SYNC] Фантом: {triple} ({router or 'роутер неизвестен'}), удаляем.")
+        remove_session(k)
+        if router in drift:
+            drift[router]['phantoms'] += 1
 
-    # Добавить новые, если на MikroTik есть, а у нас нет
-    for triple in ssh_set:
-        if triple not in local_set:
-            print(f"[SYNC] Новая сессия: {triple}, добавляем.")
-            add_session(*triple)
+    # Новые (есть на роутере, нет у нас) и уточнение роутера у известных по логу
+    for triple, router in remote.items():
+        if session_touched.get(triple[2], 0) >= started:
+            continue
+        current = sessions.get(triple[2])
+        if current is not None and (current[0], current[1], current[2]) == triple:
+            if current[4] != router:
+                add_session(*triple, ts=current[3], router=router)
+            continue
+        print(f"[SYNC] Новая сессия: {triple} на {router}, добавляем.")
+        add_session(*triple, router=router)
+        drift[router]['added'] += 1
 
-    save_state()
-    print("[SYNC] Сверка завершена.", flush=True)
+    for router, (peers, latency) in results.items():
+        router_stats[router] = {
+            'ok': peers is not None,
+            'latency_ms': int(latency * 1000),
+            'peers': len(peers) if peers is not None else None,
+            'phantoms': drift[router]['phantoms'],
+            'added': drift[router]['added'],
+            'synced_at': current_timestamp(),
+        }
+        state = f"{len(peers)} пиров" if peers is not None else "недоступен"
+        print(f"[SYNC] {router}: {state}, {int(latency * 1000)} мс, "
+              f"фантомов {drift[router]['phantoms']}, новых {drift[router]['added']}", flush=True)
+    return True
+
+class RouterSync(threading.Thread):
+    """Сверка с роутерами в отдельном потоке: SSH-опрос (до SYNC_TIMEOUT * 2 + 10 с)
+    идёт здесь и не задерживает чтение лога. Результат передаётся основному циклу
+    через очередь, а wake_fd будит его ожидание inotify; применяет apply_pending."""
+
+    def __init__(self, interval):
+        super().__init__(name='router-sync', daemon=True)
+        self.interval = interval
+        self.results = queue.Queue(maxsize=1)
+        self.wake_fd, self._wake_w = os.pipe()
+        os.set_blocking(self.wake_fd, False)
+        os.set_blocking(self._wake_w, False)
+
+    def run(self):
+        while True:
+            started = time.monotonic()
+            print(f"[SYNC] Начинаем сверку с MikroTik ({len(IKE2MON_ROUTERS)} роутеров)...", flush=True)
+            try:
+                results = poll_routers()
+            except Exception as e:
+                print(f"[SYNC] Ошибка опроса роутеров: {e}", flush=True)
+                results = None
+            if results is not None:
+                # Основной цикл ещё не применил прошлый результат — ждём его, а не копим
+                self.results.put((results, started))
+                try:
+                    os.write(self._wake_w, b'\0')
+                except BlockingIOError:
+                    pass
+            time.sleep(max(0.0, self.interval - (time.monotonic() - started)))
+
+    def apply_pending(self):
+        try:
+            while os.read(self.wake_fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        try:
+            results, started = self.results.get_nowait()
+        except queue.Empty:
+            return
+        try:
+            apply_sync(results, started)
+        except Exception as e:
+            print(f"[SYNC] Ошибка применения сверки: {e}", flush=True)
+
+router_sync = None
+
+def log_replaced(file):
+    """LOG_FILE теперь другой файл (ротация) или открытый файл усечён"""
+    try:
+        st = os.stat(LOG_FILE)
+    except OSError:
+        return False  # новый файл ещё не создан — дочитываем старый
+    fst = os.fstat(file.fileno())
+    return (st.st_dev, st.st_ino) != (fst.st_dev, fst.st_ino) or fst.st_size < file.tell()
+
+class Inotify:
+    """Минимальная обёртка над inotify(7) через libc (только Linux)"""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = (ctypes.c_int, ctypes.c_int)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path, mask):
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._rm_watch(self.fd, wd)  # watch удалённого файла уже снят ядром — ошибку не проверяем
+
+    def wait(self, timeout, extra_fds=()):
+        """Ждёт события не дольше timeout (None — бессрочно); возвращает [(wd, mask, name)].
+        Готовность любого из extra_fds тоже прерывает ожидание."""
+        ready, _, _ = select.select([self.fd, *extra_fds], [], [], timeout)
+        if self.fd not in ready:
+            return []
+        data = b''
+        while True:
+            try:
+                part = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            if not part:
+                break
+            data += part
+        events = []
+        pos = 0
+        while pos + 16 <= len(data):
+            wd, mask, _cookie, size = struct.unpack_from('iIII', data, pos)
+            name = data[pos + 16:pos + 16 + size].rstrip(b'\0').decode('utf-8', 'replace')
+            events.append((wd, mask, name))
+            pos += 16 + size
+        return events
+
+class Scheduler:
+    """Периодические задачи основного цикла (уплотнение журнала).
+    follow() спит до ближайшего срока вместо проверки таймеров на каждой итерации."""
+
+    def __init__(self):
+        self.tasks = []
+
+    def every(self, interval, func, delay=None):
+        start = interval if delay is None else delay
+        self.tasks.append({'func': func, 'interval': interval, 'next': time.monotonic() + start})
+
+    def timeout(self):
+        if not self.tasks:
+            return None
+        return max(0.0, min(t['next'] for t in self.tasks) - time.monotonic())
+
+    def run_due(self):
+        for task in self.tasks:
+            if time.monotonic() < task['next']:
+                continue
+            try:
+                task['func']()
+            except Exception as e:
+                print(f"[SCHED] Ошибка задачи {task['func'].__name__}: {e}", flush=True)
+            task['next'] = time.monotonic() + task['interval']
+
+scheduler = Scheduler()
+watcher = {'inotify': None, 'dir_wd': None, 'failed': False}
+
+def get_inotify():
+    """Общий inotify и watch на каталог лога (появление нового файла после ротации)"""
+    if watcher['inotify'] is None and not watcher['failed']:
+        try:
+            ino = Inotify()
+            watcher['dir_wd'] = ino.add_watch(os.path.dirname(os.path.abspath(LOG_FILE)), IN_CREATE | IN_MOVED_TO)
+            watcher['inotify'] = ino
+        except Exception as e:
+            watcher['failed'] = True
+            print(f"[LOG] inotify недоступен ({e}), опрос раз в {LOG_POLL_INTERVAL} с", flush=True)
+    return watcher['inotify']
 
 def follow(file):
-    file.seek(0, 2)
-    t_last_sync = time.time()
-    while True:
-        line = file.readline()
-        if not line:
-            if time.time() - t_last_sync > SYNC_INTERVAL:
-                sync_with_router()
-                t_last_sync = time.time()
-            time.sleep(0.5)
+    """Читает лог, пока LOG_FILE не ротирован и не усечён, между чтениями выполняет
+    задачи планировщика и применяет готовую сверку с роутерами. Сон — до события
+    inotify (запись, переименование/удаление файла, новый файл в каталоге), результата
+    сверки или ближайшей задачи; без inotify — опрос."""
+    ino = get_inotify()
+    wd = None
+    if ino is not None:
+        try:
+            # /proc/self/fd — именно открытый inode, даже если имя уже указывает на новый файл
+            wd = ino.add_watch(f'/proc/self/fd/{file.fileno()}',
+                               IN_MODIFY | IN_ATTRIB | IN_MOVE_SELF | IN_DELETE_SELF)
+        except OSError as e:
+            print(f"[LOG] Не удалось поставить watch на лог: {e}", flush=True)
+    try:
+        while True:
+            catch_up(file)
+            if log_replaced(file):
+                print("[LOG] Лог ротирован или усечён, открываем заново", flush=True)
+                return
+            timeout = scheduler.timeout()
+            wake = (router_sync.wake_fd,) if router_sync is not None else ()
+            if wd is not None:
+                for _wd, mask, name in ino.wait(timeout, wake):
+                    if mask & (IN_MOVE_SELF | IN_DELETE_SELF):
+                        print("[LOG] Файл лога перемещён/удалён, ждём новый", flush=True)
+                    elif mask & IN_Q_OVERFLOW:
+                        print("[LOG] Переполнение очереди inotify", flush=True)
+            else:
+                select.select(wake, [], [], LOG_POLL_INTERVAL if timeout is None else min(timeout, LOG_POLL_INTERVAL))
+            if router_sync is not None:
+                router_sync.apply_pending()
+            scheduler.run_due()
+    finally:
+        if wd is not None:
+            ino.rm_watch(wd)
+
+def reopen_log(file):
+    """Открывает LOG_FILE заново после ротации, усечения или ошибки чтения, не теряя строк"""
+    if file is not None:
+        try:
+            catch_up(file)  # остаток прежнего файла
+        except Exception as e:
+            print(f"[LOG] Не удалось дочитать прежний файл: {e}")
+        file.close()
+    f = open(LOG_FILE, 'rb')
+    st = os.fstat(f.fileno())
+    if (st.st_dev, st.st_ino) == (log_pos['dev'], log_pos['ino']) and st.st_size >= log_pos['offset']:
+        f.seek(log_pos['offset'])  # тот же файл — продолжаем с места
+    else:
+        # Ротация или усечение: всё содержимое файла — новые события
+        print("[LOG] Новый файл лога, читаем с начала", flush=True)
+    track_position(f)
+    compact_state()
+    return f
+
+REPLAY_BATCH = 1000
+
+def open_replay_log(path):
+    return gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+
+def replay_existing(cursor, rows):
+    """Сессии пачки, уже лежащие в session_history: {(username, inner_ip): [time_start, ...]}"""
+    starts = [r[3] for r in rows]
+    cursor.execute(
+        "SELECT username, inner_ip, time_start FROM session_history "
+        "WHERE time_start BETWEEN %s - INTERVAL 1 SECOND AND %s + INTERVAL 1 SECOND",
+        (min(starts), max(starts))
+    )
+    existing = {}
+    for username, inner_ip, time_start in cursor.fetchall():
+        if time_start is not None:
+            existing.setdefault((username, inner_ip), []).append(time_start)
+    return existing
+
+def replay_insert(db, rows, rollups=True):
+    """Вставляет пачку восстановленных сессий, пропуская уже записанные.
+    Совпадение — тот же пользователь и inner_ip с началом в пределах секунды
+    (живой писатель хранит время с округлением). Возвращает (вставлено, дублей)."""
+    with rollup_lock(db, ROLLUP_REBUILD_WAIT, rollups):
+        return _replay_insert(db, rows, rollups)
+
+def _replay_insert(db, rows, rollups):
+    with db.cursor() as c:
+        existing = replay_existing(c, rows)
+        fresh = []
+        for row in rows:
+            start = datetime.datetime.strptime(row[3], '%Y-%m-%d %H:%M:%S')
+            known = existing.get((row[0], row[2]), ())
+            if any(abs((start - t).total_seconds()) <= 1 for t in known):
+                continue
+            fresh.append(row)
+            existing.setdefault((row[0], row[2]), []).append(start)
+        if fresh:
+            # INSERT IGNORE — на случай уникального ключа (username, inner_ip, time_start).
+            # В сводки идут только реально вставленные строки: если ключ отбросил часть
+            # пачки, она вставляется заново построчно, чтобы узнать, какие именно.
+            sql = HISTORY_INSERT_SQL.replace('INSERT INTO', 'INSERT IGNORE INTO', 1)
+            c.execute("SAVEPOINT replay_batch")
+            if c.executemany(sql, fresh) != len(fresh):
+                c.execute("ROLLBACK TO SAVEPOINT replay_batch")
+                fresh = [row for row in fresh if c.execute(sql, row)]
+            if rollups:
+                update_rollups(c, fresh)
+    db.commit()
+    return len(fresh), len(rows) - len(fresh)
+
+def replay(path, since=None, dry_run=False):
+    """Восстановление session_history по историческому логу на полной скорости.
+
+    Живое состояние (sessions, журнал, сокет, контрольная точка) не трогается: пары
+    acquired/releasing собираются в отдельном словаре, время — из строк лога.
+    Сессии без releasing к концу файла считаются активными и не пишутся.
+    since — datetime (события раньше пропускаются) или None."""
+    open_sessions = {}
+    counters = {'lines': 0, 'events': 0, 'undated': 0, 'sessions': 0, 'inserted': 0,
+                'duplicates': 0, 'lost_release': 0}
+    db = None if dry_run else pymysql.connect(**MYSQL_SETTINGS)
+    # Сводки только что созданы — пересчитаем целиком в конце, а не по пачкам
+    rebuild = ensure_rollups(db) if db is not None else False
+    batch = []
+
+    def flush():
+        if batch and db is not None:
+            inserted, dups = replay_insert(db, batch, rollups=not rebuild)
+            counters['inserted'] += inserted
+            counters['duplicates'] += dups
+        batch.clear()
+
+    t0 = time.monotonic()
+    size = 0
+    try:
+        with open_replay_log(path) as f:
+            for raw in f:
+                counters['lines'] += 1
+                size += len(raw)
+                if b'acquired' not in raw and b'releasing' not in raw:
+                    continue
+                line = raw.decode('utf-8', 'replace')
+                m = acquired_re.search(line)
+                r = None if m else releasing_re.search(line)
+                if not m and not r:
+                    continue
+                ts = parse_log_timestamp(line)
+                if ts is None:
+                    counters['undated'] += 1
+                    continue
+                if since is not None and parse_iso8601(ts) < since:
+                    continue
+                counters['events'] += 1
+                if m:
+                    inner_ip = m.group('inner_ip')
+                    username = (m.group('cn') or m.group('altname')).strip()
+                    if inner_ip in open_sessions:
+                        counters['lost_release'] += 1
+                    open_sessions[inner_ip] = (username, m.group('outer_ip'), inner_ip, ts)
+                    continue
+                started = open_sessions.pop(r.group('inner_ip').strip(), None)
+                if started is None:
+                    continue  # начало до --since или до начала файла
+                username, outer_ip, inner_ip, ts_start = started
+                duration = max(0, int((parse_iso8601(ts) - parse_iso8601(ts_start)).total_seconds()))
+                batch.append((username, outer_ip, inner_ip, mysql_datetime(ts_start), mysql_datetime(ts), duration))
+                counters['sessions'] += 1
+                if len(batch) >= REPLAY_BATCH:
+                    flush()
+        flush()
+        if rebuild:
+            rebuild_rollups(db)
+    finally:
+        if db is not None:
+            db.close()
+
+    elapsed = max(time.monotonic() - t0, 1e-6)
+    print(f"[REPLAY] {path}: строк {counters['lines']}, событий {counters['events']}, "
+          f"сессий {counters['sessions']}, записано {counters['inserted']}, дублей {counters['duplicates']}", flush=True)
+    print(f"[REPLAY] без времени {counters['undated']}, без releasing {counters['lost_release']}, "
+          f"открытых на конец файла {len(open_sessions)}", flush=True)
+    print(f"[REPLAY] {elapsed:.1f} с, {counters['lines'] / elapsed:,.0f} строк/с, "
+          f"{size / elapsed / 1024 / 1024:.1f} МБ/с", flush=True)
+    return counters
+
+SINCE_FORMATS = ('%Y-%m-%d', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M')
+
+def parse_since(value):
+    """--since: дата или дата и время (через T или пробел, секунды необязательны)"""
+    value = value.strip()
+    for fmt in SINCE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
             continue
-        process_line(line)
+    try:
+        return session_start(value)  # с долями секунды
+    except ValueError:
+        raise ArgumentTypeError(f"не понимаю время {value!r}: ожидается 2025-06-01, "
+                                f"2025-06-01T08:00:00 или '2025-06-01 08:00:00'")
 
 def main():
+    global router_sync
+    ap = ArgumentParser(description='Мониторинг IKEv2-сессий MikroTik')
+    ap.add_argument('--replay', metavar='LOGFILE', help='Разобрать исторический лог (можно .gz) и дописать session_history')
+    ap.add_argument('--since', metavar='TS', type=parse_since,
+                    help="Только события не раньше TS (2025-06-01, 2025-06-01T08:00:00 или '2025-06-01 08:00:00')")
+    ap.add_argument('--dry-run', action='store_true', help='С --replay: только подсчёт, без записи в MySQL')
+    ap.add_argument('--rebuild-rollups', action='store_true',
+                    help='Пересчитать сводные таблицы VPN из session_history (с --since — начиная с дня). '
+                         'Можно при работающем ike2mon: на время пересчёта берётся блокировка MySQL '
+                         f'{ROLLUP_LOCK_NAME}, писатель ждёт её или откладывает пачки в спил')
+    args = ap.parse_args()
+    if args.since and not (args.replay or args.rebuild_rollups):
+        ap.error('--since используется только с --replay или --rebuild-rollups')
+    if args.rebuild_rollups:
+        db = pymysql.connect(**MYSQL_SETTINGS)
+        with db:
+            ensure_rollups(db)
+            t0 = time.monotonic()
+            try:
+                daily, hourly = rebuild_rollups(db, args.since)
+            except RollupBusy as e:
+                print(f"[ROLLUP] Пересчёт не запущен: {e} (идёт другой пересчёт или --replay)", flush=True)
+                sys.exit(1)
+        print(f"[ROLLUP] Пересчитано за {time.monotonic() - t0:.1f} с: {daily} строк по дням, {hourly} по часам", flush=True)
+        return
+    if args.replay:
+        replay(args.replay, args.since, args.dry_run)
+        return
     print("Сервис стартовал", flush=True)
-    initial_scan()
-    sync_with_router()
+    service_stats['started_at'] = current_timestamp()
+    # SIGTERM (systemd stop) — через SystemExit, чтобы atexit успел сбросить очередь в спил
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    start_history_writer()
+    position = recover_state()
+    f = open_log(position)
+    # Строки, появившиеся после контрольной точки, — до сверки с роутером
+    catch_up(f)
+    compact_state()
+    start_state_server()
+    router_sync = RouterSync(SYNC_INTERVAL)
+    router_sync.start()
+    scheduler.every(JOURNAL_COMPACT_INTERVAL, maybe_compact)
     while True:
         try:
-            with open(LOG_FILE, 'r') as f:
-                follow(f)
+            follow(f)
+            f = reopen_log(f)
         except Exception as e:
             print(f"Ошибка: {e}")
             time.sleep(5)
+            try:
+                f = reopen_log(f)
+            except Exception as e2:
+                print(f"Ошибка открытия лога: {e2}")
+                f = None
 
 if __name__ == "__main__":
     main()
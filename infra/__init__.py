@@ -0,0 +1 @@
+# Infra shared package (общие модули веб-приложения и коллекторов)
@@ -0,0 +1,103 @@
+"""Общий загрузчик /etc/infra/config.json для веб-приложения и коллекторов.
+
+Файл читается и парсится один раз на процесс; дальше отдаётся неизменяемый
+снимок. Перечитывается только если у файла поменялись inode/mtime/size
+(проверка stat не чаще раза в CHECK_INTERVAL секунд).
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from types import MappingProxyType
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONFIG_PATH = '/etc/infra/config.json'
+CHECK_INTERVAL = 1.0
+
+
+def freeze(obj):
+    """Рекурсивно делает JSON-структуру неизменяемой (dict -> MappingProxyType, list -> tuple)"""
+    if isinstance(obj, dict):
+        return MappingProxyType({k: freeze(v) for k, v in obj.items()})
+    if isinstance(obj, list):
+        return tuple(freeze(v) for v in obj)
+    return obj
+
+
+def _file_signature(st):
+    return (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+class ConfigStore:
+    """Кэш одного конфигурационного файла с перечитыванием по изменению"""
+
+    def __init__(self, path, check_interval=CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._signature = None
+        self._checked_at = 0.0
+        self.version = 0
+
+    def get(self):
+        """Текущий снимок конфига. FileNotFoundError, если файла нет и снимка ещё не было."""
+        now = time.monotonic()
+        snapshot = self._snapshot
+        if snapshot is not None and now - self._checked_at < self.check_interval:
+            return snapshot
+        with self._lock:
+            if self._snapshot is not None and now - self._checked_at < self.check_interval:
+                return self._snapshot
+            self._checked_at = now
+            try:
+                st = os.stat(self.path)
+            except FileNotFoundError:
+                if self._snapshot is None:
+                    raise
+                # Файл временно исчез (замена редактором) — работаем на старом снимке
+                return self._snapshot
+            sig = _file_signature(st)
+            if sig != self._signature:
+                self._reload(sig)
+            return self._snapshot
+
+    def _reload(self, sig):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except ValueError as e:
+            if self._snapshot is None:
+                raise
+            # Файл дописывается прямо сейчас — остаёмся на прежнем снимке
+            logger.warning(f"Не удалось перечитать {self.path}: {e}")
+            return
+        self._snapshot = freeze(data)
+        self._signature = sig
+        self.version += 1
+        logger.debug(f"Конфиг {self.path} загружен (версия {self.version})")
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def default_config_path():
+    return os.environ.get('CONFIG_PATH', DEFAULT_CONFIG_PATH)
+
+
+def get_store(path=None):
+    path = path or default_config_path()
+    store = _stores.get(path)
+    if store is None:
+        with _stores_lock:
+            store = _stores.setdefault(path, ConfigStore(path))
+    return store
+
+
+def get_config(path=None):
+    """Неизменяемый снимок конфига для процесса (по умолчанию $CONFIG_PATH или /etc/infra/config.json)"""
+    return get_store(path).get()
@@ -0,0 +1,337 @@
+"""Долгоживущий канал PowerShell на Windows-сервере поверх одного SSH-соединения.
+
+На удалённой стороне запускается powershell с циклом чтения stdin: каждая команда —
+строка base64 от UTF-8 JSON {"id", "script", "input"}, ответ — строка
+"@@PSCH <base64 JSON>" с результатом скрипта (массив объектов, уже в JSON) или
+текстом ошибки. Рукопожатие SSH и запуск powershell оплачиваются один раз на процесс,
+дальше каждая команда стоит одного обмена строками.
+
+Потоковая команда (stream) отдаёт вывод по мере выполнения: строки копятся на сервере
+до ~chunk байт, каждая порция сжимается gzip и уходит отдельным ответом "chunk",
+конец — ответ "done". Память на обеих сторонах ограничена размером порции.
+
+Канал переподключается сам: если процесс ssh умер или команда не уложилась в таймаут,
+процесс убивается, а следующая команда поднимает новый.
+"""
+
+import atexit
+import base64
+import collections
+import gzip
+import json
+import logging
+import os
+import queue
+import subprocess
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+MARKER = '@@PSCH '
+CONNECT_TIMEOUT = 30
+COMMAND_TIMEOUT = 60
+JSON_DEPTH = 4
+STREAM_CHUNK = 64 * 1024   # символов вывода на одну сжатую порцию stream()
+
+DEFAULT_SSH_OPTIONS = (
+    '-o', 'BatchMode=yes',
+    '-o', 'StrictHostKeyChecking=no',
+    '-o', 'UserKnownHostsFile=/root/.ssh/known_hosts',
+    '-o', 'ConnectTimeout=10',
+    '-o', 'ServerAliveInterval=15',
+    '-o', 'ServerAliveCountMax=3',
+)
+
+# Короткоживущие коллекторы (cron) переиспользуют SSH-соединение между запусками.
+# Сокет — только в каталоге, куда не могут писать другие пользователи (ssh_config(5)):
+# иначе любой локальный пользователь займёт предсказуемый путь первым.
+CONTROL_DIR = '~/.ssh/pschannel'
+CONTROL_PERSIST = 600
+
+
+def control_options(directory=CONTROL_DIR):
+    """-o ControlMaster/ControlPath/ControlPersist для приватного каталога (0700, владелец —
+    текущий пользователь); каталог недоступен или чужой — без мультиплексирования"""
+    path = os.path.expanduser(directory)
+    try:
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        st = os.lstat(path)
+    except OSError as e:
+        logger.warning(f"PowerShell-канал: каталог {path} недоступен ({e}), без ControlMaster")
+        return ()
+    if st.st_uid != os.geteuid() or st.st_mode & 0o077 or not os.path.isdir(path) or os.path.islink(path):
+        logger.warning(f"PowerShell-канал: {path} не приватный каталог, без ControlMaster")
+        return ()
+    return ('-o', 'ControlMaster=auto',
+            '-o', f'ControlPath={os.path.join(path, "%C")}',
+            '-o', f'ControlPersist={CONTROL_PERSIST}')
+
+# Цикл на стороне Windows. Скрипт команды получает input первым аргументом (param($x)).
+# Write-Host и прочий вывод мимо маркера клиент пропускает. -ErrorAction Stop — только
+# у разбора/отправки кадров; скрипт команды выполняется с $ErrorActionPreference =
+# 'Continue', как при обычном запуске powershell: нетерминирующие ошибки его не прерывают.
+BOOTSTRAP = r"""
+$ProgressPreference = 'SilentlyContinue'
+[Console]::OutputEncoding = New-Object System.Text.UTF8Encoding($false)
+$utf8 = New-Object System.Text.UTF8Encoding($false)
+$reader = [Console]::In
+$writer = [Console]::Out
+function Send($obj) {
+    $text = ConvertTo-Json -InputObject $obj -Compress -ErrorAction Stop
+    $writer.WriteLine('@@PSCH ' + [Convert]::ToBase64String($utf8.GetBytes($text)))
+    $writer.Flush()
+}
+function SendChunk($id, $text) {
+    $ms = New-Object System.IO.MemoryStream
+    $gz = New-Object System.IO.Compression.GZipStream($ms, [System.IO.Compression.CompressionMode]::Compress)
+    $bytes = $utf8.GetBytes($text)
+    $gz.Write($bytes, 0, $bytes.Length)
+    $gz.Close()
+    Send @{ id = $id; ok = $true; chunk = [Convert]::ToBase64String($ms.ToArray()) }
+}
+function Invoke-Payload($script, $inputObject) {
+    $ErrorActionPreference = 'Continue'
+    & ([ScriptBlock]::Create($script)) $inputObject
+}
+Send @{ id = 0; ok = $true; json = '"ready"' }
+while ($true) {
+    $line = $reader.ReadLine()
+    if ($line -eq $null) { break }
+    if ($line.Trim() -eq '') { continue }
+    try {
+        $req = $utf8.GetString([Convert]::FromBase64String($line.Trim())) | ConvertFrom-Json -ErrorAction Stop
+    } catch {
+        continue  # испорченная строка запроса: ответить некому, клиент сработает по таймауту
+    }
+    try {
+        if ($req.stream) {
+            $buf = New-Object System.Text.StringBuilder
+            Invoke-Payload $req.script $req.input | ForEach-Object {
+                [void]$buf.Append([string]$_).Append("`n")
+                if ($buf.Length -ge $req.stream) { SendChunk $req.id $buf.ToString(); [void]$buf.Clear() }
+            }
+            if ($buf.Length) { SendChunk $req.id $buf.ToString() }
+            Send @{ id = $req.id; ok = $true; done = $true }
+            continue
+        }
+        $out = Invoke-Payload $req.script $req.input
+        Send @{ id = $req.id; ok = $true; json = (ConvertTo-Json -InputObject @($out) -Depth $req.depth -Compress -ErrorAction Stop) }
+    } catch {
+        Send @{ id = $req.id; ok = $false; error = ($_ | Out-String).Trim() }
+    }
+}
+"""
+
+
+class PowerShellError(RuntimeError):
+    """Скрипт на удалённой стороне завершился ошибкой или канал недоступен"""
+
+
+class ChannelClosed(PowerShellError):
+    """Процесс ssh/powershell завершился — команду можно повторить на новом канале"""
+
+
+def _encoded_command(script):
+    return base64.b64encode(script.encode('utf-16-le')).decode('ascii')
+
+
+class PowerShellChannel:
+    """Один процесс ssh + powershell на (host, user, key); команды выполняются по очереди"""
+
+    def __init__(self, host, user, key_file, ssh_options=DEFAULT_SSH_OPTIONS,
+                 connect_timeout=CONNECT_TIMEOUT, command_timeout=COMMAND_TIMEOUT):
+        self.host = host
+        self.user = user
+        self.key_file = key_file
+        self.ssh_options = tuple(ssh_options)
+        self.connect_timeout = connect_timeout
+        self.command_timeout = command_timeout
+        self._lock = threading.Lock()
+        self._proc = None
+        self._lines = None
+        self._stderr = collections.deque(maxlen=50)
+        self._next_id = 1
+        self.stats = {'connects': 0, 'commands': 0, 'errors': 0, 'timeouts': 0}
+
+    # --- процесс ---
+
+    def _command(self):
+        return ['ssh', '-T', '-i', self.key_file, *self.ssh_options, *control_options(),
+                f'{self.user}@{self.host}',
+                'powershell -NoLogo -NoProfile -NonInteractive -EncodedCommand ' + _encoded_command(BOOTSTRAP)]
+
+    def _alive(self):
+        return self._proc is not None and self._proc.poll() is None
+
+    def _start(self):
+        self._stop()
+        proc = subprocess.Popen(self._command(), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, bufsize=0)
+        lines = queue.Queue()
+        threading.Thread(target=self._pump_stdout, args=(proc, lines), name='pschannel-out', daemon=True).start()
+        threading.Thread(target=self._pump_stderr, args=(proc,), name='pschannel-err', daemon=True).start()
+        self._proc, self._lines = proc, lines
+        self.stats['connects'] += 1
+        t0 = time.monotonic()
+        self._receive(0, self.connect_timeout)
+        logger.info(f"PowerShell-канал {self.user}@{self.host} открыт за {time.monotonic() - t0:.2f} с")
+
+    def _stop(self):
+        proc, self._proc = self._proc, None
+        if proc is None:
+            return
+        try:
+            proc.stdin.close()
+        except Exception:
+            pass
+        try:
+            proc.wait(timeout=2)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+    def _pump_stdout(self, proc, lines):
+        for raw in proc.stdout:
+            line = raw.decode('ascii', 'replace').strip()
+            if line.startswith(MARKER):
+                lines.put(line[len(MARKER):])
+        lines.put(None)  # EOF: процесс завершился
+
+    def _pump_stderr(self, proc):
+        for raw in proc.stderr:
+            self._stderr.append(raw.decode('utf-8', 'replace').rstrip())
+
+    def _receive(self, request_id, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.stats['timeouts'] += 1
+                self._stop()
+                raise PowerShellError(f"{self.host}: нет ответа за {timeout:.0f} с")
+            try:
+                payload = self._lines.get(timeout=remaining)
+            except queue.Empty:
+                continue
+            if payload is None:
+                self._stop()
+                err = '; '.join(self._stderr) or 'процесс ssh завершился'
+                raise ChannelClosed(f"{self.host}: канал закрыт ({err})")
+            resp = json.loads(base64.b64decode(payload).decode('utf-8'))
+            if resp.get('id') != request_id:
+                continue  # ответ на команду, которую мы уже бросили по таймауту
+            return resp
+
+    # --- команды ---
+
+    def call(self, script, input=None, timeout=None, depth=JSON_DEPTH):
+        """Выполняет script (тело ScriptBlock; input доступен как param($x) / $args[0]).
+        Возвращает список объектов вывода. Обрыв канала — одна повторная попытка на новом;
+        ошибка скрипта и таймаут не повторяются."""
+        with self._lock:
+            for attempt in (1, 2):
+                try:
+                    if not self._alive():
+                        self._start()
+                    return self._call(script, input, timeout or self.command_timeout, depth)
+                except (OSError, ChannelClosed) as e:
+                    self._stop()
+                    if attempt == 2:
+                        self.stats['errors'] += 1
+                        raise e if isinstance(e, PowerShellError) else ChannelClosed(f"{self.host}: {e}")
+                    logger.warning(f"PowerShell-канал: {e}, переподключаемся")
+                except PowerShellError:
+                    self.stats['errors'] += 1
+                    raise
+
+    def _send(self, script, input, depth=JSON_DEPTH, stream=None):
+        request_id = self._next_id
+        self._next_id += 1
+        request = {'id': request_id, 'script': script, 'input': input, 'depth': depth, 'stream': stream}
+        line = base64.b64encode(json.dumps(request, ensure_ascii=False).encode('utf-8')) + b'\n'
+        self._proc.stdin.write(line)
+        self._proc.stdin.flush()
+        self.stats['commands'] += 1
+        return request_id
+
+    def _call(self, script, input, timeout, depth):
+        request_id = self._send(script, input, depth)
+        resp = self._receive(request_id, timeout)
+        if not resp.get('ok'):
+            raise PowerShellError(resp.get('error') or 'ошибка PowerShell')
+        result = json.loads(resp.get('json') or '[]')
+        return result if isinstance(result, list) else [result]
+
+    def stream(self, script, input=None, timeout=None, chunk=STREAM_CHUNK):
+        """Выполняет script и отдаёт его вывод построчно (каждый объект вывода — [string],
+        генератор), не дожидаясь конца команды. timeout — на всю команду. Обрыв канала до
+        первой порции — одна повторная попытка; после — ChannelClosed (часть строк уже
+        отдана). Канал занят, пока генератор не исчерпан или не закрыт: вызывать другие
+        команды этого канала из цикла по нему нельзя."""
+        timeout = timeout or self.command_timeout
+        with self._lock:
+            deadline = time.monotonic() + timeout
+            started = False
+            for attempt in (1, 2):
+                try:
+                    if not self._alive():
+                        self._start()
+                    request_id = self._send(script, input, stream=chunk)
+                    while True:
+                        resp = self._receive(request_id, deadline - time.monotonic())
+                        if not resp.get('ok'):
+                            self.stats['errors'] += 1
+                            raise PowerShellError(resp.get('error') or 'ошибка PowerShell')
+                        if resp.get('done'):
+                            return
+                        text = gzip.decompress(base64.b64decode(resp['chunk'])).decode('utf-8')
+                        started = True
+                        for line in text.split('\n'):
+                            if line:
+                                yield line
+                except (OSError, ChannelClosed) as e:
+                    self._stop()
+                    if started or attempt == 2:
+                        self.stats['errors'] += 1
+                        raise e if isinstance(e, PowerShellError) else ChannelClosed(f"{self.host}: {e}")
+                    logger.warning(f"PowerShell-канал: {e}, переподключаемся")
+
+    def read_text(self, path, timeout=None):
+        """Содержимое текстового файла (UTF-8, BOM снимается).
+        ReadAllText, а не Get-Content: в Windows PowerShell 5.1 строка от Get-Content несёт
+        свойства PSPath/PSDrive, и ConvertTo-Json превращает её в объект."""
+        out = self.call("param($p) [System.IO.File]::ReadAllText($p, [System.Text.Encoding]::UTF8)",
+                        path, timeout)
+        if len(out) != 1 or not isinstance(out[0], str):
+            raise PowerShellError(f"{self.host}: {path}: в ответе не строка")
+        return out[0]
+
+    def close(self):
+        with self._lock:
+            self._stop()
+
+
+_channels = {}
+_channels_lock = threading.Lock()
+
+
+def get_channel(host, user, key_file, **kwargs):
+    """Общий канал процесса для (host, user, key_file)"""
+    key = (host, user, key_file)
+    channel = _channels.get(key)
+    if channel is None:
+        with _channels_lock:
+            channel = _channels.get(key)
+            if channel is None:
+                channel = _channels[key] = PowerShellChannel(host, user, key_file, **kwargs)
+    return channel
+
+
+@atexit.register
+def close_all():
+    for channel in list(_channels.values()):
+        try:
+            channel.close()
+        except Exception:
+            pass
@@ -1,11 +1,18 @@
 #!/usr/bin/env python3
-import subprocess
+import os
+import sys
 import json
 import re
 import pymysql
 import csv
 from datetime import datetime
 
+# Общие модули проекта (infra/): рядом со скриптом или в каталоге установки веб-приложения
+for _p in (os.environ.get('MONITORING_HOME', '/opt/monitoring-web'), os.path.dirname(os.path.realpath(__file__))):
+    if _p not in sys.path:
+        sys.path.insert(0, _p)
+from infra.pschannel import get_channel
+
 CONFIG_PATH = "/etc/rdpmon/config.json"
 
 def parse_win_date(datestr):
@@ -20,22 +27,23 @@ def load_config():
         return json.load(f)
 
 def fetch_events(ssh_host, ssh_user, ssh_key_path):
-    cmd = [
-        "ssh", "-i", ssh_key_path,
-        f"{ssh_user}@{ssh_host}",
-        "powershell -File C:\\Scripts\\extract_rdp_events.ps1"
-    ]
-    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out = result.stdout.decode("utf-8", errors="ignore")
-    if result.returncode != 0:
+    # Скрипт выполняется в PowerShell-канале: без отдельного запуска powershell на вызов
+    channel = get_channel(ssh_host, ssh_user, ssh_key_path)
+    try:
+        out = channel.call("& 'C:\\Scripts\\extract_rdp_events.ps1'", timeout=600)
+    except Exception as e:
         print("❌ Ошибка получения логов по SSH:")
-        print(result.stderr.decode("utf-8", errors="ignore"))
+        print(e)
         exit(1)
+    # Скрипт печатает JSON текстом; если он отдаёт объекты — они уже разобраны каналом
+    if not all(isinstance(x, str) for x in out):
+        return out
+    text = "\n".join(out)
     try:
-        return json.loads(out)
+        return json.loads(text)
     except Exception as e:
         print("❌ Ошибка парсинга JSON:", e)
-        print("Фрагмент вывода:\n", out[:1000])
+        print("Фрагмент вывода:\n", text[:1000])
         exit(1)
 
 def extract_sessions(events):
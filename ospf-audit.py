@@ -23,13 +23,18 @@ import ipaddress
 from typing import Dict, List, Tuple, Set, Optional, Any
 from argparse import ArgumentParser
 
+# Общие модули проекта (infra/): рядом со скриптом или в каталоге установки веб-приложения
+for _p in (os.environ.get('MONITORING_HOME', '/opt/monitoring-web'), os.path.dirname(os.path.realpath(__file__))):
+    if _p not in sys.path:
+        sys.path.insert(0, _p)
+from infra.config import get_config
+
 CONFIG_PATH = '/etc/infra/config.json'
 
 # === Базовые утилиты из sync-lists.py ===
 
 def load_config() -> dict:
-    with open(CONFIG_PATH, 'r', encoding='utf-8') as f:
-        return json.load(f)
+    return get_config(CONFIG_PATH)
 
 
 def load_map(map_file: str) -> Dict[str, str]:
@@ -1,11 +1,17 @@
 #!/usr/bin/env python3
 import os
-import subprocess
+import sys
 import json
 import pymysql
 import csv
 from datetime import datetime
 
+# Общие модули проекта (infra/): рядом со скриптом или в каталоге установки веб-приложения
+for _p in (os.environ.get('MONITORING_HOME', '/opt/monitoring-web'), os.path.dirname(os.path.realpath(__file__))):
+    if _p not in sys.path:
+        sys.path.insert(0, _p)
+from infra.pschannel import get_channel
+
 
 CONFIG_PATH = "/etc/rdpmon/config.json"
 
@@ -14,15 +20,22 @@ def load_config():
         return json.load(f)
 
 def fetch_file(config):
-    scp_cmd = [
-        "scp", "-i", config["ssh"]["key_path"],
-        f'{config["ssh"]["user"]}@{config["ssh"]["host"]}:{config["ssh"]["remote_json"]}',
-        config["local_json"]
-    ]
-    result = subprocess.run(scp_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if result.returncode != 0:
-        print("❌ Ошибка SCP:", result.stderr.decode())
+    # Файл читается через PowerShell-канал и подменяется атомарно (tmp + rename)
+    ssh = config["ssh"]
+    channel = get_channel(ssh["host"], ssh["user"], ssh["key_path"])
+    try:
+        text = channel.read_text(ssh["remote_json"], timeout=60)
+    except Exception as e:
+        print("❌ Ошибка получения файла сессий:", e)
+        return False
+    if not text.strip():
+        # Последний нормальный файл не затираем пустым
+        print("❌ Файл сессий пуст:", ssh["remote_json"])
         return False
+    tmp = config["local_json"] + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, config["local_json"])
     return True
 
 
@@ -224,7 +237,7 @@ def fetch_sessions(config, retries=6, delay=5):
 
 def main():
     config = load_config()
-    print(f"[{datetime.now()}] ⏳ Получаем файл сессий по SCP...")
+    print(f"[{datetime.now()}] ⏳ Получаем файл сессий по SSH...")
     if not fetch_file(config):
         return
     sessions = fetch_sessions(config)
@@ -47,7 +47,10 @@ for host in "${ROUTERS[@]}"; do
 done
 
 sort -u "$TMP_MAP" > "$MAP_FILE"
-sort -u "$TMP_CSV" > "$FULL_FILE"
+# Атомарная замена: веб-воркеры кэшируют карту по mtime/размеру и не должны
+# увидеть наполовину записанный файл; снимок <карта>.pickle они пересоберут сами
+sort -u "$TMP_CSV" > "$FULL_FILE.tmp"
+mv -f "$FULL_FILE.tmp" "$FULL_FILE"
 
 echo "✓ $(wc -l <"$MAP_FILE") IP-строк → $MAP_FILE"
 echo "✓ $(wc -l <"$FULL_FILE") строк  → $FULL_FILE"
@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import fcntl
 import json
 import logging
-import subprocess
+import random
+import signal
+import threading
+import time
 from datetime import datetime, timedelta
 from pathlib import Path
 from typing import Dict, List, Optional
@@ -11,13 +15,20 @@ import pymysql
 import os
 import sys
 import re
+from argparse import ArgumentParser
 from collections import defaultdict
 
+# Общие модули проекта (infra/): рядом со скриптом или в каталоге установки веб-приложения
+for _p in (os.environ.get('MONITORING_HOME', '/opt/monitoring-web'), os.path.dirname(os.path.realpath(__file__))):
+    if _p not in sys.path:
+        sys.path.insert(0, _p)
+from infra.config import get_config
+from infra.pschannel import get_channel
+
 CONFIG_PATH = "/etc/infra/config.json"
 
 def load_config() -> Dict:
-    with open(CONFIG_PATH, "r", encoding="utf-8") as f:
-        return json.load(f)
+    return get_config(CONFIG_PATH)
 
 def get_smbstat_connection(cfg):
     db = cfg["mysql"]["smbstat"]
@@ -43,6 +54,38 @@ def get_rdp_connection(cfg):
         autocommit=True
     )
 
+class Connections:
+    """Соединения демона с smbstat и rdpstat: открываются при первом обращении и
+    живут между циклами; перед выдачей проверяются ping(reconnect=True)."""
+
+    factories = {'smbstat': get_smbstat_connection, 'rdpstat': get_rdp_connection}
+
+    def __init__(self):
+        self.conns = {}
+
+    def get(self, cfg, name):
+        conn = self.conns.get(name)
+        if conn is not None:
+            try:
+                conn.ping(reconnect=True)
+                return conn
+            except Exception:
+                self.drop(name)
+        conn = self.conns[name] = self.factories[name](cfg)
+        return conn
+
+    def drop(self, name):
+        conn = self.conns.pop(name, None)
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def close(self):
+        for name in list(self.conns):
+            self.drop(name)
+
 def setup_logging(cfg):
     log_dir = cfg["paths"]["smbmon_log_dir"]
     log_file = cfg["paths"]["smbmon_log_file"]
@@ -87,14 +130,14 @@ def merge_intervals(intervals):
             merged.append((st, en))
     return merged
 
-def load_rdp_intervals(cfg, candidate_users: List[str]):
+def load_rdp_intervals(cfg, candidate_users: List[str], conns: Optional[Connections] = None):
     result = defaultdict(list)
     if not candidate_users:
         return result
     uniq = sorted(set(candidate_users))
     fmt = ",".join(["%s"] * len(uniq))
     try:
-        conn = get_rdp_connection(cfg)
+        conn = conns.get(cfg, 'rdpstat') if conns else get_rdp_connection(cfg)
     except Exception as e:
         log_debug(f"RDP connect failed: {e}")
         return result
@@ -127,9 +170,12 @@ def load_rdp_intervals(cfg, candidate_users: List[str]):
             result[u] = merge_intervals(result[u])
     except Exception as e:
         log_debug(f"Ошибка загрузки RDP интервалов: {e}")
+        if conns:
+            conns.drop('rdpstat')
         return defaultdict(list)
     finally:
-        conn.close()
+        if not conns:
+            conn.close()
     return result
 
 def ts_in_intervals(ts: datetime, intervals) -> bool:
@@ -141,69 +187,63 @@ def ts_in_intervals(ts: datetime, intervals) -> bool:
             return True
     return False
 
-def get_open_files(cfg) -> List[Dict]:
+def smb_channel(cfg):
+    """Общий на процесс PowerShell-канал к SMB-серверу (одно SSH-соединение на все запросы)"""
     ssh_cfg = cfg["remote_host"]["smb_server"]
-    ssh_host = ssh_cfg["ssh_host"]
-    ssh_user = ssh_cfg["ssh_user"]
-    ssh_key = ssh_cfg["ssh_key"]
-
-    monitored_ext = cfg["monitored_extensions"]
-    ext_re = '|'.join([e.lstrip('.') for e in monitored_ext])
-
-    ps_command = (
-        "powershell -NoLogo -NoProfile -Command "
-        "\"[Console]::OutputEncoding = [System.Text.Encoding]::UTF8; "
-        "$files = Get-SmbOpenFile | "
-        f"Where-Object {{ $_.Path.ToLower() -match '\\.({ext_re})$' -and -not ($_.Path -like '*\\~$*') }}; "
-        "$files | ForEach-Object { "
-        "   $size = $null; "
-        "   try { $size = (Get-Item $_.Path).Length } catch {} "
-        "   [PSCustomObject]@{ "
-        "       ClientUserName = $_.ClientUserName; "
-        "       Path = $_.Path; "
-        "       ClientComputerName = $_.ClientComputerName; "
-        "       SessionId = $_.SessionId; "
-        "       Length = $size "
-        "   } "
-        "} | ConvertTo-Json -Compress\""
-    )
-
-    ssh_cmd = [
-        "ssh",
-        "-q",
-        "-o", "StrictHostKeyChecking=no",
-        "-o", "UserKnownHostsFile=/root/.ssh/known_hosts",
-        "-i", ssh_key,
-        f"{ssh_user}@{ssh_host}",
-        ps_command
-    ]
-
-    log_debug(f"SSH CMD: {' '.join(ssh_cmd)}")
-    result = subprocess.run(
-        ssh_cmd,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        timeout=60
-    )
-    try:
-        output = result.stdout.decode('utf-8').strip()
-    except UnicodeDecodeError:
-        output = result.stdout.decode('cp1251', errors='replace').strip()
-
-    if result.returncode != 0:
-        try:
-            err = result.stderr.decode('utf-8')
-        except UnicodeDecodeError:
-            err = result.stderr.decode('cp1251', errors='replace')
-        log_debug(f"SSH ERROR: {err}")
-        raise RuntimeError(f"Ошибка SSH:\n{err}")
-
-    log_debug("STDOUT:\n" + output)
-    if output.startswith("["):
-        return json.loads(output)
-    elif output:
-        return [json.loads(output)]
-    return []
+    return get_channel(ssh_cfg["ssh_host"], ssh_cfg["ssh_user"], ssh_cfg["ssh_key"])
+
+# Сколько байт сырого вывода Get-SmbOpenFile попадает в лог (debug-образец)
+LOG_SAMPLE_BYTES = 2048
+
+# Фильтр по расширениям и exclude_path_regex выполняется на сервере; каждый файл —
+# одна строка JSON (NDJSON), канал передаёт их сжатыми порциями по мере выполнения.
+OPEN_FILES_PS_SCRIPT = r"""
+param($exclude)
+$re = $null
+if ($exclude) { $re = New-Object System.Text.RegularExpressions.Regex($exclude) }
+Get-SmbOpenFile |
+    Where-Object { $_.Path.ToLower() -match '\.(@@EXT@@)$' -and -not ($_.Path -like '*\~$*') -and -not ($re -and $re.IsMatch($_.Path)) } |
+    ForEach-Object {
+        $size = $null
+        try { $size = (Get-Item -LiteralPath $_.Path -ErrorAction Stop).Length } catch {}
+        ConvertTo-Json -Compress -InputObject ([PSCustomObject]@{
+            ClientUserName = $_.ClientUserName
+            Path = $_.Path
+            ClientComputerName = $_.ClientComputerName
+            SessionId = $_.SessionId
+            Length = $size
+        })
+    }
+"""
+
+def iter_open_files(cfg, pattern=None):
+    """Открытые файлы с SMB-сервера по одной записи: NDJSON приходит gzip-порциями
+    (PowerShellChannel.stream) и разбирается по мере получения, весь вывод целиком
+    не собирается ни на сервере, ни здесь. pattern — тот же exclude_path_regex,
+    повторно применяется локально на случай расхождений .NET- и Python-регулярок."""
+    ext_re = '|'.join([re.escape(e.lstrip('.')) for e in cfg["monitored_extensions"]])
+    ps_script = OPEN_FILES_PS_SCRIPT.replace('@@EXT@@', ext_re)
+    exclude = pattern.pattern if pattern else None
+
+    sample = []
+    sample_len = 0
+    total = 0
+    for line in smb_channel(cfg).stream(ps_script, exclude, timeout=60):
+        total += len(line) + 1
+        if sample_len < LOG_SAMPLE_BYTES:
+            sample.append(line[:LOG_SAMPLE_BYTES - sample_len])
+            sample_len += len(line) + 1
+        rec = json.loads(line)
+        if pattern and pattern.search(rec["Path"]):
+            continue
+        yield rec
+    log_debug(f"Get-SmbOpenFile: {total} символов NDJSON")
+    if sample:
+        more = ' ...' if sample_len > LOG_SAMPLE_BYTES else ''
+        log_debug("Образец вывода:\n" + '\n'.join(sample) + more)
+
+def get_open_files(cfg, pattern=None) -> List[Dict]:
+    return list(iter_open_files(cfg, pattern))
 
 def now() -> datetime:
     return datetime.now().replace(microsecond=0)
@@ -235,125 +275,241 @@ def get_or_create_id(cur, table, value, col='path', ext_insert=None):
     log_debug(f"Inserted new id={new_id} for {value} in {table}")
     return new_id
 
-def get_file_size_ssh(cfg, path):
-    ssh_cfg = cfg["remote_host"]["smb_server"]
-    ssh_host = ssh_cfg["ssh_host"]
-    ssh_user = ssh_cfg["ssh_user"]
-    ssh_key = ssh_cfg["ssh_key"]
-    ps_cmd = f"(Get-Item -LiteralPath '{path}').Length"
-    ssh_cmd = [
-        "ssh", "-q",
-        "-o", "StrictHostKeyChecking=no",
-        "-o", "UserKnownHostsFile=/root/.ssh/known_hosts",
-        "-i", ssh_key,
-        f"{ssh_user}@{ssh_host}",
-        f"powershell -NoLogo -NoProfile -Command \"{ps_cmd}\""
-    ]
-    result = subprocess.run(ssh_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=15)
-    output = result.stdout.decode('utf-8', errors='replace').strip()
-    if result.returncode == 0 and output.isdigit():
-        return int(output)
-    else:
-        print(f"[ERROR] Не удалось получить размер для {path}: {output}")
-        return None
+# Справочники: таблица -> (колонка значения, INSERT для недостающих)
+DIMENSIONS = {
+    'smb_files': ('path', "INSERT IGNORE INTO smb_files (path, norm_path) VALUES (%s, %s)"),
+    'smb_users': ('username', "INSERT IGNORE INTO smb_users (username) VALUES (%s)"),
+    'smb_clients': ('host', "INSERT IGNORE INTO smb_clients (host) VALUES (%s)"),
+}
+IN_CHUNK = 500  # значений в одном IN (...) — держим запрос в разумных пределах
+
+def chunks(seq, size=IN_CHUNK):
+    seq = list(seq)
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+def select_ids(cur, table, col, values, found):
+    """Дополняет found {значение: id} для values одним IN-запросом на пачку.
+    Сравнение в MySQL регистронезависимое (utf8mb4_unicode_ci), поэтому сопоставляем и без учёта регистра."""
+    for part in chunks(values):
+        cur.execute(f"SELECT id, {col} FROM {table} WHERE {col} IN ({','.join(['%s'] * len(part))})", part)
+        rows = {r[col]: r['id'] for r in cur.fetchall()}
+        folded = {k.lower(): v for k, v in rows.items()}
+        for v in part:
+            if v in rows:
+                found[v] = rows[v]
+            elif v.lower() in folded:
+                found[v] = folded[v.lower()]
+
+def resolve_ids(cur, table, values) -> Dict[str, int]:
+    """id справочника для всех values: выборка пачками, недостающие — одним executemany и повторная выборка.
+    То, что не сопоставилось (особенности сравнения в MySQL), добираем get_or_create_id."""
+    col, insert_sql = DIMENSIONS[table]
+    values = sorted({v for v in values if v is not None})
+    found: Dict[str, int] = {}
+    select_ids(cur, table, col, values, found)
+    missing = [v for v in values if v not in found]
+    if missing:
+        if table == 'smb_files':
+            cur.executemany(insert_sql, [(v, norm_path(v)) for v in missing])
+        else:
+            cur.executemany(insert_sql, [(v,) for v in missing])
+        select_ids(cur, table, col, missing, found)
+        for v in missing:
+            if v not in found:
+                found[v] = get_or_create_id(cur, table, v, col)
+        log_debug(f"{table}: новых записей {len(missing)}")
+    return found
+
+# Пакетный запрос размеров: список путей уходит входом команды PowerShell-канала,
+# ответ — массив объектов по путям
+SIZE_BATCH = 200
+SIZE_TIMEOUT = 60
+SIZE_PS_SCRIPT = (
+    "param($paths) "
+    "foreach ($p in $paths) { "
+    "   $i = Get-Item -LiteralPath $p -ErrorAction SilentlyContinue; "
+    "   if ($i) { [PSCustomObject]@{ Path = $p; Exists = $true; Length = $i.Length; "
+    "             MTime = [int64](($i.LastWriteTimeUtc - [datetime]'1970-01-01').TotalSeconds) } } "
+    "   else { [PSCustomObject]@{ Path = $p; Exists = $false; Length = $null; MTime = $null } } "
+    "}"
+)
+
+def get_file_sizes_ssh(cfg, paths) -> Dict[str, Dict]:
+    """Размеры файлов на SMB-сервере: одна команда PowerShell-канала на пачку до smbmon.size_batch путей.
+    Возвращает {путь: {'exists', 'size', 'mtime'}}; пути из неудавшейся пачки в ответ не попадают."""
+    opts = cfg.get("smbmon", {})
+    batch_size = int(opts.get("size_batch", SIZE_BATCH))
+    timeout = float(opts.get("size_timeout", SIZE_TIMEOUT))
+    channel = smb_channel(cfg)
+    result_map: Dict[str, Dict] = {}
+    for part in chunks(sorted({p for p in paths if p}), batch_size):
+        try:
+            items = channel.call(SIZE_PS_SCRIPT, part, timeout=timeout)
+        except Exception as e:
+            print(f"[ERROR] Не удалось получить размеры для {len(part)} файлов: {e}")
+            continue
+        for it in items:
+            result_map[it.get("Path")] = {
+                'exists': bool(it.get("Exists")),
+                'size': it.get("Length"),
+                'mtime': it.get("MTime"),
+            }
+    log_debug(f"Размеры файлов: запрошено {len(set(paths))}, получено {len(result_map)}")
+    return result_map
 
-def process_sessions(cfg, open_files):
+def get_file_size_ssh(cfg, path):
+    info = get_file_sizes_ssh(cfg, [path]).get(path)
+    if info and info['exists'] and info['size'] is not None:
+        return int(info['size'])
+    print(f"[ERROR] Не удалось получить размер для {path}")
+    return None
+
+def process_sessions(cfg, open_files, conns: Optional[Connections] = None):
+    """Один цикл сверки открытых файлов с active_smb_sessions — одной транзакцией.
+
+    Справочники (файлы, пользователи, клиенты) разрешаются пачками IN-запросов,
+    недостающие вставляются executemany; last_seen обновляется одним UPDATE,
+    новые сессии и переносы в историю — пакетными запросами."""
     now_ts = now()
     added = {}
     closed = {}
 
-    conn = get_smbstat_connection(cfg)
+    conn = conns.get(cfg, 'smbstat') if conns else get_smbstat_connection(cfg)
+    conn.autocommit(False)
     cur = conn.cursor(pymysql.cursors.DictCursor)
-
-    cur.execute("SELECT * FROM active_smb_sessions")
-    db_sessions = {(r["file_id"], r["user_id"], r["client_id"], r["session_id"]): r for r in cur.fetchall()}
-    seen_keys = set()
-
-    smb_usernames_current = set()
-    for entry in open_files:
-        smb_usernames_current.add(normalize_user(entry["ClientUserName"]))
-    if db_sessions:
-        cur.execute("SELECT id, username FROM smb_users WHERE id IN %s" %
-                    "(" + ",".join({str(r["user_id"]) for r in db_sessions.values()}) + ")")
-        for rr in cur.fetchall():
-            smb_usernames_current.add(normalize_user(rr["username"]))
-
-    rdp_map = load_rdp_intervals(cfg, list(smb_usernames_current))
-
-    for entry in open_files:
-        raw_path = entry["Path"]
-        user = entry["ClientUserName"]
-        host = entry["ClientComputerName"]
-        session_id = str(entry["SessionId"])
-
-        file_id = get_or_create_id(cur, 'smb_files', raw_path, 'path')
-        user_id = get_or_create_id(cur, 'smb_users', user, 'username')
-        client_id = get_or_create_id(cur, 'smb_clients', host, 'host')
-        key = (file_id, user_id, client_id, session_id)
-        seen_keys.add(key)
-
-        file_size = entry.get("Length")
-        if file_size is None:
-            file_size = get_file_size_ssh(cfg, raw_path)
-
-        if key in db_sessions:
-            if db_sessions[key]['initial_size'] is None and file_size is not None:
-                cur.execute(
-                    "UPDATE active_smb_sessions SET initial_size=%s WHERE id=%s",
-                    (file_size, db_sessions[key]["id"])
-                )
+    try:
+        cur.execute("SELECT * FROM active_smb_sessions")
+        db_sessions = {(r["file_id"], r["user_id"], r["client_id"], r["session_id"]): r for r in cur.fetchall()}
+
+        smb_usernames_current = set()
+        for entry in open_files:
+            smb_usernames_current.add(normalize_user(entry["ClientUserName"]))
+        if db_sessions:
+            user_ids = sorted({r["user_id"] for r in db_sessions.values()})
+            cur.execute(f"SELECT id, username FROM smb_users WHERE id IN ({','.join(['%s'] * len(user_ids))})", user_ids)
+            for rr in cur.fetchall():
+                smb_usernames_current.add(normalize_user(rr["username"]))
+
+        rdp_map = load_rdp_intervals(cfg, list(smb_usernames_current), conns)
+
+        file_ids = resolve_ids(cur, 'smb_files', [e["Path"] for e in open_files])
+        user_ids = resolve_ids(cur, 'smb_users', [e["ClientUserName"] for e in open_files])
+        client_ids = resolve_ids(cur, 'smb_clients', [e["ClientComputerName"] for e in open_files])
+
+        current = {}
+        for entry in open_files:
+            key = (file_ids[entry["Path"]], user_ids[entry["ClientUserName"]],
+                   client_ids[entry["ClientComputerName"]], str(entry["SessionId"]))
+            current.setdefault(key, entry)
+        seen_keys = set(current)
+
+        gone = [dbs for key, dbs in db_sessions.items() if key not in seen_keys]
+        paths = {}
+        for part in chunks(sorted({dbs["file_id"] for dbs in gone})):
+            cur.execute(f"SELECT id, path FROM smb_files WHERE id IN ({','.join(['%s'] * len(part))})", part)
+            paths.update({r['id']: r['path'] for r in cur.fetchall()})
+
+        # Размеры, которых не дал Get-SmbOpenFile, и итоговые размеры закрытых — одним пакетом
+        wanted = [e["Path"] for e in current.values() if e.get("Length") is None]
+        wanted += [paths[dbs["file_id"]] for dbs in gone if paths.get(dbs["file_id"])]
+        remote_sizes = get_file_sizes_ssh(cfg, wanted) if wanted else {}
+
+        def remote_size(path):
+            info = remote_sizes.get(path)
+            if info and info['exists'] and info['size'] is not None:
+                return int(info['size'])
+            return None
+
+        touched = []         # id активных сессий, которые всё ещё открыты
+        initial_sizes = []   # (id, размер) — размер появился впервые
+        new_rows = []
+        for key, entry in current.items():
+            raw_path = entry["Path"]
+            user = entry["ClientUserName"]
+
+            file_size = entry.get("Length")
+            if file_size is None:
+                file_size = remote_size(raw_path)
+
+            if key in db_sessions:
+                dbs = db_sessions[key]
+                if dbs['initial_size'] is None and file_size is not None:
+                    initial_sizes.append((dbs["id"], file_size))
+                touched.append(dbs["id"])
+            else:
+                norm_user = normalize_user(user)
+                intervals = rdp_map.get(norm_user, [])
+                open_in_rdp = 1 if ts_in_intervals(now_ts, intervals) else 0
+                new_rows.append((*key, now_ts, file_size, now_ts, open_in_rdp))
+                added[user] = added.get(user, 0) + 1
+
+        for part in chunks(touched):
             cur.execute(
-                "UPDATE active_smb_sessions SET last_seen=%s WHERE id=%s",
-                (now_ts, db_sessions[key]["id"])
+                f"UPDATE active_smb_sessions SET last_seen=%s WHERE id IN ({','.join(['%s'] * len(part))})",
+                [now_ts] + part
             )
-        else:
-            norm_user = normalize_user(user)
-            intervals = rdp_map.get(norm_user, [])
-            open_in_rdp = 1 if ts_in_intervals(now_ts, intervals) else 0
-
+        for part in chunks(initial_sizes):
             cur.execute(
+                "UPDATE active_smb_sessions SET initial_size = CASE id "
+                + " ".join(["WHEN %s THEN %s"] * len(part))
+                + f" END WHERE id IN ({','.join(['%s'] * len(part))})",
+                [x for pair in part for x in pair] + [sid for sid, _ in part]
+            )
+        if new_rows:
+            cur.executemany(
                 "INSERT INTO active_smb_sessions "
                 "(file_id, user_id, client_id, session_id, open_time, initial_size, last_seen, open_in_rdp) "
                 "VALUES (%s, %s, %s, %s, %s, %s, %s, %s)",
-                (file_id, user_id, client_id, session_id, now_ts, file_size, now_ts, open_in_rdp)
+                new_rows
             )
-            added[user] = added.get(user, 0) + 1
 
-    for key, dbs in db_sessions.items():
-        if key not in seen_keys:
+        history_rows = []
+        for dbs in gone:
             duration = int((now_ts - dbs["open_time"]).total_seconds())
             final_size = dbs["initial_size"]
-            cur.execute("SELECT path FROM smb_files WHERE id=%s", (dbs["file_id"],))
-            row = cur.fetchone()
-            file_path = row['path'] if row else None
+            file_path = paths.get(dbs["file_id"])
             if file_path:
-                size_now = get_file_size_ssh(cfg, file_path)
+                size_now = remote_size(file_path)
                 if size_now is not None:
                     final_size = size_now
-            open_in_rdp_val = dbs.get("open_in_rdp", 0)
-            cur.execute(
+            history_rows.append((
+                dbs["file_id"],
+                dbs["user_id"],
+                dbs["client_id"],
+                dbs["session_id"],
+                dbs["open_time"],
+                now_ts,
+                duration,
+                dbs["initial_size"],
+                final_size,
+                dbs.get("open_in_rdp", 0)
+            ))
+            closed[dbs['user_id']] = closed.get(dbs['user_id'], 0) + 1
+        if history_rows:
+            cur.executemany(
                 "INSERT INTO smb_session_history "
                 "(file_id, user_id, client_id, session_id, open_time, close_time, duration_sec, "
                 " initial_size, final_size, open_in_rdp) "
                 "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
-                (
-                    dbs["file_id"],
-                    dbs["user_id"],
-                    dbs["client_id"],
-                    dbs["session_id"],
-                    dbs["open_time"],
-                    now_ts,
-                    duration,
-                    dbs["initial_size"],
-                    final_size,
-                    open_in_rdp_val
-                )
+                history_rows
             )
-            cur.execute("DELETE FROM active_smb_sessions WHERE id=%s", (dbs["id"],))
-            closed[dbs['user_id']] = closed.get(dbs['user_id'], 0) + 1
+            for part in chunks([dbs["id"] for dbs in gone]):
+                cur.execute(f"DELETE FROM active_smb_sessions WHERE id IN ({','.join(['%s'] * len(part))})", part)
 
-    cur.close()
-    conn.close()
+        conn.commit()
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        if conns:
+            conns.drop('smbstat')
+        raise
+    finally:
+        cur.close()
+        if not conns:
+            conn.close()
 
     total_new = sum(added.values())
     total_closed = sum(closed.values())
@@ -366,22 +522,112 @@ def process_sessions(cfg, open_files):
         for uid, cnt in sorted(closed.items()):
             print(f"    - user_id={uid}: {cnt}")
 
+LOCK_FILE = "/run/smbmon.lock"
+DAEMON_INTERVAL = 30
+DAEMON_JITTER = 0.1   # доля интервала: циклы не совпадают с другими периодическими задачами
+
+def acquire_lock(path):
+    """flock на файл блокировки: одновременно переносить сессии в историю может только
+    один процесс (демон или запуск из cron). None — блокировку держит другой процесс."""
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    f = open(path, 'a+')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        return None
+    f.seek(0)
+    f.truncate()
+    f.write(f"{os.getpid()}\n")
+    f.flush()
+    return f
+
+def run_cycle(cfg, conns: Optional[Connections] = None) -> Dict:
+    """Один проход: открытые файлы с сервера -> active_smb_sessions / история. Возвращает тайминги."""
+    t0 = time.monotonic()
+    exclude_regex = cfg.get("exclude_path_regex")
+    pattern = re.compile(exclude_regex) if exclude_regex else None
+    open_files = get_open_files(cfg, pattern)
+    log_debug(f"Получено {len(open_files)} открытых файлов.")
+    t1 = time.monotonic()
+    process_sessions(cfg, open_files, conns)
+    t2 = time.monotonic()
+    return {'files': len(open_files), 'fetch': t1 - t0, 'db': t2 - t1, 'total': t2 - t0}
+
+def run_daemon(interval, jitter, lock_path):
+    """Демон: цикл раз в interval секунд (± jitter), соединения с БД между циклами не
+    закрываются. Цикл, не уложившийся в интервал, не запускает следующий внахлёст —
+    пропущенные сроки отбрасываются. SIGTERM/SIGINT: текущий цикл дорабатывает, затем выход."""
+    stop = threading.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda signum, frame: stop.set())
+
+    lock = acquire_lock(lock_path)
+    while lock is None:
+        logging.info(f"Блокировку {lock_path} держит другой процесс, ждём")
+        if stop.wait(interval):
+            return
+        lock = acquire_lock(lock_path)
+
+    conns = Connections()
+    stats = {'cycles': 0, 'errors': 0, 'overruns': 0, 'max_total': 0.0, 'sum_total': 0.0}
+    logging.info(f"smbmon: режим демона, интервал {interval} с, pid {os.getpid()}")
+    next_run = time.monotonic()
+    try:
+        while not stop.is_set():
+            cfg = load_config()  # снимок перечитывается только при изменении файла
+            try:
+                t = run_cycle(cfg, conns)
+                stats['cycles'] += 1
+                stats['sum_total'] += t['total']
+                stats['max_total'] = max(stats['max_total'], t['total'])
+                logging.info(f"Цикл {stats['cycles']}: файлов {t['files']}, ssh {t['fetch']:.2f} с, "
+                             f"БД {t['db']:.2f} с, всего {t['total']:.2f} с")
+            except Exception as exc:
+                stats['errors'] += 1
+                log_exception(exc)
+            next_run += interval
+            now_mono = time.monotonic()
+            if next_run < now_mono:
+                skipped = int((now_mono - next_run) // interval) + 1
+                stats['overruns'] += 1
+                logging.warning(f"Цикл дольше интервала, пропущено запусков: {skipped}")
+                next_run += skipped * interval
+            stop.wait(max(0.0, next_run - time.monotonic() + random.uniform(-jitter, jitter) * interval))
+    finally:
+        conns.close()
+        lock.close()
+        avg = stats['sum_total'] / stats['cycles'] if stats['cycles'] else 0.0
+        logging.info(f"smbmon остановлен: циклов {stats['cycles']}, ошибок {stats['errors']}, "
+                     f"перегрузок {stats['overruns']}, среднее {avg:.2f} с, максимум {stats['max_total']:.2f} с")
+
 def main():
+    ap = ArgumentParser(description='Мониторинг открытых файлов SMB')
+    ap.add_argument('--daemon', action='store_true', help='Работать постоянно с периодическим опросом')
+    ap.add_argument('--interval', type=float, help='Интервал опроса в режиме демона, с (smbmon.interval)')
+    args = ap.parse_args()
+
     cfg = load_config()
     setup_logging(cfg)
+    opts = cfg.get("smbmon", {})
+    lock_path = opts.get("lock_file", LOCK_FILE)
+    if args.daemon:
+        interval = args.interval or float(opts.get("interval", DAEMON_INTERVAL))
+        run_daemon(interval, float(opts.get("interval_jitter", DAEMON_JITTER)), lock_path)
+        return
+
     logging.info("Запуск smbmon (мониторинг и запись в БД)")
+    lock = acquire_lock(lock_path)
+    if lock is None:
+        log_debug(f"smbmon уже работает (блокировка {lock_path}), пропускаем запуск")
+        return
     try:
-        exclude_regex = cfg.get("exclude_path_regex")
-        pattern = re.compile(exclude_regex) if exclude_regex else None
-        open_files = get_open_files(cfg)
-        log_debug(f"Получено {len(open_files)} открытых файлов.")
-        if pattern:
-            open_files = [f for f in open_files if not pattern.search(f["Path"])]
-            log_debug(f"После фильтрации по exclude_path_regex осталось: {len(open_files)} файлов.")
-        process_sessions(cfg, open_files)
+        run_cycle(cfg)
     except Exception as exc:
         log_exception(exc)
         sys.exit(1)
+    finally:
+        lock.close()
 
 if __name__ == "__main__":
     main()
@@ -10,11 +10,16 @@ import os
 import csv
 from typing import Dict, Set, Tuple, List
 
+# Общие модули проекта (infra/): рядом со скриптом или в каталоге установки веб-приложения
+for _p in (os.environ.get('MONITORING_HOME', '/opt/monitoring-web'), os.path.dirname(os.path.realpath(__file__))):
+    if _p not in sys.path:
+        sys.path.insert(0, _p)
+from infra.config import get_config
+
 CONFIG_PATH = '/etc/infra/config.json'
 
 def load_config() -> dict:
-    with open(CONFIG_PATH, 'r', encoding='utf-8') as f:
-        return json.load(f)
+    return get_config(CONFIG_PATH)
 
 def load_map(map_file: str) -> Dict[str, str]:
     """
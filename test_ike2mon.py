@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Проверки ike2mon без MikroTik и MySQL: конфиг подменяется временным, модуль
+импортируется как библиотека (main() не запускается).
+"""
+
+import importlib
+import json
+import os
+import queue
+import socket
+import sys
+import tempfile
+import threading
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+try:
+    import pymysql  # noqa: F401
+except ImportError:
+    # ike2mon импортирует pymysql на уровне модуля; этим проверкам БД не нужна
+    sys.modules['pymysql'] = types.ModuleType('pymysql')
+
+import infra.config
+
+TMP = tempfile.mkdtemp(prefix='ike2mon-test-')
+TEST_CONFIG = {
+    'paths': {
+        'mikrotik_log': os.path.join(TMP, 'mikrotik.log'),
+        'ikev2_state_file': os.path.join(TMP, 'ikev2_state.csv'),
+        'ikev2_state_socket': os.path.join(TMP, 'state.sock'),
+    },
+    'mysql': {'vpnstat': {}},
+    'remote_host': {'mikrotik': {'ssh_host': '127.0.0.1', 'ssh_user': 'test', 'ssh_key': '/dev/null'}},
+}
+
+
+def load_ike2mon():
+    get_config = infra.config.get_config
+    infra.config.get_config = lambda path=None: TEST_CONFIG
+    try:
+        return importlib.import_module('ike2mon')
+    finally:
+        infra.config.get_config = get_config
+
+
+ike2mon = load_ike2mon()
+
+
+def run_with_timeout(func, timeout=5):
+    """True — func завершилась за timeout секунд"""
+    t = threading.Thread(target=func, daemon=True)
+    t.start()
+    t.join(timeout)
+    return not t.is_alive()
+
+
+def test_publish_drops_full_subscriber_without_blocking():
+    """Переполненная очередь подписчика не блокирует publish под sessions_lock"""
+    sub = queue.Queue(maxsize=3)
+    with ike2mon.sessions_lock:
+        ike2mon.subscribers.add(sub)
+    dropped = ike2mon.service_stats['dropped_subscribers']
+
+    def publish_many():
+        with ike2mon.sessions_lock:
+            for i in range(10):
+                ike2mon.publish('remove', {'inner_ip': f'10.0.0.{i}'})
+
+    assert run_with_timeout(publish_many)
+    assert sub not in ike2mon.subscribers
+    assert ike2mon.service_stats['dropped_subscribers'] == dropped + 1
+    items = []
+    while not sub.empty():
+        items.append(sub.get_nowait())
+    assert items[-1] is None
+
+
+def test_stalled_socket_subscriber_does_not_stop_publishing():
+    """Клиент подписался и перестал читать: события идут, клиент отключается, lock свободен"""
+    old_queue = ike2mon.SUBSCRIBER_QUEUE
+    ike2mon.SUBSCRIBER_QUEUE = 5
+    server = ike2mon.start_state_server()
+    assert server is not None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(ike2mon.STATE_SOCKET)
+        client.sendall(b'subscribe\n')
+        deadline = time.monotonic() + 5
+        while not ike2mon.subscribers and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert ike2mon.subscribers
+
+        # Крупные события забивают буфер сокета, отправка подписчику упирается в таймаут
+        payload = {'inner_ip': '10.0.0.1', 'pad': 'x' * 65536}
+
+        def publish_many():
+            for _ in range(200):
+                with ike2mon.sessions_lock:
+                    ike2mon.publish('remove', payload)
+
+        assert run_with_timeout(publish_many, timeout=10)
+        deadline = time.monotonic() + 10
+        while ike2mon.subscribers and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert not ike2mon.subscribers
+        # Поток сокета завершил подписку и отпустил блокировку
+        assert run_with_timeout(lambda: ike2mon.stats_message(), timeout=2)
+        assert json.loads(json.dumps(ike2mon.stats_message()))['type'] == 'stats'
+    finally:
+        client.close()
+        server.shutdown()
+        server.server_close()
+        ike2mon.SUBSCRIBER_QUEUE = old_queue